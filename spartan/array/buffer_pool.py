@@ -0,0 +1,112 @@
+'''
+A pool of recycled tile buffers.
+
+Iterative jobs (k-means, CG, PageRank) allocate a new array for every
+tile of every map and free the previous iteration's tiles soon after.
+Each worker keeps the buffers of destroyed tiles in a `BufferPool`, keyed
+by shape and dtype, and hands them out again for new tiles of the same
+size.  Only buffers handed out by the pool are taken back: the worker
+owns those, and returns them once the tile holding them is destroyed.
+'''
+
+import collections
+import weakref
+
+import numpy as np
+
+from spartan import util
+from spartan.config import FLAGS, IntFlag
+from spartan.rpc import rlock
+
+FLAGS.add(IntFlag('buffer_pool_size', default=256,
+                  help='MB of freed tile buffers kept by each worker for reuse (0 disables the pool)'))
+
+def _recyclable(data):
+  '''True if ``data`` is a plain array which owns its (writable) memory.'''
+  return type(data) is np.ndarray and data.base is None and \
+         data.flags.c_contiguous and data.flags.writeable and \
+         data.nbytes > 0 and not data.dtype.hasobject
+
+
+class BufferPool(object):
+  '''
+  Uninitialized arrays for reuse, grouped by (shape, dtype), with a memory budget.
+
+  When the budget is exceeded, the buffers of the least recently used
+  (shape, dtype) class are released.
+
+  :param max_bytes: Memory budget in bytes (0 disables the pool).
+  '''
+  def __init__(self, max_bytes):
+    self._max_bytes = max_bytes
+    self._buffers = collections.OrderedDict()
+    self._nbytes = 0
+    self._lock = rlock.FastRLock()
+    # Buffers handed out by `empty`, by id, which may be recycled.
+    self._issued = weakref.WeakValueDictionary()
+
+    self.hits = 0
+    self.misses = 0
+
+  def stats(self):
+    '''
+    :rtype: tuple of (hits, misses, bytes retained by the pool)
+    '''
+    return self.hits, self.misses, self._nbytes
+
+  def empty(self, shape, dtype):
+    '''
+    Return an uninitialized array of ``shape`` and ``dtype``, reusing a
+    recycled buffer if one is available.
+    '''
+    key = (tuple(shape), np.dtype(dtype))
+    with self._lock:
+      buffers = self._buffers.get(key)
+      if buffers:
+        data = buffers.pop()
+        if not buffers:
+          del self._buffers[key]
+        self._nbytes -= data.nbytes
+        self.hits += 1
+      else:
+        self.misses += 1
+        data = np.empty(key[0], dtype=key[1])
+      self._issued[id(data)] = data
+    return data
+
+  def recycle(self, data):
+    '''
+    Keep ``data`` for reuse by a later call to `empty`.
+
+    Only buffers handed out by `empty` are kept; anything else (e.g. an
+    array returned by a kernel, which may still hold it) is left alone.
+    The caller gives up ``data``: neither it nor anything it handed
+    ``data`` to may use it afterwards.
+    '''
+    with self._lock:
+      if self._issued.pop(id(data), None) is not data:
+        return False
+    if self._max_bytes <= 0 or not _recyclable(data) or data.nbytes > self._max_bytes:
+      return False
+
+    key = (data.shape, data.dtype)
+    with self._lock:
+      buffers = self._buffers.pop(key, [])
+      buffers.append(data)
+      self._buffers[key] = buffers
+      self._nbytes += data.nbytes
+
+      while self._nbytes > self._max_bytes:
+        _, old = self._buffers.popitem(last=False)
+        self._nbytes -= sum([b.nbytes for b in old])
+    return True
+
+  def clear(self):
+    with self._lock:
+      self._buffers.clear()
+      self._nbytes = 0
+
+  def log_stats(self):
+    hits, misses, nbytes = self.stats()
+    util.log_debug('Buffer pool: %d hits, %d misses, %d bytes retained',
+                   hits, misses, nbytes)
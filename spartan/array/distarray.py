@@ -12,12 +12,15 @@ from . import tile, extent, sparse
 from .. import util, core, blob_ctx, rpc
 from ..core import LocalKernelResult
 from ..util import Assert
-from ..config import FLAGS
+from ..config import FLAGS, IntFlag
 from .. import master
 
 # number of elements per tile
 DEFAULT_TILE_SIZE = 100000
 
+FLAGS.add(IntFlag('fetch_window', default=4,
+                  help='Number of fetches kept outstanding while iterating over an array'))
+
 
 def take_first(a, b):
   return a
@@ -116,6 +119,23 @@ def _tile_mapper(tile_id, blob, array=None, user_fn=None, **kw):
   return user_fn(ex, **kw)
 
 
+def _tile_prefetch(tile_id, blob, array=None, user_fn=None, **kw):
+  '''
+  Start fetching the inputs ``user_fn`` will read for ``blob``.
+
+  ``user_fn`` may provide this through a ``prefetch`` attribute, called
+  with the same arguments as ``user_fn``.
+
+  :rtype: The number of bytes being fetched.
+  '''
+  prefetch = getattr(user_fn, 'prefetch', None)
+  if prefetch is None:
+    return 0
+  return prefetch(array.extent_for_blob(tile_id), **kw)
+
+_tile_mapper.prefetch = _tile_prefetch
+
+
 class DistArray(object):
   '''The interface required for distributed arrays.
 
@@ -141,6 +161,18 @@ class DistArray(object):
   def update(self, ex, data):
     raise NotImplementedError
 
+  def prefetch(self, ex):
+    '''Start fetching the region ``ex`` ahead of a later `fetch`.
+
+    Returns:
+      int: The number of bytes being fetched (0 if nothing was started).
+    '''
+    return 0
+
+  def mark_updated(self):
+    '''Record that kernels have updated this array in place.'''
+    pass
+
   def foreach_tile(self, mapper_fn, kw):
     raise NotImplementedError
 
@@ -199,6 +231,18 @@ class DistArray(object):
     #util.log_info('Glomming: %s', self.shape)
     return self.select(np.index_exp[:])
 
+  def iter_tiles(self, window=None):
+    '''
+    Iterate over the data of this array as (`TileExtent`, data) pairs.
+
+    Arrays without tiles of their own yield a single pair for the whole array.
+    '''
+    yield extent.from_slice(np.index_exp[:], self.shape), self.glom()
+
+  def iter_blocks(self, axis=0, block_rows=None, window=None):
+    '''Iterate over blocks of this array along ``axis``; see `iter_tiles`.'''
+    return self.iter_tiles(window)
+
   def map_to_array(self, mapper_fn, kw=None):
     results = self.foreach_tile(mapper_fn=mapper_fn, kw=kw)
     extents = {}
@@ -243,15 +287,39 @@ class DistArrayImpl(DistArray):
 
     self.tiles = tiles
     self.id = ID_COUNTER.next()
+    # Process which created this array; ids are only unique within it.
+    self.origin = self.ctx.worker_id
+    # Incremented whenever ``tiles`` or (on the master) the contents change,
+    # so cached copies can be invalidated.
+    self.version = 0
+    # Incremented only when ``tiles`` change; identifies the tile map
+    # held by workers' kernel caches.
+    self.layout_version = 0
+    # Built on first use; tiles may move, but their extents don't change.
+    self._extent_index = None
 
     if self.ctx.is_master():
       #util.log_info('New array: %s, %s, %s tiles', shape, dtype, len(tiles))
       if _pending_destructors:
-        self.ctx.destroy_all(_pending_destructors)
-        del _pending_destructors[:]
+        # Arrays may be created by several scheduler threads at once, and
+        # __del__ may append at any time: take only the tiles seen here.
+        tiles = _pending_destructors[:]
+        del _pending_destructors[:len(tiles)]
+        self.ctx.destroy_all(tiles)
 
   def __reduce__(self):
-    return (DistArrayImpl, (self.shape, self.dtype, self.tiles, self.reducer_fn, self.sparse))
+    # copied: a `DataflowScheduler` may add tiles while kernels are sent.
+    return (DistArrayImpl, (self.shape, self.dtype, dict(self.tiles), self.reducer_fn, self.sparse),
+            {'id' : self.id, 'origin' : self.origin, 'version' : self.version,
+             'layout_version' : self.layout_version})
+
+  def cache_key(self):
+    '''
+    Identify this version of the array, across all processes.
+
+    :rtype: tuple of ((origin, id), version)
+    '''
+    return ((self.origin, self.id), self.version)
 
   def __del__(self):
     '''Destroy this array.
@@ -273,6 +341,32 @@ class DistArrayImpl(DistArray):
   def extent_for_blob(self, id):
     return self.blob_to_ex[id]
 
+  def extent_index(self):
+    '''Return an `ExtentIndex` over the extents of this array's tiles.'''
+    if self._extent_index is None:
+      self._extent_index = extent.ExtentIndex(self.tiles.iterkeys())
+    return self._extent_index
+
+  def mark_updated(self):
+    '''Record that kernels have updated this array in place.
+
+    `update` does this itself when called on the master; updates sent by
+    kernels on the workers are reported with the kernel's results.
+    '''
+    self.version += 1
+
+  def set_tile(self, ex, tile_id):
+    '''Replace the tile holding ``ex`` with ``tile_id``.'''
+    old_tile_id = self.tiles.get(ex)
+    if old_tile_id is not None:
+      self.blob_to_ex.pop(old_tile_id, None)
+    else:
+      self._extent_index = None
+    self.tiles[ex] = tile_id
+    self.blob_to_ex[tile_id] = ex
+    self.version += 1
+    self.layout_version += 1
+
   def tile_shape(self):
     scounts = collections.defaultdict(int)
     for ex in self.tiles.iterkeys():
@@ -280,16 +374,28 @@ class DistArrayImpl(DistArray):
 
     return sorted(scounts.items(), key=lambda kv: (kv[1], kv[0]))[-1][0]
 
-  def foreach_tile(self, mapper_fn, kw=None):
+  def foreach_tile(self, mapper_fn, kw=None, tile_ids=None):
+    '''
+    Run ``mapper_fn`` on every tile of this array.
+
+    If ``tile_ids`` is given, only those tiles are mapped over, and
+    only the workers holding them are sent the kernel.
+    '''
     ctx = blob_ctx.get()
 
     if kw is None: kw = {}
     kw['array'] = self
     kw['user_fn'] = mapper_fn
 
-    return ctx.map(self.tiles.values(),
+    if tile_ids is None:
+      return ctx.map(self.tiles.values(),
+                     mapper_fn=_tile_mapper,
+                     kw=kw)
+
+    return ctx.map(tile_ids,
                    mapper_fn=_tile_mapper,
-                   kw=kw)
+                   kw=kw,
+                   worker_ids=sorted(set([tile_id.worker for tile_id in tile_ids])))
 
   def fetch(self, region):
     '''
@@ -309,26 +415,75 @@ class DistArrayImpl(DistArray):
     # special case exact match against a tile
     if region in self.tiles:
       #util.log_warn('Exact match.')
-      ex, intersection = region, region
-      tile_id = self.tiles[region]
-      tgt = ctx.get(tile_id, extent.offset_slice(ex, intersection))
-      return tgt
+      splits = None
+      remote = self.tiles[region].worker != ctx.worker_id
+    else:
+      #util.log_warn('Remote fetch.')
+      splits = self.extent_index().find_overlapping(region)
+      remote = any([self.tiles[ex].worker != ctx.worker_id for ex, _ in splits])
 
-    #util.log_warn('Remote fetch.')
-    splits = list(extent.find_overlapping(self.tiles.iterkeys(), region))
+    # regions held by other workers may have been fetched already.
+    cache = ctx.fetch_cache if remote else None
+    if cache is not None:
+      tgt = cache.get(self.cache_key(), region)
+      if tgt is not None:
+        return tgt
 
     #util.log_info('Target shape: %s, %d splits', region.shape, len(splits))
     #util.log_info('Fetching %d tiles', len(splits))
 
-    futures = []
-    for ex, intersection in splits:
-      tile_id = self.tiles[ex]
-      futures.append(ctx.get(tile_id, extent.offset_slice(ex, intersection), wait=False))
+    prefetched = ctx.take_prefetch((self.cache_key(), region)) if remote else None
+    if prefetched is not None:
+      prefetch_splits, future = prefetched
+      tgt = self._stitch(region, prefetch_splits, future.wait())
+    elif splits is None:
+      tgt = ctx.get(self.tiles[region], extent.offset_slice(region, region))
+    else:
+      # fetch all pieces, with one request per worker holding any of them
+      tgt = self._stitch(region, splits, self._fetch_splits(splits).wait())
 
+    if cache is not None and (isinstance(tgt, np.ndarray) or scipy.sparse.issparse(tgt)):
+      cache.put(self.cache_key(), region, tgt)
+    return tgt
+
+  def prefetch(self, region):
+    '''
+    Start fetching ``region`` if any of it is held by another worker.
+
+    A later `fetch` of the region from the same thread waits for this
+    fetch instead of starting a new one.
+
+    :param region: `Extent` indicating the region to fetch.
+    :rtype: The number of bytes being fetched (0 if nothing was started).
+    '''
+    ctx = blob_ctx.get()
+    key = (self.cache_key(), region)
+    if ctx.has_prefetch(key):
+      return 0
+    if ctx.fetch_cache is not None and ctx.fetch_cache.contains(*key):
+      return 0
+
+    if region in self.tiles:
+      splits = [(region, region)]
+    else:
+      splits = self.extent_index().find_overlapping(region)
+    if all([self.tiles[ex].worker == ctx.worker_id for ex, _ in splits]):
+      return 0
+
+    ctx.add_prefetch(key, (splits, self._fetch_splits(splits)))
+    return int(np.prod(region.shape)) * np.dtype(self.dtype).itemsize
+
+  def _fetch_splits(self, splits):
+    '''Start fetching the (tile extent, intersection) pieces of a region.'''
+    return blob_ctx.get().multi_get([self.tiles[ex] for ex, _ in splits],
+                                    [extent.offset_slice(ex, intersection) for ex, intersection in splits],
+                                    wait=False)
+
+  def _stitch(self, region, splits, results):
+    '''Assemble the pieces of ``region`` fetched by `_fetch_splits`.'''
     # stitch results back together
     # if we have any masked tiles, then we need to create a masked array.
     # otherwise, create a dense array.
-    results = [r.data for r in rpc.wait_for_all(futures)]
 
     DENSE = 0
     MASKED = 1
@@ -345,12 +500,15 @@ class DistArrayImpl(DistArray):
       if scipy.sparse.issparse(r):
         output_type = SPARSE
 
+    if output_type == SPARSE:
+      # concatenate the entries of all pieces at once.
+      blocks = [(extent.offset_slice(region, intersection), result)
+                for (ex, intersection), result in zip(splits, results)]
+      return sparse.stack_blocks(region.shape, self.dtype, blocks)
+
     if output_type == MASKED:
       tgt = np.ma.MaskedArray(np.ndarray(region.shape, dtype=self.dtype))
       tgt.mask = 0
-    elif output_type == SPARSE:
-      tgt = scipy.sparse.coo_matrix(region.shape, dtype=self.dtype)
-      tgt = sparse.convert_sparse_array(tgt)
     else:
       tgt = np.ndarray(region.shape, dtype=self.dtype)
 
@@ -359,13 +517,78 @@ class DistArrayImpl(DistArray):
       #util.log_info('ex:%s region:%s intersection:%s dst_slice:%s result:%s', ex, region, intersection, dst_slice, result)
       #util.log_info('tgt.shape:%s result.shape:%s tgt.type:%s result.type:%s', tgt[dst_slice].shape, result.shape, type(tgt), type(result))
       if extent.all_nonzero_shape(result.shape):
-        if output_type == SPARSE:
-          tgt = sparse.compute_sparse_update(tgt, result, dst_slice)
-        else:
-          tgt[dst_slice] = result
+        tgt[dst_slice] = result
 
     return tgt
 
+  def _iter_regions(self, regions, window):
+    '''
+    Fetch each region in turn, keeping up to ``window`` fetches outstanding.
+
+    :param regions: iterable of (region, splits), where ``splits`` are the
+      (tile extent, intersection) pairs covering ``region``.
+    '''
+    if window is None:
+      window = FLAGS.fetch_window
+    window = max(1, window)
+
+    pending = collections.deque()
+    for region, splits in regions:
+      if len(pending) >= window:
+        region_, splits_, future = pending.popleft()
+        yield region_, self._stitch(region_, splits_, future.wait())
+      pending.append((region, splits, self._fetch_splits(splits)))
+
+    while pending:
+      region, splits, future = pending.popleft()
+      yield region, self._stitch(region, splits, future.wait())
+
+  def iter_tiles(self, window=None):
+    '''
+    Iterate over the tiles of this array, ordered by their upper-left corner.
+
+    Tiles are fetched ahead of the caller, so only about ``window`` tiles
+    are held locally at a time.
+
+    :param window: Number of fetches to keep outstanding (default: ``--fetch_window``).
+    :rtype: generator of (`TileExtent`, data) pairs
+    '''
+    extents = sorted(self.tiles.keys(), key=lambda ex: tuple(ex.ul))
+    return self._iter_regions([(ex, [(ex, ex)]) for ex in extents], window)
+
+  def iter_blocks(self, axis=0, block_rows=None, window=None):
+    '''
+    Iterate over consecutive blocks of this array along ``axis``.
+
+    Each block spans ``block_rows`` indices of ``axis`` and the whole of
+    every other axis; blocks are yielded in order, so they can be written
+    out incrementally (e.g. to a memmap or socket) without holding the
+    whole array.
+
+    :param axis: Axis to split the array along.
+    :param block_rows: Size of each block along ``axis`` (default: the most
+      common tile size along ``axis``).
+    :param window: Number of blocks to keep fetching ahead (default: ``--fetch_window``).
+    :rtype: generator of (`TileExtent`, data) pairs
+    '''
+    if len(self.shape) == 0:
+      return self.iter_tiles(window)
+
+    if block_rows is None:
+      block_rows = self.tile_shape()[axis]
+    block_rows = max(1, block_rows)
+
+    def _regions():
+      for start in xrange(0, self.shape[axis], block_rows):
+        ul = [0] * len(self.shape)
+        lr = list(self.shape)
+        ul[axis] = start
+        lr[axis] = min(start + block_rows, self.shape[axis])
+        region = extent.create(ul, lr, self.shape)
+        yield region, self.extent_index().find_overlapping(region)
+
+    return self._iter_regions(_regions(), window)
+
   def update_slice(self, slc, data):
     return self.update(extent.from_slice(slc, self.shape), data)
 
@@ -375,6 +598,16 @@ class DistArrayImpl(DistArray):
     Assert.eq(region.shape, data.shape,
               'Size of extent does not match size of data')
 
+    # cached copies of this array are now stale.
+    if ctx.is_master():
+      self.version += 1
+    else:
+      ctx.drop_prefetches(self.cache_key()[0])
+      if ctx.fetch_cache is not None:
+        ctx.fetch_cache.invalidate(self.cache_key()[0])
+      # the master bumps the version once the kernel is done.
+      ctx.record_update(self.cache_key()[0])
+
     # exact match
     if region in self.tiles:
       tile_id = self.tiles[region]
@@ -389,7 +622,7 @@ class DistArrayImpl(DistArray):
       for ex, tile_id in self.tiles.iteritems():
         slices.append((tile_id, ex.to_slice(), extent.offset_slice(ex, ex)))
     else:
-      splits = list(extent.find_overlapping(self.tiles, region))
+      splits = self.extent_index().find_overlapping(region)
       #util.log_info('%s: Updating %s tiles with data:%s', region, len(splits), data)
 
       for dst_extent, intersection in splits:
@@ -427,37 +660,39 @@ def create(shape,
            sharder=None,
            reducer=None,
            tile_hint=None,
-           sparse=False):
-  '''Make a new, empty DistArray'''
+           sparse=False,
+           fill_value=None):
+  '''
+  Make a new, empty DistArray.
+
+  If ``fill_value`` is given, the array is filled with it; its tiles are only
+  allocated once they are written.
+  '''
+  if sparse:
+    Assert.eq(fill_value, None, 'Sparse arrays can not have a fill value')
   ctx = blob_ctx.get()
   dtype = np.dtype(dtype)
   shape = tuple(shape)
 
   util.log_debug('Creating a new distarray with shape %s', str(shape))
   extents = compute_extents(shape, tile_hint, ctx.num_workers)
-  tiles = {}
   tile_type = tile.TYPE_SPARSE if sparse else tile.TYPE_DENSE
 
+  # worker to create each tile on; None picks one in round-robin order.
+  hints = {}
   if FLAGS.tile_assignment_strategy == 'round_robin':
     for ex, i in extents.iteritems():
-      tiles[ex] = ctx.create(
-                    tile.from_shape(ex.shape, dtype, tile_type=tile_type),
-                    hint=i)
+      hints[ex] = i
   elif FLAGS.tile_assignment_strategy == 'performance':
     worker_scores = master.get().get_worker_scores()
     for ex, i in extents.iteritems():
-      tiles[ex] = ctx.create(
-                  tile.from_shape(ex.shape, dtype, tile_type=tile_type),
-                  hint=worker_scores[i % len(worker_scores)][0])
+      hints[ex] = worker_scores[i % len(worker_scores)][0]
   elif FLAGS.tile_assignment_strategy == 'serpentine':
     for ex, i in extents.iteritems():
       j = i % ctx.num_workers
       if (i / ctx.num_workers) % 2 == 1:
         j = (ctx.num_workers - 1 - j)
-
-      tiles[ex] = ctx.create(
-                    tile.from_shape(ex.shape, dtype, tile_type=tile_type),
-                    hint=j)
+      hints[ex] = j
   elif FLAGS.tile_assignment_strategy == 'static':
     all_extents = list(extents.iterkeys())
     all_extents.sort()
@@ -467,16 +702,16 @@ def create(shape,
       map_file = appdirs.user_data_dir('spartan') + '/tiles_map'
     with open(map_file) as fp:
       for ex in all_extents:
-        worker = int(fp.readline().strip())
-        tiles[ex] = ctx.create(
-                    tile.from_shape(ex.shape, dtype, tile_type=tile_type),
-                    hint=worker)
+        hints[ex] = int(fp.readline().strip())
   else: #  random
     for ex in extents:
-      tiles[ex] = ctx.create(tile.from_shape(ex.shape, dtype, tile_type=tile_type))
+      hints[ex] = None
 
-  for ex in extents:
-    tiles[ex] = tiles[ex].wait().tile_id
+  # create all tiles with one request per worker.
+  all_extents = list(extents)
+  tile_ids = ctx.create_many([(ex.shape, dtype, tile_type, fill_value) for ex in all_extents],
+                             [hints[ex] for ex in all_extents])
+  tiles = dict(zip(all_extents, tile_ids))
 
   #for ex, i in extents.iteritems():
   #  util.log_warn("i:%d ex:%s, tile_id:%s", i, ex, tiles[ex])
@@ -495,33 +730,25 @@ def from_replica(X):
   reducer = X.reducer_fn
   sparse = X.sparse
   tile_type = tile.TYPE_SPARSE if sparse else tile.TYPE_DENSE
-  tiles = {}
-  worker_to_tiles = {}
-  for ex, tile_id in X.tiles.iteritems():
-    if tile_id.worker not in worker_to_tiles:
-      worker_to_tiles[tile_id.worker] = [ex]
-    else:
-      worker_to_tiles[tile_id.worker].append(ex)
 
-  for worker_id, ex_list in worker_to_tiles.iteritems():
-    for ex in ex_list:
-      tiles[ex] = ctx.create(tile.from_shape(ex.shape, dtype, tile_type=tile_type),
-                             hint=worker_id+1)
-
-  for ex in tiles:
-    tiles[ex] = tiles[ex].wait().tile_id
+  # place each replica on the worker after the one holding X's tile.
+  all_extents = list(X.tiles)
+  tile_ids = ctx.create_many([(ex.shape, dtype, tile_type, None) for ex in all_extents],
+                             [X.tiles[ex].worker + 1 for ex in all_extents])
+  tiles = dict(zip(all_extents, tile_ids))
 
   array = DistArrayImpl(shape=shape, dtype=dtype, tiles=tiles, reducer_fn=reducer, sparse=sparse)
   master.get().register_array(array)
   return array
 
 
-def from_table(extents):
+def from_table(extents, shape=None):
   '''
   Construct a distarray from an existing table.
   Keys must be of type `Extent`, values of type `Tile`.
 
-  Shape is computed as the maximum range of all extents.
+  Shape is computed as the maximum range of all extents, unless
+  ``shape`` is given (the table may then hold only some of the tiles).
 
   Dtype is taken from the dtype of the tiles.
 
@@ -529,7 +756,9 @@ def from_table(extents):
   '''
   Assert.no_duplicates(extents)
 
-  if not extents:
+  if shape is not None:
+    shape = tuple(shape)
+  elif not extents:
     shape = tuple()
   else:
     shape = extent.find_shape(extents.keys())
@@ -623,7 +852,10 @@ def best_locality(array, ex):
   :param table:
   :param ex:
   '''
-  splits = extent.find_overlapping(array.extents, ex)
+  if isinstance(array, DistArrayImpl):
+    splits = array.extent_index().find_overlapping(ex)
+  else:
+    splits = extent.find_overlapping(array.extents, ex)
   counts = collections.defaultdict(int)
   for key, overlap in splits:
     shard = array.extents[key]
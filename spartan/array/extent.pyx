@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import bisect
 import collections
+import itertools
 from spartan import util
 from spartan.util import Assert
 import numpy as np
@@ -255,14 +257,133 @@ def find_overlapping(extents, region):
   '''
   Return the extents that overlap with ``region``.
 
-  :param extents: List of extents to search over.
+  :param extents: List of extents to search over, or an `ExtentIndex`.
   :param region: `Extent` to match.
   '''
+  if isinstance(extents, ExtentIndex):
+    return iter(extents.find_overlapping(region))
+  return _scan_overlapping(extents, region)
+
+def _scan_overlapping(extents, region):
   for ex in extents:
     overlap = intersection(ex, region)
     if overlap is not None:
       yield (ex, overlap)
 
+cdef class ExtentIndex(object):
+  '''
+  An index for finding the extents that overlap with a region.
+
+  Extents which form a grid (as produced by `compute_extents`) are found
+  by searching the split points of each axis, and only the matching cells
+  are visited.  Other sets of extents are sorted by their position along
+  the first axis, and only those that can reach the region along that axis
+  are checked.
+
+  Overlaps are reported exactly as `intersection` does, so results match
+  a scan over all of the extents.
+  '''
+  cdef list _extents
+  cdef unsigned int _ndim
+  # grid mode: per-axis interval starts and stops, and the cell -> extent map.
+  cdef list _starts, _stops
+  cdef dict _cells
+  # fallback: extents sorted by their first coordinate.
+  cdef list _ul0
+  cdef coordinate_t _max_len0
+
+  def __init__(self, extents):
+    self._extents = list(extents)
+    self._cells = None
+    if len(self._extents) == 0:
+      self._ndim = 0
+      return
+
+    self._ndim = (<TileExtent>self._extents[0])._ul_len
+    if self._ndim == 0 or not self._build_grid():
+      self._build_sorted()
+
+  def _build_grid(self):
+    cdef TileExtent ex
+    cdef unsigned int d
+    intervals = [set() for d in range(self._ndim)]
+    for ex in self._extents:
+      for d in range(self._ndim):
+        intervals[d].add((ex._ul[d], ex._lr[d]))
+
+    self._starts = []
+    self._stops = []
+    for d in range(self._ndim):
+      axis = sorted(intervals[d])
+      for i in range(1, len(axis)):
+        if axis[i][0] < axis[i - 1][1]:
+          return False
+      self._starts.append([start for start, stop in axis])
+      self._stops.append([stop for start, stop in axis])
+
+    cells = {}
+    for i, ex in enumerate(self._extents):
+      cell = tuple([bisect.bisect_left(self._starts[d], ex._ul[d]) for d in range(self._ndim)])
+      if cell in cells:
+        return False
+      cells[cell] = i
+
+    if len(cells) != np.prod([len(starts) for starts in self._starts]):
+      return False
+
+    self._cells = cells
+    return True
+
+  def _build_sorted(self):
+    cdef TileExtent ex
+    self._extents.sort(key=lambda ex: ex.ul[0] if ex.ndim > 0 else 0)
+    self._ul0 = []
+    self._max_len0 = 0
+    for ex in self._extents:
+      if self._ndim == 0:
+        self._ul0.append(0)
+        continue
+      self._ul0.append(ex._ul[0])
+      if ex._lr[0] - ex._ul[0] > self._max_len0:
+        self._max_len0 = ex._lr[0] - ex._ul[0]
+
+  def __len__(self):
+    return len(self._extents)
+
+  def __iter__(self):
+    return iter(self._extents)
+
+  def find_overlapping(self, TileExtent region):
+    '''
+    :rtype: list of (extent, overlap) for the extents that overlap with ``region``.
+    '''
+    cdef unsigned int d
+    if self._cells is None:
+      if self._ndim == 0:
+        candidates = self._extents
+      else:
+        lo = bisect.bisect_left(self._ul0, region._ul[0] - self._max_len0)
+        hi = bisect.bisect_right(self._ul0, region._lr[0])
+        candidates = self._extents[lo:hi]
+      return list(_scan_overlapping(candidates, region))
+
+    ranges = []
+    for d in range(self._ndim):
+      # intervals with start <= region.lr and stop >= region.ul (see `intersection`).
+      lo = bisect.bisect_left(self._stops[d], region._ul[d])
+      hi = bisect.bisect_right(self._starts[d], region._lr[d])
+      if lo >= hi:
+        return []
+      ranges.append(xrange(lo, hi))
+
+    result = []
+    for cell in itertools.product(*ranges):
+      ex = self._extents[self._cells[cell]]
+      overlap = intersection(ex, region)
+      if overlap is not None:
+        result.append((ex, overlap))
+    return result
+
 def compute_slice(TileExtent base, idx):
   '''Return a new ``TileExtent`` representing ``base[idx]``
 
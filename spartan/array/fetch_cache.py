@@ -0,0 +1,137 @@
+'''
+A cache of array regions fetched from other workers.
+
+Join-style kernels (outer products, dot products, stencils) fetch the
+same remote region once per local tile.  Each worker keeps recently
+fetched regions in a `FetchCache`, keyed by the array's identity and
+version and by the fetched extent, so later fetches of the same region
+are served locally.
+
+Entries are dropped when the worker updates the source array, and (unless
+``--fetch_cache_across_kernels`` is set) when the kernel which fetched
+them finishes; until then they are only visible to that kernel.  Updates
+made by other workers are not observed, so regions are only shared
+across kernels for arrays which are not updated in place.
+'''
+
+import collections
+import threading
+
+from spartan import util
+from spartan.config import FLAGS, BoolFlag, IntFlag
+from spartan.rpc import rlock
+from .tile_store import data_nbytes
+
+FLAGS.add(IntFlag('fetch_cache_size', default=256,
+                  help='MB of remote array regions cached by each worker (0 disables caching)'))
+FLAGS.add(BoolFlag('fetch_cache_across_kernels', default=False,
+                   help='Keep cached remote regions between kernels'))
+
+
+class FetchCache(object):
+  '''
+  An LRU cache of fetched array regions with a memory budget.
+
+  Values are copied on the way in and out, so callers are free to modify
+  the data they fetched.
+
+  :param max_bytes: Memory budget in bytes (0 disables caching).
+  '''
+  def __init__(self, max_bytes):
+    self._max_bytes = max_bytes
+    self._entries = collections.OrderedDict()
+    self._nbytes = 0
+    self._lock = rlock.FastRLock()
+    # The kernel each thread is running (see `set_kernel`).
+    self._kernel = threading.local()
+
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self):
+    '''
+    :rtype: tuple of (hits, misses)
+    '''
+    return self.hits, self.misses
+
+  def set_kernel(self, kernel):
+    '''Attribute the regions this thread caches to ``kernel`` (see `end_kernel`).'''
+    self._kernel.val = kernel
+
+  def _key(self, array_key, region):
+    if FLAGS.fetch_cache_across_kernels:
+      return (None, array_key, region)
+    return (getattr(self._kernel, 'val', None), array_key, region)
+
+  def get(self, array_key, region):
+    '''
+    Return a copy of the cached data for ``region`` of an array, or None.
+
+    :param array_key: Identity and version of the array (see `DistArrayImpl.cache_key`).
+    :param region: `TileExtent`
+    '''
+    if self._max_bytes <= 0:
+      return None
+
+    key = self._key(array_key, region)
+    with self._lock:
+      if key not in self._entries:
+        self.misses += 1
+        return None
+      data, nbytes = self._entries.pop(key)
+      self._entries[key] = (data, nbytes)
+      self.hits += 1
+    return data.copy()
+
+  def contains(self, array_key, region):
+    '''True if ``region`` of an array is cached; does not count as a hit or miss.'''
+    if self._max_bytes <= 0:
+      return False
+    with self._lock:
+      return self._key(array_key, region) in self._entries
+
+  def put(self, array_key, region, data):
+    '''Cache a copy of ``data`` as the contents of ``region`` of an array.'''
+    nbytes = data_nbytes(data)
+    if nbytes > self._max_bytes:
+      return
+
+    data = data.copy()
+    key = self._key(array_key, region)
+    with self._lock:
+      if key in self._entries:
+        self._nbytes -= self._entries.pop(key)[1]
+      self._entries[key] = (data, nbytes)
+      self._nbytes += nbytes
+
+      while self._nbytes > self._max_bytes:
+        _, (_, old_bytes) = self._entries.popitem(last=False)
+        self._nbytes -= old_bytes
+
+  def invalidate(self, array_id):
+    '''
+    Drop all cached regions of an array, for all of its versions.
+
+    :param array_id: The first element of the array's `cache_key`.
+    '''
+    with self._lock:
+      for key in [k for k in self._entries if k[1][0] == array_id]:
+        self._nbytes -= self._entries.pop(key)[1]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._nbytes = 0
+
+  def end_kernel(self, kernel):
+    '''Called when ``kernel`` finishes; forgets its regions unless they are shared across kernels.'''
+    util.log_debug('Fetch cache: %d hits, %d misses, %d entries',
+                   self.hits, self.misses, len(self._entries))
+    if FLAGS.fetch_cache_across_kernels:
+      return
+    with self._lock:
+      for key in [k for k in self._entries if k[0] is kernel]:
+        self._nbytes -= self._entries.pop(key)[1]
@@ -12,23 +12,58 @@ from datetime import datetime
 ctypedef np.float32_t DTYPE_FLT
 ctypedef np.int32_t DTYPE_INT
 
+# Value and index types with native merge kernels.  Sparse tiles of other
+# types fall back to scipy.
+ctypedef fused DATA_T:
+  np.float32_t
+  np.float64_t
+  np.int64_t
+
+ctypedef fused INDEX_T:
+  np.int32_t
+  np.int64_t
+
+NATIVE_DTYPES = set([numpy.dtype(numpy.float32), numpy.dtype(numpy.float64), numpy.dtype(numpy.int64)])
+
 cdef public enum Reducers:
   REDUCE_ADD = 0
   REDUCE_MUL = 1
   REDUCE_NONE = 2
-  
+
+def reducer_kind(reducer):
+  '''
+  Map ``reducer`` to the kernel implementing it.
+
+  :rtype: One of `Reducers`, or None if ``reducer`` has no native kernel.
+  '''
+  if reducer is None:
+    return REDUCE_NONE
+  if reducer is numpy.add:
+    return REDUCE_ADD
+  if reducer is numpy.multiply:
+    return REDUCE_MUL
+  return None
+
 @cython.boundscheck(False) # turn of bounds-checking for entire function
-cpdef sparse_to_dense_update(np.ndarray[ndim=2, dtype=DTYPE_FLT] target, 
-                             np.ndarray[ndim=2, dtype=np.uint8_t, cast=True] mask, 
-                             np.ndarray[ndim=1, dtype=DTYPE_INT] rows,
-                             np.ndarray[ndim=1, dtype=DTYPE_INT] cols,
-                             np.ndarray[ndim=1, dtype=DTYPE_FLT] data,
-                             int reducer):
-  
-  cdef int i
-  cdef int size = rows.shape[0]
+@cython.wraparound(False)
+def sparse_to_dense_update(np.ndarray[ndim=2, dtype=DATA_T] target,
+                           np.ndarray[ndim=2, dtype=np.uint8_t, cast=True] mask,
+                           np.ndarray[ndim=1, dtype=INDEX_T] rows,
+                           np.ndarray[ndim=1, dtype=INDEX_T] cols,
+                           np.ndarray[ndim=1, dtype=DATA_T] data,
+                           int reducer):
+  '''
+  Apply the entries (rows, cols, data) to ``target``.  Entries whose ``mask``
+  is clear are replaced; entries outside of ``target`` are ignored.
+  '''
+  cdef Py_ssize_t i
+  cdef Py_ssize_t size = rows.shape[0]
+  cdef Py_ssize_t n_rows = target.shape[0]
+  cdef Py_ssize_t n_cols = target.shape[1]
   with nogil:
-    for i in xrange(size):
+    for i in range(size):
+      if rows[i] >= n_rows or cols[i] >= n_cols:
+        continue
       if reducer == REDUCE_NONE or mask[rows[i], cols[i]] == 0:
         target[rows[i], cols[i]] = data[i]
         mask[rows[i], cols[i]] = 1
@@ -37,6 +72,285 @@ cpdef sparse_to_dense_update(np.ndarray[ndim=2, dtype=DTYPE_FLT] target,
       elif reducer == REDUCE_MUL:
         target[rows[i], cols[i]] = target[rows[i], cols[i]] * data[i]
     
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+def _merge_compressed(np.ndarray[ndim=1, dtype=INDEX_T] a_indptr,
+                      np.ndarray[ndim=1, dtype=INDEX_T] a_indices,
+                      np.ndarray[ndim=1, dtype=DATA_T] a_data,
+                      np.ndarray[ndim=1, dtype=INDEX_T] b_indptr,
+                      np.ndarray[ndim=1, dtype=INDEX_T] b_indices,
+                      np.ndarray[ndim=1, dtype=DATA_T] b_data,
+                      Py_ssize_t major_start, Py_ssize_t major_stop,
+                      Py_ssize_t minor_start, Py_ssize_t minor_stop,
+                      int reducer):
+  '''
+  Merge the compressed matrix b into the rectangle [major_start:major_stop,
+  minor_start:minor_stop] of the compressed matrix a.
+
+  Both matrices must have sorted indices without duplicates.  Each row (or
+  column, for CSC) is merged in a single pass, so this is O(nnz(a) + nnz(b)).
+  Inside the rectangle, REDUCE_NONE replaces a with b, REDUCE_ADD keeps the
+  union of both and REDUCE_MUL keeps their intersection.
+
+  :rtype: tuple of (indptr, indices, data) of the result.
+  '''
+  cdef Py_ssize_t n_major = a_indptr.shape[0] - 1
+  cdef Py_ssize_t b_major = b_indptr.shape[0] - 1
+  cdef Py_ssize_t capacity = a_indices.shape[0] + b_indices.shape[0]
+  cdef np.ndarray[ndim=1, dtype=INDEX_T] indptr = numpy.empty(n_major + 1, dtype=a_indptr.dtype)
+  cdef np.ndarray[ndim=1, dtype=INDEX_T] indices = numpy.empty(capacity, dtype=a_indices.dtype)
+  cdef np.ndarray[ndim=1, dtype=DATA_T] data = numpy.empty(capacity, dtype=a_data.dtype)
+
+  cdef Py_ssize_t i, p, p_end, q, q_end, j, k = 0, n = 0
+  cdef bint in_rows
+  with nogil:
+    indptr[0] = 0
+    for i in range(n_major):
+      p = a_indptr[i]
+      p_end = a_indptr[i + 1]
+      q = 0
+      q_end = 0
+      in_rows = major_start <= i < major_stop
+      if in_rows and i - major_start < b_major:
+        q = b_indptr[i - major_start]
+        q_end = b_indptr[i - major_start + 1]
+
+      while p < p_end or q < q_end:
+        if q < q_end:
+          k = b_indices[q] + minor_start
+          if k >= minor_stop:
+            # indices are sorted, so the rest of b's row is outside as well.
+            q = q_end
+            continue
+
+        if q >= q_end or (p < p_end and a_indices[p] < k):
+          j = a_indices[p]
+          if reducer == REDUCE_ADD or not in_rows or j < minor_start or j >= minor_stop:
+            indices[n] = j
+            data[n] = a_data[p]
+            n += 1
+          p += 1
+        elif p >= p_end or k < a_indices[p]:
+          if reducer != REDUCE_MUL:
+            indices[n] = k
+            data[n] = b_data[q]
+            n += 1
+          q += 1
+        else:
+          indices[n] = k
+          if reducer == REDUCE_ADD:
+            data[n] = a_data[p] + b_data[q]
+          elif reducer == REDUCE_MUL:
+            data[n] = a_data[p] * b_data[q]
+          else:
+            data[n] = b_data[q]
+          n += 1
+          p += 1
+          q += 1
+      indptr[i + 1] = n
+
+  return indptr, indices[:n], data[:n]
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+def _slice_compressed(np.ndarray[ndim=1, dtype=INDEX_T] indptr,
+                      np.ndarray[ndim=1, dtype=INDEX_T] indices,
+                      np.ndarray[ndim=1, dtype=DATA_T] data,
+                      Py_ssize_t major_start, Py_ssize_t major_stop,
+                      Py_ssize_t minor_start, Py_ssize_t minor_stop):
+  '''
+  Extract [major_start:major_stop, minor_start:minor_stop] of a compressed
+  matrix, in time linear in the number of entries of the selected rows.
+
+  :rtype: tuple of (indptr, indices, data) of the result.
+  '''
+  cdef Py_ssize_t base = indptr[major_start]
+  cdef Py_ssize_t capacity = indptr[major_stop] - base
+  cdef np.ndarray[ndim=1, dtype=INDEX_T] out_indptr = numpy.empty(major_stop - major_start + 1, dtype=indptr.dtype)
+  cdef np.ndarray[ndim=1, dtype=INDEX_T] out_indices = numpy.empty(capacity, dtype=indices.dtype)
+  cdef np.ndarray[ndim=1, dtype=DATA_T] out_data = numpy.empty(capacity, dtype=data.dtype)
+
+  cdef Py_ssize_t i, p, n = 0
+  with nogil:
+    out_indptr[0] = 0
+    for i in range(major_start, major_stop):
+      for p in range(indptr[i], indptr[i + 1]):
+        if minor_start <= indices[p] < minor_stop:
+          out_indices[n] = indices[p] - minor_start
+          out_data[n] = data[p]
+          n += 1
+      out_indptr[i - major_start + 1] = n
+
+  return out_indptr, out_indices[:n], out_data[:n]
+
+def empty_native(shape, dtype):
+  '''Return an empty sparse matrix in the format `to_native` would choose.'''
+  return convert_sparse_array(scipy.sparse.csr_matrix(shape, dtype=dtype))
+
+def to_native(X):
+  '''
+  Convert ``X`` to the format sparse tiles are stored in: CSR, or CSC for
+  tall matrices, with sorted indices and no duplicates.  CSR and CSC
+  matrices keep their format.
+  '''
+  if X.format not in ('csr', 'csc'):
+    X = convert_sparse_array(X)
+  X.sum_duplicates()
+  return X
+
+def stack_blocks(shape, dtype, blocks):
+  '''
+  Assemble a sparse matrix of ``shape`` from non-overlapping blocks.
+
+  :param blocks: list of (slices, matrix), where ``matrix`` (sparse or dense)
+    holds the values of the region ``slices``.
+  :rtype: A matrix in the format `to_native` would choose.
+  '''
+  rows, cols, data = [], [], []
+  for slices, block in blocks:
+    block = scipy.sparse.coo_matrix(block)
+    if block.nnz == 0:
+      continue
+    rows.append(block.row.astype(numpy.int64) + slices[0].start)
+    cols.append(block.col.astype(numpy.int64) + slices[1].start)
+    data.append(block.data)
+
+  if not data:
+    return empty_native(shape, dtype)
+
+  result = scipy.sparse.coo_matrix((numpy.concatenate(data).astype(dtype, copy=False),
+                                    (numpy.concatenate(rows), numpy.concatenate(cols))),
+                                   shape=shape)
+  return to_native(result)
+
+def _unit_rect(slices, shape):
+  '''
+  Return ``slices`` as a list of (start, stop) per dimension, or None if
+  they select a strided region.
+  '''
+  if slices is None:
+    slices = ()
+  if len(slices) > len(shape):
+    return None
+  rect = []
+  for i, dim in enumerate(shape):
+    if i >= len(slices):
+      rect.append((0, dim))
+      continue
+    slc = slices[i]
+    if not isinstance(slc, __builtins__.slice):
+      return None
+    start, stop, step = slc.indices(dim)
+    if step != 1:
+      return None
+    rect.append((start, max(start, stop)))
+  return rect
+
+def _major_minor(X, rect):
+  if X.format == 'csc':
+    return rect[1], rect[0]
+  return rect[0], rect[1]
+
+def slice_compressed(X, slices):
+  '''
+  Return ``X[slices]`` for a CSR or CSC matrix ``X``, in the format of ``X``.
+  '''
+  rect = _unit_rect(slices, X.shape)
+  if rect is None or X.dtype not in NATIVE_DTYPES:
+    return X[slices]
+
+  X = to_native(X)
+  (major_start, major_stop), (minor_start, minor_stop) = _major_minor(X, rect)
+  indptr, indices, data = _slice_compressed(X.indptr, X.indices, X.data,
+                                            major_start, major_stop,
+                                            minor_start, minor_stop)
+  shape = tuple([stop - start for start, stop in rect])
+  return X.__class__((data, indices, indptr), shape=shape)
+
+def update_compressed(X, slices, update, reducer):
+  '''
+  Merge ``update`` (sparse or dense) into ``X[slices]`` with ``reducer``.
+
+  This is an out-of-place update; the result has the format of ``X``, which
+  must be CSR or CSC.
+  '''
+  rect = _unit_rect(slices, X.shape)
+  if rect is None or X.dtype not in NATIVE_DTYPES:
+    if not scipy.sparse.issparse(update):
+      update = scipy.sparse.csr_matrix(update)
+    return compute_sparse_update(X, update, slices, reducer)
+
+  X = to_native(X)
+  kind = reducer_kind(reducer)
+  if kind is None:
+    # No kernel for this reducer, and ufuncs don't apply to sparse matrices:
+    # reduce the densified region and replace it.
+    if scipy.sparse.issparse(update):
+      update = update.toarray()
+    update = reducer(slice_compressed(X, slices).toarray(), update)
+    kind = REDUCE_NONE
+
+  if scipy.sparse.issparse(update):
+    update = update.asformat(X.format)
+    if update.dtype != X.dtype:
+      update = update.astype(X.dtype)
+    update.sum_duplicates()
+  else:
+    update = X.__class__(numpy.asarray(update), dtype=X.dtype)
+
+  # Replacing the whole matrix needs no merge.
+  if kind == REDUCE_NONE and update.shape == X.shape and \
+     all([start == 0 and stop == dim for (start, stop), dim in zip(rect, X.shape)]):
+    return update
+
+  index_type = numpy.promote_types(X.indices.dtype, update.indices.dtype)
+  (major_start, major_stop), (minor_start, minor_stop) = _major_minor(X, rect)
+  indptr, indices, data = _merge_compressed(X.indptr.astype(index_type, copy=False),
+                                            X.indices.astype(index_type, copy=False),
+                                            X.data,
+                                            update.indptr.astype(index_type, copy=False),
+                                            update.indices.astype(index_type, copy=False),
+                                            update.data,
+                                            major_start, major_stop,
+                                            minor_start, minor_stop,
+                                            kind)
+  return X.__class__((data, indices, indptr), shape=X.shape)
+
+def update_dense(target, mask, update, reducer):
+  '''
+  Apply the sparse matrix ``update`` to the dense array ``target``.
+
+  Elements whose ``mask`` is clear are replaced, others are reduced.
+  Reducers without a native kernel are applied to ``update`` densified.
+  '''
+  kind = reducer_kind(reducer)
+  if kind is None:
+    dense = update.toarray()[:target.shape[0], :target.shape[1]]
+    region = target[:dense.shape[0], :dense.shape[1]]
+    valid = mask[:dense.shape[0], :dense.shape[1]]
+    region[...] = numpy.where(valid, reducer(region, dense), dense)
+    valid[...] = True
+    return
+
+  update = update.tocoo()
+  update.sum_duplicates()
+  if target.dtype in NATIVE_DTYPES:
+    index_type = numpy.promote_types(update.row.dtype, update.col.dtype)
+    sparse_to_dense_update(target, mask,
+                           update.row.astype(index_type, copy=False),
+                           update.col.astype(index_type, copy=False),
+                           update.data.astype(target.dtype, copy=False),
+                           kind)
+    return
+
+  inside = (update.row < target.shape[0]) & (update.col < target.shape[1])
+  rows, cols, data = update.row[inside], update.col[inside], update.data[inside]
+  if kind != REDUCE_NONE:
+    op = numpy.add if kind == REDUCE_ADD else numpy.multiply
+    data = numpy.where(mask[rows, cols], op(target[rows, cols], data), data)
+  target[rows, cols] = data
+  mask[rows, cols] = True
+
 @cython.boundscheck(False) # turn of bounds-checking for entire function   
 def dot_coo_dense_dict(X not None, np.ndarray[ndim=2, dtype=DTYPE_FLT] W not None):
     """Multiply a sparse coo matrix by a dense vector
@@ -285,10 +599,10 @@ def multiple_slice(X not None, list slices):
     if isinstance(X, scipy.sparse.coo_matrix) and X.shape[1] == 1:
         return multiple_slice_coo(X, slices)
     elif scipy.sparse.issparse(X):
-        X = X.tocsr()
+        X = to_native(X)
         l = []
         for (tile_id, src_slice, dst_slice) in slices:
-            result = X[src_slice]
+            result = slice_compressed(X, src_slice)
             if result.getnnz() == 0:
                 continue
             result = convert_sparse_array(result, use_getitem = False)
@@ -1,3 +1,4 @@
+import copy
 import traceback
 import numpy as np
 import scipy.sparse
@@ -11,9 +12,21 @@ TYPE_DENSE = 1
 TYPE_MASKED = 2
 TYPE_SPARSE = 3
 
+# Masks of dense tiles record which elements have been written.  A mask is
+# one of:
+#
+#   MASK_ALL_CLEAR -- no element is valid
+#   MASK_ALL_SET   -- every element is valid
+#   a list of rectangles -- the elements inside any of them are valid; each
+#                           rectangle is a tuple of (start, stop) per dimension
+#   a boolean array -- used when the valid region can't be described by a few
+#                      rectangles
 MASK_ALL_CLEAR = 0
 MASK_ALL_SET = 1
 
+# Partially written tiles switch to a boolean mask after this many rectangles.
+MAX_MASK_RECTS = 8
+
 # get: slice -> ndarray or sparse or masked
 # update: right now -- takes a Tile
 #   change to update: takes a (slice, data, reducer)
@@ -23,12 +36,14 @@ ID = iter(xrange(100000000))
 
 class Tile(object):
   '''
-  Tiles have 4 modes:
-
-  Empty   -- no data or mask
-  Masked  -- data + mask
-  Sparse  -- hashmap of positions (implicit mask)
-  Dense   -- all data values have been set, mask is cleared.
+  Tiles have 5 modes:
+
+  Empty    -- no data or mask
+  Constant -- every element has the same value; no data is allocated until
+              part of the tile is written (see `from_constant`).
+  Masked   -- data + mask
+  Sparse   -- hashmap of positions (implicit mask)
+  Dense    -- all data values have been set, mask is cleared.
   '''
 
   def __init__(self, shape, dtype, data, mask, tile_type):
@@ -38,6 +53,7 @@ class Tile(object):
     self.dtype = dtype
     self.type = tile_type
     self.mask = mask
+    self._fill = None
     self.data = data
     self.refcnt = 1
 
@@ -51,6 +67,7 @@ class Tile(object):
   @property
   def data(self):
     #util.log_info('DATA %s %s', self.id, self._data)
+    # None for constant tiles: use `get` to read them.
     return self._data
 
   @data.setter
@@ -60,21 +77,56 @@ class Tile(object):
       Assert.eq(val.dtype, self.dtype)
 
     self._data = val
+    self._fill = None
+
+  def is_constant(self):
+    '''True if this tile holds a single value and has no data allocated.'''
+    return self._data is None and self._fill is not None
+
+  def _materialize(self):
+    '''Allocate the data of a constant tile.'''
+    if self._fill == 0:
+      self.data = np.zeros(self.shape, dtype=self.dtype)
+    else:
+      self.data = np.full(self.shape, self._fill, dtype=self.dtype)
 
   def update(self, subslice, data, reducer):
     #util.log_info('Update: %s %s', subslice, data)
     return merge(self, subslice, data, reducer)
 
+  def copy(self):
+    '''Return a copy of this tile, which later updates to it don't change.'''
+    result = copy.copy(self)
+    if self._data is not None:
+      result._data = self._data.copy()
+    if isinstance(self.mask, np.ndarray):
+      result.mask = self.mask.copy()
+    elif isinstance(self.mask, list):
+      result.mask = list(self.mask)
+    return result
+
   def get(self, subslice=None):
     # no data, return an empty array
     if subslice is not None and not isinstance(subslice, tuple):
       subslice = (subslice,)
+    if self.is_constant():
+      # callers may keep or write the result, so it can't be a view of _fill.
+      shape = np.broadcast_to(self._fill, self.shape)[subslice].shape
+      data = np.full(shape, self._fill, dtype=self.dtype)
+      if self.all_valid(subslice):
+        return data
+      # elements which were never written read as masked.
+      mask = self.valid_mask(subslice)
+      result = np.ma.masked_all(shape, dtype=self.dtype)
+      result[mask] = data[mask]
+      return result
+
     if self.data is None:
       #self._initialize()
       #util.log_info('EMPTY %s %s', self.id, self.shape)
       if self.type == TYPE_SPARSE:
         shape = self.shape if subslice is None else tuple([slice.stop - slice.start for slice in subslice])
-        return scipy.sparse.coo_matrix(shape, self.dtype)
+        return sparse.empty_native(shape, self.dtype)
 
       return np.ndarray(self.shape, self.dtype)[subslice]
 
@@ -88,24 +140,17 @@ class Tile(object):
     # otherwise if sparse, return a sparse subset
     if self.type == TYPE_SPARSE:
       if subslice is None or extent.is_complete(self.data.shape, subslice):
-        result = self.data
-      else:
-        # TODO -- slicing doesn't really work for sparse arrays!
-        util.log_warn('Trying to slice a sparse tile  -- this will likely fail!')
-        result = self.data[subslice]
-      return result
+        return self.data
+      return sparse.slice_compressed(self.data, subslice)
 
     # dense, check our mask and return a masked segment or unmasked if
     # the mask is all filled for the selected region.
-    self._initialize_mask()
-
-    #return self.data[subslice]
-    if self.mask is None or np.all(self.mask[subslice]):
+    if self.all_valid(subslice):
       #util.log_info('%s %s %s', self.data, self.mask, subslice)
       return self.data[subslice]
 
     data = self.data[subslice]
-    mask = self.mask[subslice]
+    mask = self.valid_mask(subslice)
     result = np.ma.masked_all(data.shape, dtype=data.dtype)
     result[mask] = data[mask]
 
@@ -120,22 +165,82 @@ class Tile(object):
     if self.type == TYPE_SPARSE:
       if self.data is None:
         #util.log_info('New sparse: %s', self.shape)
-        self.data = scipy.sparse.coo_matrix(self.shape, dtype=self.dtype)
+        self.data = sparse.empty_native(self.shape, self.dtype)
     else:
       if self.data is None:
-        self.data = np.zeros(self.shape, dtype=self.dtype)
+        # Read as zeros, but only allocated once it is written (see `merge`).
+        self._fill = np.zeros((), dtype=self.dtype)
       self._initialize_mask()
 
   def _initialize_mask(self):
     if self.type == TYPE_SPARSE:
       self.mask = None
+
+  def all_valid(self, subslice=None):
+    '''True if every element of ``subslice`` has been written.'''
+    mask = self.mask
+    if mask is None or _is_flag(mask, MASK_ALL_SET):
+      return True
+    if _is_flag(mask, MASK_ALL_CLEAR):
+      return _is_empty(subslice, self.shape)
+    if isinstance(mask, list):
+      rect = _to_rect(subslice, self.shape)
+      if rect is not None and any(_contains(r, rect) for r in mask):
+        return True
+    return np.all(self.valid_mask(subslice))
+
+  def none_valid(self, subslice=None):
+    '''True if no element of ``subslice`` has been written.'''
+    mask = self.mask
+    if _is_flag(mask, MASK_ALL_CLEAR):
+      return True
+    if mask is None or _is_flag(mask, MASK_ALL_SET):
+      return _is_empty(subslice, self.shape)
+    if isinstance(mask, list):
+      rect = _to_rect(subslice, self.shape)
+      if rect is not None and not any(_intersects(r, rect) for r in mask):
+        return True
+    return not np.any(self.valid_mask(subslice))
+
+  def valid_mask(self, subslice=None):
+    '''Return a boolean array of the valid elements of ``subslice``.'''
+    if subslice is None:
+      subslice = Ellipsis
+    mask = self.mask
+    if isinstance(mask, np.ndarray):
+      return mask[subslice]
+    if isinstance(mask, list):
+      result = np.zeros(self.shape, dtype=np.bool)
+      for r in mask:
+        result[_to_slice(r)] = True
+      return result[subslice]
+    if _is_flag(mask, MASK_ALL_CLEAR):
+      return np.zeros(self.shape, dtype=np.bool)[subslice]
+    return np.ones(self.shape, dtype=np.bool)[subslice]
+
+  def mark_valid(self, subslice=None):
+    '''Record that every element of ``subslice`` has been written.'''
+    mask = self.mask
+    if mask is None or _is_flag(mask, MASK_ALL_SET):
       return
 
-    if not isinstance(self.mask, np.ndarray):
-      if self.mask == MASK_ALL_SET:
-        self.mask = np.ones(self.shape, dtype=np.bool)
-      elif self.mask == MASK_ALL_CLEAR:
-        self.mask = np.zeros(self.shape, dtype=np.bool)
+    rect = _to_rect(subslice, self.shape)
+    if rect is not None and _contains(rect, _to_rect(None, self.shape)):
+      self.mask = MASK_ALL_SET
+    elif isinstance(mask, np.ndarray):
+      mask[subslice] = True
+    elif rect is not None and _is_flag(mask, MASK_ALL_CLEAR):
+      self.mask = [rect]
+    elif rect is not None and len(mask) < MAX_MASK_RECTS:
+      if not any(_contains(r, rect) for r in mask):
+        self.mask = [r for r in mask if not _contains(rect, r)] + [rect]
+        # Check whether the rectangles now cover the tile, if they are large enough to.
+        if sum(_volume(r) for r in self.mask) >= np.prod(self.shape) and np.all(self.valid_mask()):
+          self.mask = MASK_ALL_SET
+    else:
+      bitmap = self.valid_mask()
+      bitmap[subslice] = True
+      self.mask = bitmap
 
 
   def __repr__(self):
@@ -146,19 +251,37 @@ def from_data(data):
   if scipy.sparse.issparse(data):
     return Tile(
       shape=data.shape,
-      data=data,
+      data=sparse.to_native(data),
       dtype=data.dtype,
       mask=MASK_ALL_SET,
       tile_type=TYPE_SPARSE)
   else:
+    if isinstance(data, np.ndarray) and not data.flags.writeable:
+      # e.g. a kernel argument shared by later kernels: the tile may be updated.
+      data = data.copy()
     return Tile(
       shape=data.shape,
       data=data,
       dtype=data.dtype,
-      mask=np.ones(data.shape, dtype=np.bool),
+      mask=MASK_ALL_SET,
       tile_type=TYPE_DENSE)
 
 
+def from_constant(shape, dtype, value):
+  '''
+  Return a dense tile of ``shape`` where every element is ``value``.
+
+  Only the value is stored until part of the tile is written.
+  '''
+  t = Tile(shape=shape,
+           data=None,
+           dtype=dtype,
+           tile_type=TYPE_DENSE,
+           mask=MASK_ALL_SET)
+  t._fill = np.asarray(value, dtype=dtype)
+  return t
+
+
 def from_shape(shape, dtype, tile_type):
   if tile_type == TYPE_SPARSE:
     return Tile(shape=shape,
@@ -176,32 +299,107 @@ def from_shape(shape, dtype, tile_type):
     assert False, 'Unknown tile type %s' % tile_type
 
 
-def from_intersection(src, overlap, data):
+def from_intersection(src, overlap, data, pool=None):
   '''
   Return a tile for ``src``, masked to update the area specifed by ``overlap``.
 
   :param src: `TileExtent`
   :param overlap: `TileExtent`
   :param data:
+  :param pool: Optional `BufferPool` to allocate the tile data from.
   '''
   util.log_debug('%s %s %s', src, overlap, data.dtype)
   slc = extent.offset_slice(src, overlap)
-  tdata = np.ndarray(src.shape, data.dtype)
-  tmask = np.zeros(src.shape, np.bool)
-  tmask[slc] = 1
+  if pool is not None:
+    tdata = pool.empty(src.shape, data.dtype)
+  else:
+    tdata = np.ndarray(src.shape, data.dtype)
   tdata[slc] = data
-  return Tile(dtype=data.dtype,
-              data=tdata,
-              shape=src.shape,
-              mask=tmask,
-              tile_type=TYPE_DENSE)
+  t = Tile(dtype=data.dtype,
+           data=tdata,
+           shape=src.shape,
+           mask=MASK_ALL_CLEAR,
+           tile_type=TYPE_DENSE)
+  t.mark_valid(slc)
+  return t
+
+
+def _is_identity(reducer, value):
+  '''True if reducing ``value`` with x using ``reducer`` always gives x.'''
+  return (reducer is np.add and value == 0) or (reducer is np.multiply and value == 1)
+
+
+def _is_flag(mask, flag):
+  return not isinstance(mask, (list, np.ndarray)) and mask == flag
+
+
+def _to_rect(subslice, shape):
+  '''
+  Convert ``subslice`` of an array of ``shape`` to a rectangle, or return
+  None if it selects a strided region.
+  '''
+  if subslice is None:
+    subslice = ()
+  elif not isinstance(subslice, tuple):
+    subslice = (subslice,)
+  if len(subslice) > len(shape):
+    return None
+
+  rect = []
+  for i, dim in enumerate(shape):
+    if i >= len(subslice):
+      rect.append((0, dim))
+      continue
+    slc = subslice[i]
+    if not isinstance(slc, slice):
+      return None
+    start, stop, step = slc.indices(dim)
+    if step != 1:
+      return None
+    rect.append((start, max(start, stop)))
+  return tuple(rect)
+
+
+def _to_slice(rect):
+  return tuple([slice(start, stop) for start, stop in rect])
+
+
+def _contains(outer, inner):
+  for (ostart, ostop), (istart, istop) in zip(outer, inner):
+    if istart < istop and (istart < ostart or istop > ostop):
+      return False
+  return True
+
+
+def _volume(rect):
+  return np.prod([max(0, stop - start) for start, stop in rect])
+
+
+def _intersects(a, b):
+  for (astart, astop), (bstart, bstop) in zip(a, b):
+    if max(astart, bstart) >= min(astop, bstop):
+      return False
+  return True
+
+
+def _is_empty(subslice, shape):
+  rect = _to_rect(subslice, shape)
+  if rect is None:
+    return np.ones(shape, dtype=np.bool)[subslice].size == 0
+  return any(start >= stop for start, stop in rect)
+
+
+def _all_set_mask(shape):
+  '''A writable boolean mask of ``shape`` which is all True, without allocating it.'''
+  return np.lib.stride_tricks.as_strided(np.ones(1, dtype=np.bool), shape=shape,
+                                         strides=(0,) * len(shape))
 
 
 def merge(old_tile, subslice, update, reducer):
   Assert.isinstance(old_tile, Tile)
 
   # TODO(Qi) -- see if we can still do the fast path.
-  if old_tile.data is None:
+  if old_tile.data is None and not old_tile.is_constant():
     # return tile.from_data_and_shape(???)
     old_tile._initialize()
 
@@ -210,6 +408,8 @@ def merge(old_tile, subslice, update, reducer):
 
   # zero-dimensional arrays; just use data == None as a mask.
   if len(old_tile.shape) == 0:
+    if old_tile.is_constant():
+      old_tile._materialize()
     if old_tile.data is None or reducer is None:
       old_tile.data = update
     else:
@@ -218,32 +418,47 @@ def merge(old_tile, subslice, update, reducer):
 
   assert not isinstance(update, np.ma.MaskedArray)
 
+  if subslice is None:
+    subslice = tuple([slice(None)] * len(old_tile.shape))
+
+  if old_tile.is_constant():
+    if scipy.sparse.issparse(update) or old_tile.shape != update.shape:
+      old_tile._materialize()
+    elif reducer is None or old_tile.none_valid() or \
+         (old_tile.all_valid() and _is_identity(reducer, old_tile._fill)):
+      # e.g. the first write to a new tile, or accumulating into zeros:
+      # the update replaces the tile.
+      old_tile.data = update.astype(old_tile.dtype)
+      old_tile.mark_valid(subslice)
+      return old_tile
+    elif old_tile.all_valid():
+      # The update covers the tile, so the value is only read (through a
+      # broadcast view) to reduce it.
+      old_tile.data = reducer(np.broadcast_to(old_tile._fill, old_tile.shape), update)
+      return old_tile
+    else:
+      old_tile._materialize()
+
   # Apply a sparse update array to the current tile data (which may be sparse or dense)
   if scipy.sparse.issparse(update):
     if old_tile.type == TYPE_DENSE:
       #util.log_debug('Update sparse to dense')
-      update_coo = update.tocoo()
-      sparse.sparse_to_dense_update(old_tile.data, old_tile.mask, update_coo.row, update_coo.col, update_coo.data,
-                                        sparse.REDUCE_ADD)
-      #util.log_info('Update %s', update)
-      #util.log_info('Update COO %s', update_coo)
-      #util.log_info('New mask: %s', old_tile.mask)
-      #if reducer is not None:
-      #  old_tile.data[subslice] = reducer(old_tile.data[subslice], update)
-      #else:
-      #  old_tile.data[subslice] = update.todense()
-      old_tile.mask[subslice] = True
-    else:
-      if old_tile.shape == update.shape:
-        if reducer is not None:
-          old_tile.data = reducer(old_tile.data, update)
-        else:
-          old_tile.data = update
+      # The implicit zeros of the update are written as well: clear the
+      # region if it is replaced, or the elements not written yet.
+      region = old_tile.data[subslice]
+      if reducer is None:
+        region[...] = 0
+        mask = _all_set_mask(region.shape)
+      elif old_tile.all_valid(subslice):
+        # Every element is reduced, so the mask is never read.
+        mask = _all_set_mask(region.shape)
       else:
-        old_tile.data = sparse.compute_sparse_update(old_tile.data,
-                                                     update,
-                                                     subslice,
-                                                     reducer)
+        mask = old_tile.valid_mask(subslice)
+        region[~mask] = 0
+      sparse.update_dense(region, mask, update, reducer)
+      old_tile.mark_valid(subslice)
+    else:
+      old_tile.data = sparse.update_compressed(old_tile.data, subslice, update, reducer)
     return old_tile
 
   # Apply a dense update array to the current tile data (which may be sparse or dense)
@@ -260,38 +475,29 @@ def merge(old_tile, subslice, update, reducer):
 
     # If the update shape is the same as the tile,
     # then avoid doing a (possibly expensive) slice update.
-    if old_tile.data.shape == update.shape:
-      if reducer is not None and old_tile.mask[np.unravel_index(0, old_tile.data.shape)]:
+    if old_tile.data.shape == update.shape and old_tile.all_valid():
+      if reducer is not None:
         old_tile.data = reducer(old_tile.data, update)
       else:
         old_tile.data = update.astype(old_tile.data.dtype)
-      old_tile.mask = np.ones(old_tile.shape, dtype=np.bool)
+    elif old_tile.data.shape == update.shape and old_tile.none_valid():
+      old_tile.data = update.astype(old_tile.data.dtype)
+    elif reducer is None or old_tile.none_valid(subslice):
+      old_tile.data[subslice] = update
+    elif old_tile.all_valid(subslice):
+      old_tile.data[subslice] = reducer(old_tile.data[subslice], update)
     else:
-      replaced = ~old_tile.mask[subslice]
-      updated = old_tile.mask[subslice]
+      updated = old_tile.valid_mask(subslice)
+      replaced = ~updated
 
       old_region = old_tile.data[subslice]
-      if np.any(replaced):
-        old_region[replaced] = update[replaced]
-
-      if np.any(updated):
-        if reducer is not None:
-          old_region[updated] = reducer(old_region[updated], update[updated])
-        else:
-          old_region[updated] = update[updated]
+      old_region[replaced] = update[replaced]
+      old_region[updated] = reducer(old_region[updated], update[updated])
 
-      old_tile.mask[subslice] = True
+    old_tile.mark_valid(subslice)
   else:
-    if old_tile.data is not None: #and old_tile.data.format == 'coo':
-      #old_tile.data = old_tile.data.tocsr()
-      old_tile.data = old_tile.data.tolil()
     #util.log_info('Update dense to sparse')
-    # TODO (SPARSE UPDATE)!!!
-    # sparse update, no mask, just iterate over data items
-    # TODO(POWER) -- this is SLOW!
-    if reducer is not None:
-      old_tile.data[subslice] = reducer(old_tile.data[subslice], update)
-    else:
-      old_tile.data[subslice] = update
+    # sparse tile, no mask: merge the non-zero elements of the update.
+    old_tile.data = sparse.update_compressed(old_tile.data, subslice, update, reducer)
 
   return old_tile
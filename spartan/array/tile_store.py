@@ -0,0 +1,221 @@
+'''
+A dictionary of tiles with a memory budget.
+
+Workers keep every tile they own in a `TileStore`.  When the resident
+size of the store exceeds the budget, the least recently used dense
+tiles are written to memory-mapped files under a spill directory.
+Spilled tiles are read back into memory the next time they are accessed.
+'''
+
+import os
+import numpy as np
+import scipy.sparse
+
+from spartan import util
+from spartan.rpc import rlock
+from . import tile
+
+
+def data_nbytes(data):
+  '''
+  Return the number of bytes of memory held by a dense or sparse array.
+
+  Memory-mapped data is not counted.
+  '''
+  nbytes = 0
+  if isinstance(data, np.memmap):
+    pass
+  elif isinstance(data, np.ndarray):
+    nbytes += data.nbytes
+  elif scipy.sparse.issparse(data):
+    for attr in ('data', 'indices', 'indptr', 'row', 'col'):
+      if hasattr(data, attr):
+        nbytes += getattr(data, attr).nbytes
+  return nbytes
+
+
+def tile_nbytes(t):
+  '''
+  Return the number of bytes of memory held by tile ``t``.
+
+  Spilled (memory-mapped) data and constant tiles are not counted.
+
+  :param t: `Tile`
+  '''
+  nbytes = 0 if t.is_constant() else data_nbytes(t.data)
+  if isinstance(t.mask, np.ndarray):
+    nbytes += t.mask.nbytes
+  return nbytes
+
+
+class TileStore(object):
+  '''
+  A mapping from tile id to `Tile`.
+
+  If ``budget`` is non-zero, cold tiles are spilled to ``spill_dir``
+  whenever a tile is stored and the store is over budget.  Reads never
+  spill, so a tile returned from the store is not swapped out from
+  under an update in progress.
+
+  Tiles may be updated by several threads at once, each holding the lock
+  of the tile it updates.  If ``tile_lock`` is given, a tile is only
+  spilled if its lock can be taken without waiting.
+
+  :param budget: Memory budget in bytes (0 disables spilling).
+  :param spill_dir: Directory to write spilled tiles to.
+  :param tile_lock: Optional function returning the lock guarding a tile id.
+  '''
+  def __init__(self, budget=0, spill_dir=None, tile_lock=None):
+    self._budget = budget
+    self._spill_dir = spill_dir
+    self._tile_lock = tile_lock
+    self._tiles = {}
+    self._last_access = {}
+    self._nbytes = {}
+    self._spilled = {}
+    self._resident_bytes = 0
+    self._clock = 0
+    self._lock = rlock.FastRLock()
+
+    self.spill_count = 0
+    self.spill_bytes = 0
+    self.reload_count = 0
+    self.reload_bytes = 0
+
+    if self._budget > 0:
+      if not os.path.exists(self._spill_dir):
+        os.makedirs(self._spill_dir)
+
+  def __len__(self):
+    return len(self._tiles)
+
+  def __contains__(self, tile_id):
+    return tile_id in self._tiles
+
+  def __iter__(self):
+    return iter(self._tiles)
+
+  def iterkeys(self):
+    return self._tiles.iterkeys()
+
+  def keys(self):
+    return self._tiles.keys()
+
+  def peek(self, tile_id):
+    '''
+    Return the tile for ``tile_id`` without reloading it or
+    marking it as recently used.
+    '''
+    return self._tiles[tile_id]
+
+  def __getitem__(self, tile_id):
+    t = self._tiles[tile_id]
+    if self._budget == 0:
+      return t
+
+    with self._lock:
+      self._clock += 1
+      self._last_access[tile_id] = self._clock
+      if tile_id in self._spilled:
+        self._reload(tile_id, t)
+    return t
+
+  def __setitem__(self, tile_id, t):
+    if self._budget == 0:
+      self._tiles[tile_id] = t
+      return
+
+    with self._lock:
+      if tile_id in self._tiles:
+        self._discard(tile_id)
+      self._tiles[tile_id] = t
+      self._clock += 1
+      self._last_access[tile_id] = self._clock
+      self._nbytes[tile_id] = tile_nbytes(t)
+      self._resident_bytes += self._nbytes[tile_id]
+      if self._resident_bytes > self._budget:
+        self._evict(tile_id)
+
+  def __delitem__(self, tile_id):
+    if self._budget == 0:
+      del self._tiles[tile_id]
+      return
+
+    with self._lock:
+      self._discard(tile_id)
+      del self._tiles[tile_id]
+
+  def _discard(self, tile_id):
+    self._resident_bytes -= self._nbytes.pop(tile_id, 0)
+    self._last_access.pop(tile_id, None)
+    path = self._spilled.pop(tile_id, None)
+    if path is not None:
+      os.unlink(path)
+
+  def _evict(self, current_id):
+    # Sizes may have drifted since the tiles were stored (masks and
+    # data are allocated lazily), so recompute them before choosing victims.
+    self._resident_bytes = 0
+    for tile_id in self._nbytes:
+      self._nbytes[tile_id] = tile_nbytes(self._tiles[tile_id])
+      self._resident_bytes += self._nbytes[tile_id]
+
+    candidates = sorted(self._nbytes, key=lambda tile_id: self._last_access[tile_id])
+    for tile_id in candidates:
+      if self._resident_bytes <= self._budget:
+        break
+      if tile_id == current_id:
+        continue
+      if self._tile_lock is None:
+        self._spill(tile_id, self._tiles[tile_id])
+        continue
+
+      # skip tiles which are being updated by another thread.
+      lock = self._tile_lock(tile_id)
+      if lock.acquire(False):
+        try:
+          self._spill(tile_id, self._tiles[tile_id])
+        finally:
+          lock.release()
+
+  def _spill(self, tile_id, t):
+    data = t.data
+    if not isinstance(data, np.ndarray) or isinstance(data, np.memmap) or \
+       t.type == tile.TYPE_SPARSE or len(data.shape) == 0 or t.is_constant():
+      return
+
+    path = os.path.join(self._spill_dir, '%d-%d.npy' % (os.getpid(), t.id))
+    np.save(path, np.ascontiguousarray(data))
+    t.data = np.load(path, mmap_mode='r+')
+
+    nbytes = data.nbytes
+    self._spilled[tile_id] = path
+    self._nbytes[tile_id] -= nbytes
+    self._resident_bytes -= nbytes
+    self.spill_count += 1
+    self.spill_bytes += nbytes
+    util.log_debug('Spilled tile %s (%d bytes) to %s', tile_id, nbytes, path)
+
+  def _reload(self, tile_id, t):
+    path = self._spilled.pop(tile_id)
+    t.data = np.array(t.data)
+    os.unlink(path)
+
+    nbytes = t.data.nbytes
+    self._nbytes[tile_id] += nbytes
+    self._resident_bytes += nbytes
+    self.reload_count += 1
+    self.reload_bytes += nbytes
+
+  def stats(self):
+    '''
+    :rtype: tuple of (spill_count, spill_bytes, reload_count, reload_bytes)
+    '''
+    return (self.spill_count, self.spill_bytes,
+            self.reload_count, self.reload_bytes)
+
+  def clear(self):
+    '''Remove all tiles and any spill files.'''
+    with self._lock:
+      for tile_id in self._tiles.keys():
+        del self[tile_id]
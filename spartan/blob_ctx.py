@@ -6,17 +6,89 @@ running user-defined *kernel functions* on tile data.
 '''
 
 
-from . import util, rpc, core
+from . import util, rpc, core, kernel_cache
+import collections
+import numpy as np
+import socket
 import threading
+from .config import FLAGS, BoolFlag, IntFlag
 from .util import Assert
 import random
 
 MASTER_ID = 65536
 ID_COUNTER = iter(xrange(10000000))
 
+FLAGS.add(BoolFlag('shared_memory_tiles', default=False,
+                   help='Read tiles of workers on the same host through shared memory'))
+FLAGS.add(IntFlag('update_buffer_size', default=64,
+                  help='MB of non-blocking updates combined by each kernel thread before sending (0 disables)'))
+
+
+def _done_future():
+  f = rpc.Future(None, -1)
+  f.done()
+  return f
+
+
+def _update_key(req):
+  '''Key identifying the tile region written by ``req``, or None.'''
+  if not isinstance(req.region, tuple):
+    return None
+  region = []
+  for s in req.region:
+    if not isinstance(s, slice):
+      return None
+    region.append((s.start, s.stop, s.step))
+  return (req.id.worker, req.id.id, tuple(region))
+
+
+def _combine_update(pending, req):
+  '''
+  Merge ``req`` into the pending update of the same region.
+
+  Only dense updates are combined; reducers are assumed to be associative,
+  as updates from different workers may be applied in any order.
+
+  Returns:
+    bool: True if ``req`` was merged.
+  '''
+  old, new = pending.data, req.data
+  if type(old) is not np.ndarray or type(new) is not np.ndarray or \
+     old.shape != new.shape or pending.reducer is not req.reducer:
+    return False
+
+  if req.reducer is None:
+    pending.data = new
+  else:
+    pending.data = req.reducer(old, new)
+  return True
+
+
+class MultiGetFuture(object):
+  '''The data requested by a non-blocking `BlobCtx.multi_get`.'''
+  def __init__(self, count, futures):
+    self._count = count
+    self._futures = futures
+
+  def wait(self):
+    '''
+    Returns:
+      list: the data fetched from each tile, in the order they were requested.
+    '''
+    results = [None] * self._count
+    for idx, f in self._futures:
+      resp = f.wait()
+      if isinstance(resp, core.MultiGetResp):
+        for i, data in zip(idx, resp.data):
+          results[i] = data
+      else:
+        results[idx[0]] = resp.data
+    return results
+
 
 class BlobCtx(object):
-  def __init__(self, worker_id, workers, local_worker=None):
+  def __init__(self, worker_id, workers, local_worker=None, fetch_cache=None,
+               buffer_pool=None):
     '''
     Create a new context.
     
@@ -26,6 +98,8 @@ class BlobCtx(object):
       local_worker (Worker): A reference to the local worker creating this context.
         This is used to avoid sending RPC messages for operations that can be 
         serviced locally.
+      fetch_cache (FetchCache): Optional.  Cache of array regions fetched from other workers.
+      buffer_pool (BufferPool): Optional.  Recycled buffers for new tiles.
     '''
     assert isinstance(workers, dict)
     assert isinstance(worker_id, int)
@@ -35,8 +109,37 @@ class BlobCtx(object):
     self.workers = workers
     self.id_map = {}
     self.local_worker = local_worker
+    self.fetch_cache = fetch_cache
+    self.buffer_pool = buffer_pool
     self.active = True
 
+    # Workers on this host; with --shared_memory_tiles, fetches from
+    # these workers map the tile data instead of copying it over RPC.
+    local_peers = []
+    if FLAGS.shared_memory_tiles:
+      hostname = socket.gethostname()
+      for id, client in workers.iteritems():
+        if id != MASTER_ID and id != worker_id and client.host == hostname:
+          local_peers.append(id)
+    self.local_peers = frozenset(local_peers)
+
+    # Per-thread buffers of pending updates (see `buffer_updates`).
+    self._update_buffer = threading.local()
+
+    # Per-thread fetches started ahead of use (see `add_prefetch`).
+    self._prefetches = threading.local()
+
+    # Per-thread set of the arrays updated by the running kernel (see `track_updates`).
+    self._updated_arrays = threading.local()
+
+    # Serializes encoding and sending kernels (see `map`).
+    self._kernel_lock = threading.Lock()
+
+    if self.is_master() and FLAGS.kernel_cache_size > 0:
+      self.kernel_encoder = kernel_cache.KernelEncoder(FLAGS.kernel_cache_size)
+    else:
+      self.kernel_encoder = None
+
     #util.log_info('New blob ctx.  Worker=%s', self.worker_id)
     
   def is_master(self):
@@ -127,6 +230,9 @@ class BlobCtx(object):
   def get(self, tile_id, subslice, wait=True, timeout=None):
     '''
     Fetch a region of a tile.
+
+    Tiles held by another worker on the same host are returned as a
+    copy-on-write view of the owner's shared memory (see `Worker.get_shared`).
     
     Args:
       tile_id (int): Tile to fetch from.
@@ -137,10 +243,15 @@ class BlobCtx(object):
     Assert.isinstance(tile_id, core.TileId)
     req = core.GetReq(id=tile_id, subslice=subslice)
 
+    if subslice is not None and tile_id.worker in self.local_peers:
+      method = 'get_shared'
+    else:
+      method = 'get'
+
     if wait:
-      return self._send(tile_id, 'get', req, wait=True, timeout=timeout).data
+      return self._send(tile_id, method, req, wait=True, timeout=timeout).data
     else:
-      return self._send(tile_id, 'get', req, wait=False)
+      return self._send(tile_id, method, req, wait=False)
 
   def get_flatten(self, tile_id, subslice, wait=True, timeout=None):
     '''
@@ -160,6 +271,45 @@ class BlobCtx(object):
     else:
       return self._send(tile_id, 'get_flatten', req, wait=False)
     
+  def multi_get(self, tile_ids, subslices, flatten=False, wait=True, timeout=None):
+    '''
+    Fetch regions of several tiles, with one request per owning worker.
+
+    Tiles held by another worker on the same host are fetched through
+    shared memory, as for `get`.
+
+    Args:
+      tile_ids (list): Tiles to fetch from.
+      subslices (list): Portion of each tile to fetch (slice or None).
+      flatten (boolean): Fetch from the flatten format of the tiles (see `get_flatten`).
+      wait (boolean): Wait for the data to arrive before returning.
+      timeout (float):
+
+    Returns:
+      list: the data fetched from each tile, in the order of ``tile_ids``.
+      If ``wait`` is False, a `MultiGetFuture` for this list.
+    '''
+    by_worker = collections.defaultdict(list)
+    futures = []
+    for i, (tile_id, subslice) in enumerate(zip(tile_ids, subslices)):
+      Assert.isinstance(tile_id, core.TileId)
+      if not flatten and subslice is not None and tile_id.worker in self.local_peers:
+        futures.append(([i], self.get(tile_id, subslice, wait=False, timeout=timeout)))
+      else:
+        by_worker[tile_id.worker].append(i)
+
+    method = 'multi_get_flatten' if flatten else 'multi_get'
+    for worker_id, idx in by_worker.iteritems():
+      req = core.MultiGetReq(ids=[tile_ids[i] for i in idx],
+                             subslices=[subslices[i] for i in idx])
+      futures.append((idx, self._send_to_worker(worker_id, method, req,
+                                                wait=False, timeout=timeout)))
+
+    future = MultiGetFuture(len(tile_ids), futures)
+    if wait:
+      return future.wait()
+    return future
+
   def update(self, tile_id, region, data, reducer, wait=True, timeout=None):
     '''
     Update ``region`` of ``tile_id`` with ``data``.
@@ -176,8 +326,122 @@ class BlobCtx(object):
     '''
 
     req = core.UpdateReq(id=tile_id, region=region, data=data, reducer=reducer)
-    return self._send(tile_id, 'update', req, wait=wait, timeout=timeout)
+    buffer = getattr(self._update_buffer, 'updates', None)
+    if wait or buffer is None:
+      return self._send(tile_id, 'update', req, wait=wait, timeout=timeout)
+
+    # Combine with an earlier update of the same region, if possible.
+    key = _update_key(req)
+    if key in buffer and _combine_update(buffer[key], req):
+      return _done_future()
+
+    if key is None:
+      key = ('pending', len(buffer))
+    buffer[key] = req
+    self._update_buffer.nbytes += getattr(data, 'nbytes', 0)
+    if self._update_buffer.nbytes > FLAGS.update_buffer_size * 1024 * 1024:
+      futures = self.flush_updates()
+      self.buffer_updates()
+      return futures
+
+    return _done_future()
+
+  def buffer_updates(self):
+    '''
+    Start buffering non-blocking updates issued by this thread.
+
+    Updates to the same region of a tile are combined locally using their
+    reducer, and the rest are sent with one request per worker by
+    `flush_updates`.  Futures returned by `update` for buffered updates
+    are already complete; the futures from `flush_updates` must be waited
+    for instead.
+    '''
+    if FLAGS.update_buffer_size > 0:
+      self._update_buffer.updates = collections.OrderedDict()
+      self._update_buffer.nbytes = 0
+
+  def flush_updates(self, timeout=None):
+    '''
+    Send the updates buffered by this thread, and stop buffering.
+
+    Returns:
+      `FutureGroup`: one future per worker updated.
+    '''
+    buffer = getattr(self._update_buffer, 'updates', None)
+    self._update_buffer.updates = None
+    futures = rpc.FutureGroup()
+    if not buffer:
+      return futures
+
+    by_worker = collections.defaultdict(list)
+    for req in buffer.itervalues():
+      by_worker[self._lookup(req.id)].append(req)
+
+    for worker_id, updates in by_worker.iteritems():
+      if len(updates) == 1:
+        futures.append(self._send_to_worker(worker_id, 'update', updates[0],
+                                            wait=False, timeout=timeout))
+      else:
+        req = core.MultiUpdateReq(updates=updates)
+        futures.append(self._send_to_worker(worker_id, 'multi_update', req,
+                                            wait=False, timeout=timeout))
+    return futures
   
+  def track_updates(self, updated):
+    '''
+    Add the identity of every array this thread updates to ``updated``.
+
+    Workers report these with the results of a kernel, so the master can
+    mark the arrays as updated (see `map`).  None stops tracking.
+    '''
+    self._updated_arrays.val = updated
+
+  def record_update(self, array_id):
+    '''Record that this thread updated the array identified by ``array_id``.'''
+    updated = getattr(self._updated_arrays, 'val', None)
+    if updated is not None:
+      updated.add(array_id)
+
+  def _prefetch_table(self):
+    table = getattr(self._prefetches, 'table', None)
+    if table is None:
+      table = self._prefetches.table = {}
+    return table
+
+  def add_prefetch(self, key, value):
+    '''
+    Record a fetch started by this thread ahead of its use.
+
+    Futures can only be waited for by the thread which created them, so
+    prefetches are only visible to the thread which started them.
+
+    Args:
+      key: ((array identity, version), region) being fetched.
+      value: Whatever the array needs to finish the fetch.
+    '''
+    self._prefetch_table()[key] = value
+
+  def has_prefetch(self, key):
+    return key in self._prefetch_table()
+
+  def take_prefetch(self, key):
+    '''Return and forget the prefetch for ``key`` started by this thread, or None.'''
+    return self._prefetch_table().pop(key, None)
+
+  def drop_prefetches(self, array_id=None):
+    '''
+    Forget the prefetches started by this thread, for one array or all of them.
+
+    Args:
+      array_id: The identity (first element of the cache key) of an array.
+    '''
+    table = self._prefetch_table()
+    if array_id is None:
+      table.clear()
+      return
+    for key in [k for k in table if k[0][0] == array_id]:
+      del table[key]
+
   def new_tile_id(self):
     '''
     Create a new tile id.  Does not create a new tile, or any data. 
@@ -232,18 +496,10 @@ class BlobCtx(object):
 
     # workers create blobs locally; master dispatches to a 
     # worker in round-robin order.
+    worker_id = self._create_target(hint)
     if self.is_master():
-      if hint is None:
-        worker_id = ID_COUNTER.next() % len(self.workers)
-      else:
-        worker_id = hint % len(self.workers)
-        
-      if worker_id not in self.local_worker._available_workers:
-        worker_id = random.choice(self.local_worker._available_workers)
-        
       id = -1
     else:
-      worker_id = self.worker_id
       id = ID_COUNTER.next()
 
     tile_id = core.TileId(worker=worker_id, id=id)
@@ -253,7 +509,54 @@ class BlobCtx(object):
     req = core.CreateTileReq(tile_id=tile_id, data=data)
     return self._send(tile_id, 'create', req, wait=False, timeout=timeout)
 
-  def map(self, tile_ids, mapper_fn, kw, timeout=None):
+  def _create_target(self, hint):
+    '''Return the worker a new tile should be created on.'''
+    if not self.is_master():
+      return self.worker_id
+
+    if hint is None:
+      worker_id = ID_COUNTER.next() % len(self.workers)
+    else:
+      worker_id = hint % len(self.workers)
+
+    if worker_id not in self.local_worker._available_workers:
+      worker_id = random.choice(self.local_worker._available_workers)
+    return worker_id
+
+  def create_many(self, descriptors, hints=None, timeout=None):
+    '''
+    Create empty tiles, with one request per worker.
+
+    Args:
+      descriptors (list): (shape, dtype, tile_type, fill_value) of each tile.  Tiles
+        with a fill_value other than None are created with `tile.from_constant`.
+      hints (list): Optional.  Worker to create each tile on (or None), as for `create`.
+      timeout (float):
+
+    Returns:
+      list: the `TileId` of each tile, in the order of ``descriptors``.
+    '''
+    assert self.worker_id >= 0, self.worker_id
+    if hints is None:
+      hints = [None] * len(descriptors)
+
+    by_worker = collections.defaultdict(list)
+    for i, hint in enumerate(hints):
+      by_worker[self._create_target(hint)].append(i)
+
+    futures = []
+    for worker_id, idx in by_worker.iteritems():
+      req = core.MultiCreateReq(descriptors=[descriptors[i] for i in idx])
+      futures.append((idx, self._send_to_worker(worker_id, 'create_many', req,
+                                                wait=False, timeout=timeout)))
+
+    tile_ids = [None] * len(descriptors)
+    for idx, f in futures:
+      for i, tile_id in zip(idx, f.wait().tile_ids):
+        tile_ids[i] = tile_id
+    return tile_ids
+
+  def map(self, tile_ids, mapper_fn, kw, timeout=None, worker_ids=None):
     '''
     Run ``mapper_fn`` on all tiles in ``tile_ids``.
     
@@ -262,16 +565,51 @@ class BlobCtx(object):
       mapper_fn (function): Function taking (extent, kw)
       kw (dict): Keywords to supply to ``mapper_fn``.
       timeout: optional RPC timeout.
+      worker_ids (list): Workers to send the kernel to; all available
+        workers by default.  Must include the workers holding ``tile_ids``.
       
     Returns:
       dict: mapping from (source_tile, result of ``mapper_fn``)
     '''
-    req = core.RunKernelReq(blobs=tile_ids, mapper_fn=mapper_fn, kw=kw)
-    futures = self._send_all('run_kernel', req, targets=None, timeout=timeout)
+    if worker_ids is None:
+      targets = None
+    else:
+      targets = [self.workers[id] for id in worker_ids]
+
+    # Several kernels may be started at once (see `DagScheduler`); the
+    # encoder expects workers to receive kernels in the order it encoded them.
+    with self._kernel_lock:
+      if self.kernel_encoder is None:
+        req = core.RunKernelReq(blobs=tile_ids, mapper_fn=mapper_fn, kw=kw)
+        futures = self._send_all('run_kernel', req, targets=targets,
+                                 wait=False, timeout=timeout)
+      else:
+        if worker_ids is None:
+          worker_ids = self.local_worker.get_available_workers()
+        skeleton, uploads, objects = self.kernel_encoder.encode(mapper_fn, kw, worker_ids)
+        req = core.RunKernelReq(blobs=tile_ids, skeleton=skeleton, uploads=uploads)
+        futures = self._send_all('run_kernel', req,
+                                 targets=[self.workers[id] for id in worker_ids],
+                                 wait=False, timeout=timeout)
+
     result = {}
-    for f in futures:
-      for source_tile, map_result in f.iteritems():
+    updated = set()
+    for f in futures.wait():
+      if isinstance(f, core.KernelCacheMissResp):
+        # The worker evicted objects we expected it to have; resend all of them,
+        # before any other kernel is encoded for the worker.
+        with self._kernel_lock:
+          req.uploads = self.kernel_encoder.reupload(f.worker_id, objects)
+          future = self._send_to_worker(f.worker_id, 'run_kernel', req,
+                                        wait=False, timeout=timeout)
+        f = future.wait()
+
+      for source_tile, map_result in f.result.iteritems():
         result[source_tile] = map_result
+      updated.update(f.updated)
+
+    if updated:
+      self.local_worker.mark_updated(updated)
     return result
 
   def tile_op(self, tile_id, fn):
@@ -295,8 +295,9 @@ cdef class CloudPickler:
     cdef int proto, fast, _BATCHSIZE
     cdef list numpy_tst_mods
     cdef object write
+    cdef object persistent_id
 
-    def __init__(self, file, protocol=0, min_size_to_save=0):
+    def __init__(self, file, protocol=0, min_size_to_save=0, persistent_id=None):
         self.proto = <int>protocol
         if self.proto < 0:
             self.proto = HIGHEST_PROTOCOL
@@ -316,6 +317,7 @@ cdef class CloudPickler:
         self._BATCHSIZE = 1000
 
         self.numpy_tst_mods = ['numpy', 'scipy.special']
+        self.persistent_id = persistent_id
 
     cdef void clear_memo(self):
         self.memo.clear()
@@ -365,6 +367,13 @@ cdef class CloudPickler:
         return GET + repr(i) + '\n'
 
     def save(self, obj):
+        # Check for a persistent id (defined by the caller)
+        if self.persistent_id is not None:
+            pid = self.persistent_id(obj)
+            if pid is not None:
+                self.save_pers(pid)
+                return
+
         # Check the memo
         x = self.memo.get(id(obj))
         if x:
@@ -1352,8 +1361,8 @@ cpdef encode_long(long x):
 
 # Shorthands for legacy support
 
-cpdef dump(obj, file, int protocol=2):
-    CloudPickler(file, protocol).dump(obj)
+cpdef dump(obj, file, int protocol=2, persistent_id=None):
+    CloudPickler(file, protocol, persistent_id=persistent_id).dump(obj)
 
 cpdef dumps(obj, int protocol=2):
     file = Writer()
@@ -9,6 +9,7 @@ workers (`RegisterReq`, `InitializeReq`).
 '''
 
 from traits.api import Function, Instance, Dict, Int, HasTraits, Tuple, PythonValue, List, Float, Str, Trait
+import mmap
 import numpy as np
 from spartan.array.tile import Tile
 from node import Node
@@ -48,9 +49,11 @@ cdef class WorkerStatus(object):
   cdef public float mem_usage, cpu_usage
   cdef public double last_report_time
   cdef public list kernel_remain_tiles, task_failures
+  cdef public long spill_count, spill_bytes, reload_count, reload_bytes
   
   def __init__(self, phy_memory, num_processors, mem_usage, cpu_usage, last_report_time, 
-  			   kernel_remain_tiles, task_failures):
+  			   kernel_remain_tiles, task_failures,
+  			   spill_count=0, spill_bytes=0, reload_count=0, reload_bytes=0):
     self.total_physical_memory = phy_memory
     self.num_processors = num_processors
     self.mem_usage = mem_usage
@@ -58,17 +61,29 @@ cdef class WorkerStatus(object):
     self.last_report_time = last_report_time
     self.kernel_remain_tiles = kernel_remain_tiles
     self.task_failures = task_failures
+    self.spill_count = spill_count
+    self.spill_bytes = spill_bytes
+    self.reload_count = reload_count
+    self.reload_bytes = reload_bytes
 
   def __reduce__(self):
     return (WorkerStatus, (self.total_physical_memory, self.num_processors, 
                            self.mem_usage, self.cpu_usage, self.last_report_time, 
-                           self.kernel_remain_tiles, self.task_failures))
+                           self.kernel_remain_tiles, self.task_failures,
+                           self.spill_count, self.spill_bytes,
+                           self.reload_count, self.reload_bytes))
       
   def update_status(self, mem_usage, cpu_usage, report_time, kernel_remain_tiles):
     self.mem_usage = mem_usage
     self.cpu_usage = cpu_usage
     self.last_report_time = report_time
     self.kernel_remain_tiles = kernel_remain_tiles
+
+  def update_spill_status(self, spill_count, spill_bytes, reload_count, reload_bytes):
+    self.spill_count = spill_count
+    self.spill_bytes = spill_bytes
+    self.reload_count = reload_count
+    self.reload_bytes = reload_bytes
   
   def add_task_failure(self, task_req):
     self.task_failures.append(task_req)
@@ -78,10 +93,12 @@ cdef class WorkerStatus(object):
     self.task_failures = []
     
   def __repr__(WorkerStatus self):
-    return 'WorkerStatus:total_phy_mem:%s num_processors:%s mem_usage:%s cpu_usage:%s remain_tiles:%s task_failures:%s' % (
+    return 'WorkerStatus:total_phy_mem:%s num_processors:%s mem_usage:%s cpu_usage:%s remain_tiles:%s task_failures:%s spilled:%s/%s reloaded:%s/%s' % (
                   str(self.total_physical_memory), str(self.num_processors), 
                   str(self.mem_usage), str(self.cpu_usage), 
-                  str(self.kernel_remain_tiles), str(self.task_failures))
+                  str(self.kernel_remain_tiles), str(self.task_failures),
+                  str(self.spill_count), str(self.spill_bytes),
+                  str(self.reload_count), str(self.reload_bytes))
     
 class Message(Node):
   '''Base class for all RPC messages.'''
@@ -136,6 +153,61 @@ class GetResp(Message):
   id = Instance(TileId) 
   data = PythonValue
 
+class MultiGetReq(Message):
+  '''
+  Fetch regions from several tiles held by the same worker.
+  '''
+  #_members = ['ids', 'subslices']
+  ids = List
+  subslices = List
+
+class MultiGetResp(Message):
+  '''
+  The result of a `MultiGetReq`: the data fetched from each tile, in request order.
+  '''
+  #_members = ['data']
+  data = List
+
+def map_shared_tile(path, shape, dtype):
+  '''
+  Map tile data exported to shared memory by another worker.
+
+  The mapping is copy-on-write: the result can be passed to code expecting
+  a writable buffer, but writes are never seen by the owner of the tile.
+
+  :param path: File holding the tile data.
+  :rtype: An array of ``shape`` and ``dtype`` backed by ``path``.
+  '''
+  with open(path, 'rb') as f:
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+  return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+class SharedTileResp(Message):
+  '''
+  The result of a fetch served through shared memory.
+
+  Instead of the tile data, this carries the location of a shared memory
+  file holding it.  The file is mapped once, when the response is decoded;
+  ``data`` returns the fetched region of the mapping without copying it.
+  '''
+  #_members = ['path', 'shape', 'dtype', 'subslice']
+  path = Str
+  shape = PythonValue
+  dtype = PythonValue
+  subslice = PythonValue
+
+  def __setstate__(self, state):
+    Message.__setstate__(self, state)
+    # The owner removes the file some time after the tile changes, so map
+    # it as soon as the reply arrives rather than when ``data`` is read.
+    self._data = map_shared_tile(self.path, self.shape, self.dtype)[self.subslice]
+
+  @property
+  def data(self):
+    if getattr(self, '_data', None) is None:
+      self._data = map_shared_tile(self.path, self.shape, self.dtype)[self.subslice]
+    return self._data
+
 class DestroyReq(Message):
   '''
   Destroy any tiles listed in ``ids``.
@@ -156,6 +228,13 @@ class UpdateReq(Message):
   data = PythonValue(None) 
   reducer = PythonValue(None) 
 
+class MultiUpdateReq(Message):
+  '''
+  Apply several `UpdateReq` to tiles held by the same worker.
+  '''
+  #_members = ['updates']
+  updates = List
+
 class LocalKernelResult(Message):
   '''The local result returned from a kernel invocation.
   
@@ -174,19 +253,31 @@ class RunKernelReq(Message):
   
   For efficiency (since Python serialization is slow), the same message
   is sent to all workers. 
+
+  If ``skeleton`` is set, ``mapper_fn`` and ``kw`` are instead encoded by a
+  `KernelEncoder`, with the cached objects workers may be missing in ``uploads``.
   '''
-  #_members = ['blobs', 'mapper_fn', 'kw']
+  #_members = ['blobs', 'mapper_fn', 'kw', 'skeleton', 'uploads']
   blobs = List
   mapper_fn = Function(None)
   kw = Dict
+  skeleton = PythonValue(None)
+  uploads = Dict
+
+class KernelCacheMissResp(Message):
+  '''Sent in place of kernel results by a worker missing cached kernel objects.'''
+  #_members = ['worker_id']
+  worker_id = Int
 
 class RunKernelResp(Message):
   '''The result returned from running a kernel function.
   
-  This is typically a map from `Extent` to TileId.
+  This is typically a map from `Extent` to TileId.  Kernels run over
+  tiles also report the identities of the arrays they updated in ``updated``.
   '''
-  #_members = ['result']
+  #_members = ['result', 'updated']
   result = PythonValue
+  updated = PythonValue(None)
 
 class CreateTileReq(Message):
   #_members = ['tile_id', 'data']
@@ -197,6 +288,23 @@ class TileIdMessage(Message):
   #_members = ['tile_id']
   tile_id = Instance(TileId)
 
+class MultiCreateReq(Message):
+  '''
+  Create several empty tiles on the same worker.
+
+  Each descriptor is a tuple of (shape, dtype, tile_type, fill_value); tiles
+  with a fill value are created as constant tiles.
+  '''
+  #_members = ['descriptors']
+  descriptors = List
+
+class MultiCreateResp(Message):
+  '''
+  The ids of the tiles created by a `MultiCreateReq`, in request order.
+  '''
+  #_members = ['tile_ids']
+  tile_ids = List
+
 class HeartbeatReq(Message):
   #_members = ['worker_id', 'worker_status']
   worker_id = Int
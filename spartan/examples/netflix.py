@@ -12,7 +12,7 @@ import random
 import scipy.sparse
 import sys
 import zipfile
-from traits.api import PythonValue
+from spartan.node import PythonValue
 import numpy as np
 from spartan import util, expr, node
 from spartan.expr import lazify
@@ -88,7 +88,7 @@ def sgd_netflix_mapper(inputs, ex, V=None, M=None, U=None, worklist=None):
   if ex not in worklist:
     return
 
-  v = V.fetch(ex)
+  v = V.fetch(ex).tocoo()
   u = U.select(ex[0].to_slice())  # size: (ex.shape[0] * r)
   m = M.select(ex[1].to_slice())  # size: (ex.shape[1] * r)
 
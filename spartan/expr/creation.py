@@ -64,10 +64,6 @@ def identity(n, dtype=np.float32, tile_hint=None):
   return eye(n, dtype=dtype, tile_hint=tile_hint)
 
 
-def _make_zeros(input):
-  return np.zeros(input.shape, input.dtype)
-
-
 def zeros(shape, dtype=np.float32, tile_hint=None):
   '''
   Create a distributed array over the given shape and dtype, filled with zeros.
@@ -77,8 +73,7 @@ def zeros(shape, dtype=np.float32, tile_hint=None):
   :param tile_hint:
   :rtype: `Expr`
   '''
-  return map(ndarray(shape, dtype=dtype, tile_hint=tile_hint),
-             fn=_make_zeros)
+  return ndarray(shape, dtype=dtype, tile_hint=tile_hint, fill_value=0)
 
 
 def zeros_like(array, dtype=None, tile_hint=None):
@@ -89,10 +84,6 @@ def zeros_like(array, dtype=None, tile_hint=None):
   return zeros(array.shape, dtype=dtype, tile_hint=tile_hint)
 
 
-def _make_ones(input):
-  return np.ones(input.shape, input.dtype)
-
-
 def ones(shape, dtype=np.float32, tile_hint=None):
   '''
   Create a distributed array over the given shape and dtype, filled with ones.
@@ -102,8 +93,7 @@ def ones(shape, dtype=np.float32, tile_hint=None):
   :param tile_hint:
   :rtype: `Expr`
   '''
-  return map(ndarray(shape, dtype=dtype, tile_hint=tile_hint),
-             fn=_make_ones)
+  return ndarray(shape, dtype=dtype, tile_hint=tile_hint, fill_value=1)
 
 
 def ones_like(array, dtype=None, tile_hint=None):
@@ -114,13 +104,17 @@ def ones_like(array, dtype=None, tile_hint=None):
   return ones(array.shape, dtype=dtype, tile_hint=tile_hint)
 
 
-def _full_mapper(tile, fill_value, dtype=None):
-  return np.full(tile.shape, fill_value, dtype=dtype)
-
-
 def full(shape, fill_value, dtype=np.float32, tile_hint=None):
-  return map(ndarray(shape, dtype=dtype, tile_hint=tile_hint),
-             fn=_full_mapper)
+  '''
+  Create a distributed array over the given shape and dtype, filled with ``fill_value``.
+
+  :param shape:
+  :param fill_value:
+  :param dtype:
+  :param tile_hint:
+  :rtype: `Expr`
+  '''
+  return ndarray(shape, dtype=dtype, tile_hint=tile_hint, fill_value=fill_value)
 
 
 def full_like(array, fill_value, dtype=None, tile_hint=None):
@@ -4,7 +4,7 @@ Dot expr.
 
 import numpy as np
 import scipy.sparse as sp
-from traits.api import PythonValue, HasTraits
+from ..node import PythonValue
 from .operator import outer, map
 from .operator.base import Expr, lazify
 from .operator.shuffle import target_mapper, notarget_mapper
@@ -4,21 +4,50 @@ well as common subclasses for collections.
 '''
 
 import collections
+import functools
+import Queue
 import sys
+import threading
 import traceback
+import types
 import weakref
 import numpy as np
+from multiprocessing.pool import ThreadPool
 
-from traits.api import Any, Instance, Int, PythonValue
 
 from ... import blob_ctx, util
-from ...node import Node, indent
+from ...node import SlotNode, indent, Any, Instance, Int, PythonValue
 from ...util import Assert, copy_docstring
-from ...array import distarray
-from ...config import FLAGS, BoolFlag
+from ...array import distarray, extent
+from ...config import FLAGS, BoolFlag, IntFlag
 from ...rpc import TimeoutException
+from .local import LocalExpr
 
 FLAGS.add(BoolFlag('opt_expression_cache', True, 'Enable expression caching.'))
+FLAGS.add(BoolFlag('opt_structural_cache', False,
+                   'Reuse results across rebuilt expressions with the same structure and inputs.'))
+FLAGS.add(IntFlag('structural_cache_entries', 64,
+                  'Maximum number of results kept by the structural cache.'))
+FLAGS.add(IntFlag('structural_cache_memory', 1024,
+                  'Maximum size (MB) of the results kept by the structural cache.'))
+FLAGS.add(BoolFlag('dataflow', False,
+                   'Run the kernel for each tile once the tiles it reads are computed, '
+                   'rather than after the whole of each input.'))
+FLAGS.add(IntFlag('dataflow_batch_tiles', 4,
+                  'Maximum number of tiles sent to a worker in one kernel with --dataflow.'))
+
+# Values which are compared by value in a structural key; anything else
+# (functions, arrays, DistArrays) is only equal to itself.
+_value_types = (int, long, float, complex, bool, basestring, type(None),
+                np.generic, np.dtype)
+
+# Globals which functions may read without making their result uncacheable.
+_immutable_globals = (types.ModuleType, types.BuiltinFunctionType, type,
+                      types.ClassType, np.ufunc)
+
+# Expressions which allocate or write an array; two copies are not
+# interchangeable even if they look the same.
+_unshared_exprs = set(['NdArrayExpr', 'WriteArrayExpr', 'CheckpointExpr'])
 
 
 class newaxis(object):
@@ -33,6 +62,13 @@ class NotShapeable(Exception):
   first evaluating the expression.
   '''
 
+
+class Uncacheable(Exception):
+  '''
+  Thrown when the result of an expression may not be shared with
+  a rebuilt copy of it.
+  '''
+
 unique_id = iter(xrange(10000000))
 
 
@@ -82,10 +118,31 @@ class EvalCache(object):
   no longer directly linked to an expressions lifetime, we have to
   manually track reference counts here, and clear items from the
   cache when the reference count hits zero.
+
+  With ``--opt_structural_cache``, results are also kept by the
+  `structural_key` of their expression, so an expression rebuilt from
+  scratch (e.g. every iteration of a loop) finds the result of the
+  previous copy.  Keys include the version of every array read, so
+  updating an array invalidates the results computed from it.  These
+  results are evicted least recently used first once there are more than
+  ``--structural_cache_entries`` of them, or they hold more than
+  ``--structural_cache_memory`` MB of arrays.
   '''
   def __init__(self):
     self.refs = collections.defaultdict(int)
     self.cache = {}
+    # expressions may be created and evaluated by several threads
+    # (see `DagScheduler`).
+    self._lock = threading.RLock()
+
+    # structural key -> (value, value version, nbytes, versions), least
+    # recently used first.
+    self.results = collections.OrderedDict()
+    self.result_bytes = 0
+    # array id -> (version, keys of the results computed from it).
+    self.readers = {}
+    self.hits = 0
+    self.misses = 0
 
   def set(self, exprid, value):
     #assert not exprid in self.cache, 'Trying to replace an existing cache entry!'
@@ -95,22 +152,249 @@ class EvalCache(object):
     return self.cache.get(exprid, None)
 
   def register(self, exprid):
-    self.refs[exprid] += 1
+    with self._lock:
+      self.refs[exprid] += 1
 
   def deregister(self, expr_id):
-    self.refs[expr_id] -= 1
-    if self.refs[expr_id] == 0:
-      #util.log_debug('Destroying... %s', expr_id)
-      if expr_id in self.cache:
-        #import objgraph
-        #objgraph.show_backrefs([self.cache[expr_id]], filename='%s-refs.png' % expr_id)
-        del self.cache[expr_id]
+    with self._lock:
+      self.refs[expr_id] -= 1
+      if self.refs[expr_id] == 0:
+        #util.log_debug('Destroying... %s', expr_id)
+        if expr_id in self.cache:
+          #import objgraph
+          #objgraph.show_backrefs([self.cache[expr_id]], filename='%s-refs.png' % expr_id)
+          del self.cache[expr_id]
+
+        del self.refs[expr_id]
+
+  def get_result(self, key, versions):
+    '''
+    Return the result stored for the structural ``key``, or None.
+
+    :param versions: dict mapping the id of every array read by the
+      expression to its current version (see `structural_key`).
+    '''
+    with self._lock:
+      self._invalidate(versions)
+      entry = self.results.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      value = entry[0]
+      if getattr(value, 'version', None) != entry[1]:
+        # the result itself was written to since.
+        self.results[key] = entry
+        self._drop(key)
+        self.misses += 1
+        return None
+
+      self.results[key] = entry
+      self.hits += 1
+      return value
+
+  def set_result(self, key, versions, value):
+    '''Store ``value`` as the result of the structural ``key``.'''
+    max_bytes = FLAGS.structural_cache_memory * 1024 * 1024
+    nbytes = _result_nbytes(value)
+    if nbytes > max_bytes:
+      return
 
-      del self.refs[expr_id]
+    with self._lock:
+      self._invalidate(versions)
+      if key in self.results:
+        self._drop(key)
+
+      self.results[key] = (value, getattr(value, 'version', None), nbytes, versions)
+      self.result_bytes += nbytes
+      for array_id, version in versions.iteritems():
+        self.readers.setdefault(array_id, (version, set()))[1].add(key)
+
+      while len(self.results) > FLAGS.structural_cache_entries or self.result_bytes > max_bytes:
+        self._drop(next(iter(self.results)))
+
+  def _invalidate(self, versions):
+    '''Drop the results computed from older versions of the arrays in ``versions``.'''
+    for array_id, version in versions.iteritems():
+      if array_id in self.readers and self.readers[array_id][0] != version:
+        util.log_debug('Array %s updated, dropping %d results',
+                       array_id, len(self.readers[array_id][1]))
+        for key in list(self.readers[array_id][1]):
+          self._drop(key)
+
+  def _drop(self, key):
+    _, _, nbytes, versions = self.results.pop(key)
+    self.result_bytes -= nbytes
+    for array_id in versions:
+      keys = self.readers[array_id][1]
+      keys.discard(key)
+      if not keys:
+        del self.readers[array_id]
 
   def clear(self):
-    self.refs.clear()
-    self.cache.clear()
+    with self._lock:
+      self.refs.clear()
+      self.cache.clear()
+      self.results.clear()
+      self.readers.clear()
+      self.result_bytes = 0
+
+
+def _result_nbytes(value):
+  if isinstance(value, distarray.DistArrayImpl):
+    return int(np.prod(value.shape)) * np.dtype(value.dtype).itemsize
+  return getattr(value, 'nbytes', 0)
+
+
+class _Ident(object):
+  '''
+  Key for an object which is only equal to itself.
+
+  Holding the object keeps it alive, so its id can not be reused by
+  another object while the key exists.
+  '''
+  __slots__ = ['obj']
+
+  def __init__(self, obj):
+    self.obj = obj
+
+  def __hash__(self):
+    return id(self.obj)
+
+  def __eq__(self, other):
+    return isinstance(other, _Ident) and other.obj is self.obj
+
+
+def structural_key(expr):
+  '''
+  Compute a key identifying the result of ``expr``.
+
+  Two expressions have the same key if they have the same structure
+  and read the same versions of the same arrays, even if they were
+  built separately.
+
+  Raises `Uncacheable` if ``expr`` allocates or writes arrays, or
+  reads values which can't be compared (e.g. numpy arrays).
+
+  Returns:
+    tuple: (key, versions), where ``versions`` maps the id of each
+    array read by ``expr`` to its version.
+  '''
+  versions = {}
+  memo = {}
+  def expr_key(e):
+    if e.expr_id not in memo:
+      memo[e.expr_id] = node_key(e, expr_key, versions)
+    return memo[e.expr_id]
+  return expr_key(expr), versions
+
+
+def node_key(expr, child_key, versions):
+  '''
+  Compute a key for ``expr`` from its type and members.
+
+  This is shared by `structural_key` and common subexpression elimination,
+  so both consider the same expressions equal.
+
+  Args:
+    child_key: Function returning the key of a child expression.
+    versions (dict): Updated with the version of each array read by ``expr``.
+
+  Raises `Uncacheable` if ``expr`` allocates or writes arrays, is not
+  idempotent, or reads values which can't be compared.
+  '''
+  from .optimize import _not_idempotent_list
+  if expr.typename() in _unshared_exprs or id(expr) in _not_idempotent_list or \
+     getattr(expr, 'target', None) is not None:
+    raise Uncacheable
+
+  # map inputs are named freshly for every copy; use their position instead.
+  varnames = dict([(v, i) for i, v in enumerate(getattr(expr, 'child_to_var', None) or [])])
+  return (expr.__class__,) + tuple([_value_key(getattr(expr, k), varnames, versions, child_key)
+                                    for k in expr.members if k not in ('expr_id', 'stack_trace')])
+
+
+def _value_key(v, varnames, versions, child_key):
+  if isinstance(v, Expr):
+    return child_key(v)
+  if isinstance(v, distarray.DistArrayImpl):
+    array_id, version = v.cache_key()
+    versions[array_id] = version
+    return ('array', array_id, version)
+  if isinstance(v, (distarray.DistArray, np.ndarray)):
+    # contents may change without a version to tell
+    raise Uncacheable
+  if isinstance(v, LocalExpr):
+    return (v.__class__,) + tuple([_value_key(getattr(v, k), varnames, versions, child_key)
+                                   for k in v.members])
+  if isinstance(v, basestring) and v in varnames:
+    return ('var', varnames[v])
+  if isinstance(v, (list, tuple)):
+    return (type(v),) + tuple([_value_key(x, varnames, versions, child_key) for x in v])
+  if isinstance(v, dict):
+    return (dict,) + tuple(sorted([(k, _value_key(x, varnames, versions, child_key))
+                                   for k, x in v.iteritems()]))
+  if isinstance(v, slice):
+    return (slice,) + tuple([_value_key(x, varnames, versions, child_key)
+                             for x in (v.start, v.stop, v.step)])
+  if isinstance(v, extent.TileExtent):
+    return (extent.TileExtent, v.ul, v.lr, v.array_shape)
+  if isinstance(v, _value_types):
+    # 1, 1.0 and True hash alike but give different result types.
+    return (type(v), v)
+  if isinstance(v, types.FunctionType):
+    # lambdas are created anew with every expression; copies made from the
+    # same code are equal if they captured equal values.
+    try:
+      cells = tuple([c.cell_contents for c in v.__closure__ or ()])
+    except ValueError:
+      raise Uncacheable
+    return (types.FunctionType, _Ident(v.__code__),
+            _value_key(cells, varnames, versions, child_key),
+            _value_key(v.__defaults__, varnames, versions, child_key),
+            _globals_key(v, set()))
+  return _Ident(v)
+
+
+def _global_names(code):
+  '''Return the names ``code`` (and the functions defined in it) may read as globals.'''
+  names = set(code.co_names)
+  for const in code.co_consts:
+    if isinstance(const, types.CodeType):
+      names.update(_global_names(const))
+  return names
+
+
+def _globals_key(fn, seen):
+  '''
+  Key the values of the globals read by ``fn``, and by the global functions it calls.
+
+  Spartan's own kernels are trusted to only read constants.  Raises
+  `Uncacheable` if ``fn`` reads a global which can be changed in place.
+  '''
+  seen.add(fn)
+  if fn.__module__ is not None and fn.__module__.startswith('spartan.'):
+    return ()
+
+  key = []
+  for name in sorted(_global_names(fn.__code__)):
+    # names may also be attributes, or builtins.
+    if name not in fn.__globals__:
+      continue
+    value = fn.__globals__[name]
+    if isinstance(value, types.FunctionType):
+      if value in seen:
+        key.append((name, _Ident(value)))
+      else:
+        key.append((name, _Ident(value), _globals_key(value, seen)))
+    elif isinstance(value, _value_types):
+      # globals may be rebound, so their value is part of the key.
+      key.append((name, type(value), value))
+    elif isinstance(value, _immutable_globals):
+      key.append((name, _Ident(value)))
+    else:
+      raise Uncacheable
+  return tuple(key)
 
 
 class ExprTrace(object):
@@ -159,7 +443,7 @@ class ExprTrace(object):
 eval_cache = EvalCache()
 
 
-class Expr(Node):
+class Expr(SlotNode):
   '''
   Base class for all expressions.
 
@@ -275,15 +559,24 @@ class Expr(Node):
     The result of the evaluation is stored in the expression cache,
     future calls to evaluate will return the cached value.
 
+    With ``--concurrent_kernels`` > 1, dependencies which don't depend
+    on each other are evaluated at the same time (see `DagScheduler`).
+    With ``--dataflow``, tiles are computed as soon as the tiles they
+    read are (see `DataflowScheduler`).
+
     Returns:
       DistArray:
     '''
-
-    cache = self.cache()
+    cache, key, versions = self._lookup()
     if cache is not None:
-      util.log_debug('Retrieving %d from cache' % self.expr_id)
       return cache
 
+    if not FLAGS.load_balance and not getattr(_scheduler_thread, 'active', False):
+      if FLAGS.dataflow:
+        return DataflowScheduler(self, key, versions).run()
+      if FLAGS.concurrent_kernels > 1:
+        return DagScheduler(self, key, versions).run()
+
     ctx = blob_ctx.get()
     #util.log_info('Evaluting deps for %s', prim)
     deps = {}
@@ -293,6 +586,37 @@ class Expr(Node):
       else:
         #assert not isinstance(vs, (dict, list)), vs
         deps[k] = vs
+    return self._run(ctx, deps, key, versions)
+
+  def _lookup(self):
+    '''
+    Look for the result of this expression in the caches.
+
+    Returns:
+      tuple: (cached value or None, structural key or None, versions)
+    '''
+    cache = self.cache()
+    if cache is not None:
+      util.log_debug('Retrieving %d from cache' % self.expr_id)
+      return cache, None, None
+
+    if self.needs_cache and FLAGS.opt_structural_cache:
+      try:
+        key, versions = structural_key(self)
+      except Uncacheable:
+        return None, None, None
+
+      cache = eval_cache.get_result(key, versions)
+      if cache is not None and len(getattr(cache, 'bad_tiles', [])) == 0:
+        util.log_debug('Retrieving %d from structural cache', self.expr_id)
+        eval_cache.set(self.expr_id, cache)
+        return cache, None, None
+      return None, key, versions
+
+    return None, None, None
+
+  def _run(self, ctx, deps, key, versions):
+    '''Evaluate this expression from the values of its dependencies, and cache the result.'''
     try:
       value = self._evaluate(ctx, deps)
       #value = self.optimized()._evaluate(ctx, deps)
@@ -304,11 +628,16 @@ class Expr(Node):
       self.stack_trace.dump()
       raise
 
+    self._cache_value(value, key, versions)
+    return value
+
+  def _cache_value(self, value, key, versions):
+    '''Store the value of this expression in the caches.'''
     if self.needs_cache:
       #util.log_info('Caching %s -> %s', prim.expr_id, value)
       eval_cache.set(self.expr_id, value)
-
-    return value
+      if key is not None:
+        eval_cache.set_result(key, versions, value)
 
   def _evaluate(self, ctx, deps):
     '''
@@ -497,6 +826,28 @@ class Expr(Node):
     '''
     return glom(self)
 
+  def iter_tiles(self, window=None):
+    '''
+    Evaluate this expression and iterate over the tiles of the result.
+
+    See `DistArrayImpl.iter_tiles`.
+
+    :rtype: generator of (`TileExtent`, data) pairs
+
+    '''
+    return evaluate(self).iter_tiles(window)
+
+  def iter_blocks(self, axis=0, block_rows=None, window=None):
+    '''
+    Evaluate this expression and iterate over blocks of the result along ``axis``.
+
+    See `DistArrayImpl.iter_blocks`.
+
+    :rtype: generator of (`TileExtent`, data) pairs
+
+    '''
+    return evaluate(self).iter_blocks(axis, block_rows, window)
+
   def __reduce__(self):
     return evaluate(self).__reduce__()
 
@@ -645,6 +996,458 @@ class TupleExpr(CollectionExpr):
     return len(self.vals)
 
 
+class TileKernel(object):
+  '''
+  A kernel run over the tiles of an array.
+
+  Expressions which evaluate to a single kernel describe it with
+  ``_tile_kernel(ctx, deps)``, so a `DataflowScheduler` can run the
+  kernel for each tile on its own.
+
+  Attributes:
+    array (DistArray): Array whose tiles are mapped over.
+    mapper_fn (function): Called as ``mapper_fn(extent, **kw)`` for each
+      tile.  Its ``inputs`` attribute, if set, is called the same way and
+      returns the (array, region) pairs read for the tile.
+    kw (dict): Keywords for ``mapper_fn``.
+    output (DistArray): Array the kernel updates, or None if ``mapper_fn``
+      returns the tiles of a new array.
+  '''
+  def __init__(self, array, mapper_fn, kw, output=None):
+    self.array = array
+    self.mapper_fn = mapper_fn
+    self.kw = kw
+    self.output = output
+
+  def run(self):
+    '''Run the kernel over all tiles, and return the resulting array.'''
+    if self.output is None:
+      return self.array.map_to_array(self.mapper_fn, kw=self.kw)
+    self.array.foreach_tile(mapper_fn=self.mapper_fn, kw=self.kw)
+    return self.output
+
+
+# Set in threads evaluating a node for a `DagScheduler`; expressions
+# evaluated from there (e.g. retries) don't start another scheduler.
+_scheduler_thread = threading.local()
+_scheduler_pool = None
+_dataflow_pool = None
+
+
+def _get_scheduler_pool():
+  global _scheduler_pool
+  if _scheduler_pool is None:
+    _scheduler_pool = ThreadPool(processes=FLAGS.concurrent_kernels)
+  return _scheduler_pool
+
+
+class DagScheduler(object):
+  '''
+  Evaluates an expression DAG, running nodes which don't depend on
+  each other at the same time.
+
+  ``map2((A.dot(x), B.dot(y)))`` runs both dot products together, so
+  the workers are busy with one while the other's small kernels finish.
+
+  Nodes are evaluated by a pool of threads on the master, each waiting
+  for its own kernels; at most ``--concurrent_kernels`` nodes run at once,
+  which bounds the number of intermediate arrays being built.  Workers
+  run that many kernels at once as well.
+  '''
+  def __init__(self, root, key=None, versions=None):
+    self.ctx = blob_ctx.get()
+    self.root = root
+    # expr_id -> (expr, structural key, versions) of nodes to evaluate.
+    self.nodes = {}
+    # expr_id -> value of evaluated nodes.
+    self.values = {}
+    # expr_id -> number of children which haven't been evaluated.
+    self.waiting = {}
+    self.parents = collections.defaultdict(list)
+    self.ready = []
+    self._add(root, (None, key, versions))
+
+  def _add(self, expr, lookup):
+    value, key, versions = lookup
+    if value is not None:
+      self.values[expr.expr_id] = value
+      return
+
+    self.nodes[expr.expr_id] = (expr, key, versions)
+    children = set()
+    for v in expr.dependencies().itervalues():
+      if not isinstance(v, Expr):
+        continue
+      if v.expr_id not in self.nodes and v.expr_id not in self.values:
+        self._add(v, v._lookup())
+      if v.expr_id not in self.values:
+        children.add(v.expr_id)
+
+    for child_id in children:
+      self.parents[child_id].append(expr.expr_id)
+    self.waiting[expr.expr_id] = len(children)
+    if not children:
+      self.ready.append(expr.expr_id)
+
+  def _run_node(self, expr_id, done):
+    blob_ctx.set(self.ctx)
+    _scheduler_thread.active = True
+    expr, key, versions = self.nodes[expr_id]
+    try:
+      deps = {}
+      for k, v in expr.dependencies().iteritems():
+        deps[k] = self.values[v.expr_id] if isinstance(v, Expr) else v
+      done.put((expr_id, expr._run(self.ctx, deps, key, versions), None))
+    except Exception:
+      done.put((expr_id, None, sys.exc_info()))
+
+  def run(self):
+    '''Evaluate the DAG, and return the value of the root.'''
+    util.log_debug('Scheduling %d expressions', len(self.nodes))
+    pool = _get_scheduler_pool()
+    done = Queue.Queue()
+    running = 0
+    error = None
+    while self.root.expr_id not in self.values:
+      while self.ready and running < FLAGS.concurrent_kernels and error is None:
+        pool.apply_async(self._run_node, args=(self.ready.pop(), done))
+        running += 1
+
+      if running == 0:
+        break
+
+      expr_id, value, exc_info = done.get()
+      running -= 1
+      if exc_info is not None:
+        # let running nodes finish before raising the first error.
+        error = error or exc_info
+        continue
+
+      self.values[expr_id] = value
+      for parent_id in self.parents[expr_id]:
+        self.waiting[parent_id] -= 1
+        if self.waiting[parent_id] == 0:
+          self.ready.append(parent_id)
+
+    if error is not None:
+      raise error[0], error[1], error[2]
+    return self.values[self.root.expr_id]
+
+
+def _get_dataflow_pool(ctx):
+  global _dataflow_pool
+  if _dataflow_pool is None:
+    # enough threads to wait on every worker's kernels, with some to spare
+    # for the expressions run whole.
+    n_kernels = max(FLAGS.concurrent_kernels, 1)
+    _dataflow_pool = ThreadPool(processes=n_kernels * (ctx.num_workers + 1))
+  return _dataflow_pool
+
+
+class _Stage(object):
+  '''The tiles of a `TileKernel` being run by a `DataflowScheduler`.'''
+  def __init__(self, expr_id, kernel, extents, order):
+    self.expr_id = expr_id
+    self.kernel = kernel
+    self.extents = extents
+    # Position in which stages were started; later stages are sent first.
+    self.order = order
+    # extent -> number of input tiles which haven't been computed.
+    self.waiting = {}
+    # worker_id -> [(extent, tile_id)] of tiles ready to be run.
+    self.ready = collections.defaultdict(list)
+    # number of tiles which haven't been run.
+    self.remaining = len(extents)
+    # extent -> tile_id of the computed tiles of a new array.
+    self.tiles = {}
+    self._index = None
+
+  def find_overlapping(self, region):
+    '''Return the extents of this stage overlapping ``region``.'''
+    if self._index is None:
+      self._index = extent.ExtentIndex(self.extents)
+    return [ex for ex, _ in self._index.find_overlapping(region)]
+
+
+class DataflowScheduler(DagScheduler):
+  '''
+  Evaluates an expression DAG tile by tile.
+
+  Expressions evaluating to a `TileKernel` (maps, map2 and reductions)
+  are started once each of their inputs has some tiles computed, and the
+  kernel for one of their tiles is sent once the input tiles it reads are
+  computed.  In ``sum(a * 2 + b)`` each tile of ``a * 2`` is added to
+  ``b`` and reduced as soon as it is ready, so a slow tile only holds
+  back the tiles which read it.
+
+  Only kernels returning new tiles (maps) pass tiles on this way; arrays
+  updated by a kernel (map2, reductions) are complete once all of its
+  tiles have run.  Other expressions, and kernels reading regions the
+  scheduler can't follow, are evaluated whole once their inputs are
+  complete.
+
+  Each worker runs at most ``--concurrent_kernels`` kernels from the
+  scheduler at once, of at most ``--dataflow_batch_tiles`` tiles, and
+  tiles of later stages are sent first; intermediate arrays are worked
+  through from front to back instead of being built whole.
+  '''
+  def __init__(self, root, key=None, versions=None):
+    DagScheduler.__init__(self, root, key, versions)
+    # expr_id -> value of nodes with some (but not all) tiles computed.
+    self.partial = {}
+    # id(array) -> expr_id of the stage computing it.
+    self.producers = {}
+    # expr_id -> `_Stage`
+    self.stages = {}
+    # (expr_id, extent) -> [(stage, extent)] of tiles waiting for a tile.
+    self.consumers = collections.defaultdict(list)
+    self.started = set()
+    # expr_id -> `TileKernel` run whole once its inputs are complete.
+    self.blocked = {}
+    # worker_id -> number of kernels sent to it which haven't finished.
+    self.running = collections.defaultdict(int)
+    self.done = Queue.Queue()
+    self.pending = 0
+    self.error = None
+
+  def _streams(self, expr):
+    '''True if ``expr`` can start before its inputs are complete.'''
+    return hasattr(expr, '_tile_kernel') or isinstance(expr, CollectionExpr)
+
+  def _deps(self, expr):
+    deps = {}
+    for k, v in expr.dependencies().iteritems():
+      if not isinstance(v, Expr):
+        deps[k] = v
+      elif v.expr_id in self.values:
+        deps[k] = self.values[v.expr_id]
+      else:
+        deps[k] = self.partial[v.expr_id]
+    return deps
+
+  def _complete(self, expr):
+    '''True if all inputs of ``expr`` are complete.'''
+    for v in expr.dependencies().itervalues():
+      if isinstance(v, Expr) and v.expr_id not in self.values:
+        return False
+    return True
+
+  def _spawn(self, fn, args, callback):
+    '''Call ``fn(*args)`` in the pool, and ``callback`` with its result from `run`.'''
+    self.pending += 1
+    _get_dataflow_pool(self.ctx).apply_async(self._task, args=(fn, args, callback))
+
+  def _task(self, fn, args, callback):
+    blob_ctx.set(self.ctx)
+    _scheduler_thread.active = True
+    try:
+      self.done.put((callback, fn(*args), None))
+    except Exception:
+      self.done.put((callback, None, sys.exc_info()))
+
+  def _call(self, expr, fn, *args):
+    try:
+      return fn(*args)
+    except Exception:
+      print >>sys.stderr, 'Error executing expression'
+      expr.stack_trace.dump()
+      raise
+
+  def _start(self, expr_id):
+    '''Start evaluating ``expr_id`` if its inputs are available.'''
+    if expr_id in self.started:
+      return
+    expr, key, versions = self.nodes[expr_id]
+    streams = self._streams(expr)
+    for v in expr.dependencies().itervalues():
+      if isinstance(v, Expr) and v.expr_id not in self.values:
+        if not streams or v.expr_id not in self.partial:
+          return
+
+    self.started.add(expr_id)
+    if isinstance(expr, CollectionExpr):
+      value = expr._evaluate(self.ctx, self._deps(expr))
+      if self._complete(expr):
+        expr._cache_value(value, key, versions)
+        self._finish(expr_id, value)
+      else:
+        self.partial[expr_id] = value
+        self._start_parents(expr_id)
+    elif streams:
+      self._spawn(self._call, (expr, expr._tile_kernel, self.ctx, self._deps(expr)),
+                  functools.partial(self._start_stage, expr_id))
+    else:
+      self._spawn(expr._run, (self.ctx, self._deps(expr), key, versions),
+                  functools.partial(self._finish, expr_id))
+
+  def _start_parents(self, expr_id):
+    for parent_id in self.parents[expr_id]:
+      parent = self.nodes[parent_id][0]
+      if parent_id in self.blocked:
+        self._run_blocked(parent_id)
+      elif parent_id in self.partial and isinstance(parent, CollectionExpr):
+        if self._complete(parent):
+          _, key, versions = self.nodes[parent_id]
+          parent._cache_value(self.partial[parent_id], key, versions)
+          self._finish(parent_id, self.partial[parent_id])
+      else:
+        self._start(parent_id)
+
+  def _finish(self, expr_id, value):
+    '''Record the value of a complete node.'''
+    self.values[expr_id] = value
+    self.partial.pop(expr_id, None)
+    self._start_parents(expr_id)
+
+  def _start_stage(self, expr_id, kernel):
+    array = kernel.array
+    inputs = getattr(kernel.mapper_fn, 'inputs', None)
+    if inputs is None or not isinstance(array, distarray.DistArrayImpl):
+      self.blocked[expr_id] = kernel
+      self._run_blocked(expr_id)
+      return
+
+    producer_id = self.producers.get(id(array))
+    if producer_id is not None and producer_id not in self.values:
+      extents = self.stages[producer_id].extents
+    else:
+      extents = array.tiles.keys()
+    if not extents:
+      self.blocked[expr_id] = kernel
+      self._run_blocked(expr_id)
+      return
+
+    stage = _Stage(expr_id, kernel, extents, len(self.stages))
+    self.stages[expr_id] = stage
+    for ex in extents:
+      missing = self._missing_tiles(inputs(ex, **kernel.kw) + [(array, ex)])
+      stage.waiting[ex] = len(missing)
+      for key in missing:
+        self.consumers[key].append((stage, ex))
+      if not missing:
+        self._tile_ready(stage, ex)
+
+  def _run_blocked(self, expr_id):
+    expr = self.nodes[expr_id][0]
+    if self._complete(expr):
+      kernel = self.blocked.pop(expr_id)
+      self._spawn(self._call, (expr, kernel.run),
+                  functools.partial(self._finish_stage, expr_id))
+
+  def _missing_tiles(self, inputs):
+    '''Return the (expr_id, extent) of tiles read by ``inputs`` which aren't computed.'''
+    missing = set()
+    for array, region in inputs:
+      # views (e.g. broadcasts) of an array depend on all of it.
+      while id(array) not in self.producers and \
+            isinstance(array, distarray.DistArray) and hasattr(array, 'base'):
+        array, region = array.base, None
+
+      producer_id = self.producers.get(id(array))
+      if producer_id is None or producer_id in self.values:
+        continue
+      producer = self.stages[producer_id]
+      if region is None:
+        extents = producer.extents
+      else:
+        extents = producer.find_overlapping(region)
+      for ex in extents:
+        if ex not in producer.tiles:
+          missing.add((producer_id, ex))
+    return missing
+
+  def _tile_ready(self, stage, ex):
+    tile_id = stage.kernel.array.tiles[ex]
+    stage.ready[tile_id.worker].append((ex, tile_id))
+
+  def _send_tiles(self):
+    '''Send the ready tiles of each stage, up to the limit for each worker.'''
+    n_kernels = max(FLAGS.concurrent_kernels, 1)
+    n_tiles = max(FLAGS.dataflow_batch_tiles, 1)
+    for stage in sorted(self.stages.values(), key=lambda stage: -stage.order):
+      for worker_id, tiles in stage.ready.iteritems():
+        while tiles and self.running[worker_id] < n_kernels:
+          batch = tiles[:n_tiles]
+          del tiles[:n_tiles]
+          self.running[worker_id] += 1
+          expr = self.nodes[stage.expr_id][0]
+          self._spawn(self._call, (expr, self._run_tiles, stage.kernel, batch),
+                      functools.partial(self._tiles_done, stage, worker_id, batch))
+
+  def _run_tiles(self, kernel, tiles):
+    return kernel.array.foreach_tile(mapper_fn=kernel.mapper_fn,
+                                     kw=dict(kernel.kw),
+                                     tile_ids=[tile_id for _, tile_id in tiles])
+
+  def _tiles_done(self, stage, worker_id, tiles, results):
+    self.running[worker_id] -= 1
+    for ex, tile_id in tiles:
+      if stage.kernel.output is None:
+        for result_ex, result_id in results[tile_id]:
+          self._tile_done(stage, result_ex, result_id)
+      else:
+        self._tile_done(stage, ex)
+
+    stage.remaining -= len(tiles)
+    if stage.remaining == 0:
+      if stage.kernel.output is None:
+        value = self.partial.get(stage.expr_id)
+        if value is None:
+          # no tile produced a result (e.g. a filter selecting nothing).
+          value = distarray.from_table({}, shape=extent.find_shape(stage.extents))
+      else:
+        value = stage.kernel.output
+      self._finish_stage(stage.expr_id, value)
+
+  def _tile_done(self, stage, ex, tile_id=None):
+    '''Record that the tile ``ex`` of ``stage`` is computed.'''
+    if tile_id is not None:
+      stage.tiles[ex] = tile_id
+      array = self.partial.get(stage.expr_id)
+      if array is None:
+        array = distarray.from_table({ex: tile_id}, shape=extent.find_shape(stage.extents))
+        self.partial[stage.expr_id] = array
+        self.producers[id(array)] = stage.expr_id
+        self._start_parents(stage.expr_id)
+      else:
+        array.set_tile(ex, tile_id)
+
+    for consumer, consumer_ex in self.consumers.pop((stage.expr_id, ex), []):
+      consumer.waiting[consumer_ex] -= 1
+      if consumer.waiting[consumer_ex] == 0:
+        self._tile_ready(consumer, consumer_ex)
+
+  def _finish_stage(self, expr_id, value):
+    expr, key, versions = self.nodes[expr_id]
+    expr._cache_value(value, key, versions)
+    self._finish(expr_id, value)
+
+  def run(self):
+    '''Evaluate the DAG, and return the value of the root.'''
+    util.log_debug('Scheduling %d expressions by tile', len(self.nodes))
+    for expr_id in self.ready:
+      self._start(expr_id)
+
+    while self.root.expr_id not in self.values:
+      if self.error is None:
+        self._send_tiles()
+
+      if self.pending == 0:
+        break
+
+      callback, result, exc_info = self.done.get()
+      self.pending -= 1
+      if exc_info is not None:
+        # let running tasks finish before raising the first error.
+        self.error = self.error or exc_info
+      elif self.error is None:
+        callback(result)
+
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+    return self.values[self.root.expr_id]
+
+
 def glom(value):
   '''
   Evaluate this expression and return the result as a `numpy.ndarray`.
@@ -1,4 +1,4 @@
-from traits.api import Bool, Str, Instance, PythonValue, HasTraits
+from ...node import Bool, Str, Instance, PythonValue
 
 from .base import Expr, lazify
 from ..fio import save, partial_load, load
@@ -29,7 +29,7 @@ class CheckpointExpr(Expr):
         new_blobs = partial_load(extents, "%s" % self.expr_id, path=self.path,
                                  iszip=False)
         for ex, tile_id in new_blobs.iteritems():
-          cached_result.tiles[ex] = tile_id
+          cached_result.set_tile(ex, tile_id)
           cached_result.bad_tiles.remove(ex)
         return cached_result
       else:
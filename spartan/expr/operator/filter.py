@@ -4,7 +4,7 @@ These are generated by a __getitem__ call to an `Expr`, when
 passed a non-numeric, non-tuple type, (e.g. x[idx_x]).
 '''
 import numpy as np
-from traits.api import Instance, PythonValue
+from ...node import Instance, PythonValue
 
 from .base import Expr, ListExpr, TupleExpr, NotShapeable
 from ... import util, blob_ctx
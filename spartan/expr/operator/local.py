@@ -17,8 +17,7 @@ import scipy.sparse as sp
 
 from spartan import util
 from spartan.util import Assert
-from spartan.node import Node, indent
-from traits.api import Str, List, Function, PythonValue, Int
+from spartan.node import SlotNode, indent, Str, List, Function, PythonValue, Int
 
 var_id = iter(xrange(1000000))
 expr_id = iter(xrange(1000000))
@@ -32,11 +31,11 @@ def make_var():
   return 'key_%d' % var_id.next()
 
 
-class LocalCtx(Node):
+class LocalCtx(SlotNode):
   inputs = PythonValue
 
 
-class LocalExpr(Node):
+class LocalExpr(SlotNode):
   '''Represents an internal operation to be performed in the context of a tile.'''
   deps = List()
 
@@ -112,7 +111,13 @@ class FnCallExpr(LocalExpr):
     else:
       return self.fn.__name__
 
-  def evaluate(self, ctx):
+  def evaluate(self, ctx, alloc=None):
+    '''
+    :param ctx: `LocalCtx`
+    :param alloc: Optional function of (shape, dtype) returning an array.  If
+      this expression is a ufunc over dense arrays, its result is written into
+      an array from ``alloc``.
+    '''
     deps = [d.evaluate(ctx) for d in self.deps]
 
     #util.log_info('Evaluating %s.%d [%s]', self.fn_name(), self.id, deps)
@@ -124,9 +129,35 @@ class FnCallExpr(LocalExpr):
       for i in range(2):
         if sp.issparse(deps[i]):
           deps[i] = deps[i].todense()
+
+    if alloc is not None:
+      out = _ufunc_output(self.fn, deps, self.kw, alloc)
+      if out is not None:
+        return self.fn(*deps, out=out, **self.kw)
     return self.fn(*deps, **self.kw)
 
 
+def _ufunc_output(fn, deps, kw, alloc):
+  '''
+  Return an array from ``alloc`` to hold the result of ``fn(*deps, **kw)``,
+  or None if ``fn`` is not a ufunc over plain arrays and scalars.
+  '''
+  if not isinstance(fn, np.ufunc) or fn.nout != 1 or 'out' in kw or 'where' in kw:
+    return None
+
+  arrays = [d for d in deps if not np.isscalar(d)]
+  if not arrays or any([type(d) is not np.ndarray for d in arrays]):
+    return None
+
+  # the result type is found by applying ``fn`` to empty slices of the
+  # inputs, which keeps numpy's casting rules for arrays and scalars.
+  probe = [d[(slice(0, 0),) * d.ndim] if isinstance(d, np.ndarray) and d.ndim > 0 else d
+           for d in deps]
+  dtype = fn(*probe, **kw).dtype
+  shape = np.broadcast(*deps).shape
+  return alloc(shape, dtype)
+
+
 # The local operation of map and reduce expressions is practically
 # identical.  Reductions take an axis and extent argument in
 # addition to the normal function call arguments.
@@ -137,7 +168,7 @@ class LocalMapExpr(FnCallExpr):
 class LocalMapLocationExpr(LocalMapExpr):
   _op_type = 'map_location'
 
-  def evaluate(self, ctx):
+  def evaluate(self, ctx, alloc=None):
     deps = []
     for d in self.deps:
       if isinstance(d, LocalInput) and d.idx == 'extent':
@@ -16,10 +16,10 @@ the same behavior as Numpy broadcasting).
 
 import collections
 import time
-from traits.api import Instance
+from ...node import Instance
 
 from spartan import rpc
-from .base import ListExpr, TupleExpr, PythonValue, Expr, as_array, NotShapeable
+from .base import ListExpr, TupleExpr, PythonValue, Expr, TileKernel, as_array, NotShapeable
 from .broadcast import Broadcast, broadcast
 from .local import FnCallExpr, LocalInput, LocalCtx, LocalExpr, LocalMapExpr
 from .local import LocalMapLocationExpr, make_var
@@ -71,7 +71,12 @@ def tile_mapper(ex, children, child_to_var, op):
   op_ctx = LocalCtx(inputs=local_values)
 
   #util.log_info('Inputs: %s', local_values)
-  result = op.evaluate(op_ctx)
+  # write the result of elementwise ops into a recycled tile buffer.
+  pool = blob_ctx.get().buffer_pool
+  if pool is not None and isinstance(op, FnCallExpr):
+    result = op.evaluate(op_ctx, alloc=pool.empty)
+  else:
+    result = op.evaluate(op_ctx)
 
   if id(result) == id(local_values[child_to_var[0]]):
     return LocalKernelResult(result=[(ex, children[0].tiles[ex])])
@@ -88,6 +93,34 @@ def tile_mapper(ex, children, child_to_var, op):
   return LocalKernelResult(result=[(ex, tile_id)])
 
 
+def tile_prefetch(ex, children, child_to_var, op):
+  '''
+  Start fetching the inputs `tile_mapper` will read for ``ex``.
+
+  Broadcast inputs are small and are fetched when they are used.
+
+  :rtype: The number of bytes being fetched.
+  '''
+  nbytes = 0
+  for child in children:
+    if not isinstance(child, Broadcast):
+      nbytes += child.prefetch(ex)
+  return nbytes
+
+tile_mapper.prefetch = tile_prefetch
+
+
+def tile_inputs(ex, children, child_to_var, op):
+  '''
+  List the regions `tile_mapper` reads for ``ex``.
+
+  :rtype: list of (array, region) pairs.
+  '''
+  return [(child, ex) for child in children]
+
+tile_mapper.inputs = tile_inputs
+
+
 class MapExpr(Expr):
   '''Represents mapping an operator over one or more inputs.
 
@@ -147,6 +180,9 @@ class MapExpr(Expr):
         self._evaluate_kw(d)
 
   def _evaluate(self, ctx, deps):
+    return self._tile_kernel(ctx, deps).run()
+
+  def _tile_kernel(self, ctx, deps):
     children = deps['children']
     child_to_var = deps['child_to_var']
     self._evaluate_kw(self.op)
@@ -164,9 +200,9 @@ class MapExpr(Expr):
 
     #util.log_info('Mapping %s over %d inputs; largest = %s', op, len(children), largest.shape)
 
-    return largest.map_to_array(tile_mapper, kw={'children': children,
-                                                 'child_to_var': child_to_var,
-                                                 'op': self.op})
+    return TileKernel(largest, tile_mapper, kw={'children': children,
+                                                'child_to_var': child_to_var,
+                                                'op': self.op})
 
 
 def map(inputs, fn, numpy_expr=None, fn_kw=None):
@@ -240,40 +276,50 @@ def region_join_mapper(ex, arrays, axes, local_user_fn, local_user_fn_kw,
     return LocalKernelResult(result=[], futures=futures)
 
 
-def join_mapper(ex, arrays, axes, local_user_fn, local_user_fn_kw, target):
+def _join_extents(ex, arrays, axes):
+  '''
+  Find the extents of ``arrays`` joined with the tile ``ex`` of the first.
+
+  :rtype: list of extents, one per array, or None if nothing is joined.
+  '''
   if len(axes) == 0:
-    tiles = []
-    # Fetch the extents
-    for i in range(0, len(arrays)):
-      tiles.append(arrays[i].fetch(ex))
+    return [ex] * len(arrays)
 
-    join_extents = ex
-  else:
-    # First find out extents for all arrays
-    first_extent = extent.change_partition_axis(ex, axes[0])
-
-    # FIXME: I'm not sure if the following comment is really true for map2.
-    # assert first_extent is not None
-    if first_extent is None:
-      # It is possible that the return value of change_partition_axis
-      # is None if the dimension of new partition axis is smaller than
-      # the dimension of the original axis.
-      return LocalKernelResult(result=[])
-
-    keys = (first_extent.ul[axes[0]], first_extent.lr[axes[0]])
-    join_extents = [first_extent]
-
-    for i in range(1, len(arrays)):
-      ul = [0 for j in range(len(arrays[i].shape))]
-      lr = list(arrays[i].shape)
-      ul[axes[i]] = keys[0]
-      lr[axes[i]] = keys[1]
-      join_extents.append(extent.create(ul, lr, arrays[i].shape))
-
-    tiles = []
-    # Fetch the extents
-    for i in range(0, len(arrays)):
-      tiles.append(arrays[i].fetch(join_extents[i]))
+  # First find out extents for all arrays
+  first_extent = extent.change_partition_axis(ex, axes[0])
+
+  # FIXME: I'm not sure if the following comment is really true for map2.
+  # assert first_extent is not None
+  if first_extent is None:
+    # It is possible that the return value of change_partition_axis
+    # is None if the dimension of new partition axis is smaller than
+    # the dimension of the original axis.
+    return None
+
+  keys = (first_extent.ul[axes[0]], first_extent.lr[axes[0]])
+  join_extents = [first_extent]
+
+  for i in range(1, len(arrays)):
+    ul = [0 for j in range(len(arrays[i].shape))]
+    lr = list(arrays[i].shape)
+    ul[axes[i]] = keys[0]
+    lr[axes[i]] = keys[1]
+    join_extents.append(extent.create(ul, lr, arrays[i].shape))
+  return join_extents
+
+
+def join_mapper(ex, arrays, axes, local_user_fn, local_user_fn_kw, target):
+  extents = _join_extents(ex, arrays, axes)
+  if extents is None:
+    return LocalKernelResult(result=[])
+
+  tiles = []
+  # Fetch the extents
+  for i in range(0, len(arrays)):
+    tiles.append(arrays[i].fetch(extents[i]))
+
+  # without axes, the user function is passed the tile's extent alone.
+  join_extents = ex if len(axes) == 0 else extents
 
   if local_user_fn_kw is None:
     local_user_fn_kw = {}
@@ -286,6 +332,20 @@ def join_mapper(ex, arrays, axes, local_user_fn, local_user_fn_kw, target):
   return LocalKernelResult(result=[], futures=futures)
 
 
+def join_inputs(ex, arrays, axes, local_user_fn, local_user_fn_kw, target):
+  '''
+  List the regions `join_mapper` reads for ``ex``.
+
+  :rtype: list of (array, region) pairs.
+  '''
+  extents = _join_extents(ex, arrays, axes)
+  if extents is None:
+    return []
+  return zip(arrays, extents)
+
+join_mapper.inputs = join_inputs
+
+
 class Map2Expr(Expr):
   arrays = Instance(TupleExpr)
   axes = Instance(tuple)
@@ -304,6 +364,9 @@ class Map2Expr(Expr):
     return self.shape
 
   def _evaluate(self, ctx, deps):
+    return self._tile_kernel(ctx, deps).run()
+
+  def _tile_kernel(self, ctx, deps):
     arrays = deps['arrays']
     axes = deps['axes']
     fn = deps['fn']
@@ -323,15 +386,16 @@ class Map2Expr(Expr):
                               sparse=(arrays[0].sparse and arrays[1].sparse))
 
     if update_region is None:
-      arrays[0].foreach_tile(mapper_fn=join_mapper,
-                             kw=dict(arrays=arrays, axes=axes, local_user_fn=fn,
-                                     local_user_fn_kw=fn_kw, target=target))
+      return TileKernel(arrays[0], join_mapper,
+                        kw=dict(arrays=arrays, axes=axes, local_user_fn=fn,
+                                local_user_fn_kw=fn_kw, target=target),
+                        output=target)
     else:
-      arrays[0].foreach_tile(mapper_fn=region_join_mapper,
-                             kw=dict(arrays=arrays, axes=axes, local_user_fn=fn,
-                                     local_user_fn_kw=fn_kw, target=target,
-                                     region=update_region))
-    return target
+      return TileKernel(arrays[0], region_join_mapper,
+                        kw=dict(arrays=arrays, axes=axes, local_user_fn=fn,
+                                local_user_fn_kw=fn_kw, target=target,
+                                region=update_region),
+                        output=target)
 
 
 def map2(arrays, axes=[], fn=None, fn_kw=None, shape=None, update_region=None,
@@ -1,6 +1,6 @@
 import numpy as np
 
-from traits.api import Tuple, Bool, PythonValue
+from ...node import Tuple, Bool, PythonValue
 
 from spartan.array import distarray
 from .base import Expr, expr_like
@@ -12,6 +12,7 @@ class NdArrayExpr(Expr):
   dtype = PythonValue(None, desc="np.type or type")
   tile_hint = PythonValue(None, desc="Tuple or None")
   reduce_fn = PythonValue(None, desc="Function or None")
+  fill_value = PythonValue(None, desc="Initial value of every element, or None")
 
   def pretty_str(self):
     return 'DistArray[%d](%s, %s, hint=%s)' % (self.expr_id, self.shape, np.dtype(self.dtype).name, self.tile_hint)
@@ -22,7 +23,8 @@ class NdArrayExpr(Expr):
       dtype=visitor.visit(self.dtype),
       tile_hint=self.tile_hint,
       sparse=self.sparse,
-      reduce_fn=self.reduce_fn)
+      reduce_fn=self.reduce_fn,
+      fill_value=self.fill_value)
 
   def dependencies(self):
     return {}
@@ -38,21 +40,26 @@ class NdArrayExpr(Expr):
     return distarray.create(shape, dtype,
                             reducer=self.reduce_fn,
                             tile_hint=tile_hint,
-                            sparse=self.sparse)
+                            sparse=self.sparse,
+                            fill_value=self.fill_value)
 
 def ndarray(shape,
             dtype=np.float,
             tile_hint=None,
             reduce_fn=None,
-            sparse=False):
+            sparse=False,
+            fill_value=None):
   '''
   Lazily create a new distributed array.
   :param shape:
   :param dtype:
   :param tile_hint:
+  :param fill_value: If not None, every element starts out with this value.
+    Tiles are stored as constants until they are written.
   '''
   return NdArrayExpr(_shape = shape,
                      dtype = dtype,
                      tile_hint = tile_hint,
                      reduce_fn = reduce_fn,
-                     sparse = sparse)
+                     sparse = sparse,
+                     fill_value = fill_value)
@@ -17,7 +17,7 @@ from collections import namedtuple
 from . import local
 from . import tiling
 from .base import Expr, Val, AsArray, ListExpr, lazify, expr_like, ExprTrace
-from .base import NotShapeable, CollectionExpr
+from .base import NotShapeable, CollectionExpr, Uncacheable, node_key
 from .filter import FilterExpr
 from .local import LocalInput, LocalMapExpr, LocalMapLocationExpr, make_var
 from .local import ParakeetExpr
@@ -130,6 +130,48 @@ def merge_var(children, child_to_var, k, v):
     child_to_var.append(k)
 
 
+class CommonSubexpressionElimination(OptimizePass):
+  '''Merge structurally identical subexpressions.
+
+  (x.T + 1) * (x.T + 1) -> y * y, where y = x.T + 1
+
+  Two nodes are equal if they have the same `node_key` (as used by the
+  result cache), and their children have already been merged.  Expressions
+  which allocate or write arrays, or are not idempotent, are never merged.
+  '''
+  name = 'cse'
+  hits = 0
+
+  def __init__(self):
+    # Keys are only comparable within a single DAG.
+    self.visited = {}
+    self.exprs = {}
+
+  def visit_default(self, expr):
+    if id(expr) in _not_idempotent_list:
+      return expr.visit(self)
+
+    expr = expr.visit(self)
+    try:
+      # children are merged already, so they are equal only to themselves.
+      key = node_key(expr, lambda child: ('expr', child.expr_id), {})
+      found = self.exprs.get(key)
+    except Uncacheable:
+      return expr
+    except TypeError:
+      # unhashable value nested inside a structure
+      return expr
+
+    if found is None:
+      self.exprs[key] = expr
+      return expr
+
+    CommonSubexpressionElimination.hits += 1
+    util.log_debug('CSE: %s %d -> %d (%d merged)', expr.typename(), expr.expr_id,
+                   found.expr_id, CommonSubexpressionElimination.hits)
+    return found
+
+
 class MapMapFusion(OptimizePass):
   '''Fold sequences of Map operations together.
 
@@ -1089,6 +1131,7 @@ def add_optimization(klass, default):
   #util.log_info('Passes: %s', passes)
 
 add_optimization(CollapsedCachedExpressions, True)
+add_optimization(CommonSubexpressionElimination, True)
 add_optimization(AutomaticTiling, True)
 add_optimization(RotateSlice, False)
 add_optimization(MapMapFusion, True)
@@ -1,5 +1,5 @@
 import time
-from traits.api import Instance
+from ...node import Instance
 
 from spartan.node import Node
 from spartan import rpc
@@ -7,12 +7,13 @@ This supports generic reduce operations such as
 import collections
 import numpy as np
 
-from traits.api import Instance, Function, PythonValue
+from ...node import Instance, Function, PythonValue
 
 from spartan.node import indent
 from . import broadcast
-from .base import Expr, ListExpr
+from .base import Expr, ListExpr, TileKernel
 from .local import make_var, LocalExpr, LocalReduceExpr, LocalInput, LocalCtx
+from ... import rpc
 from ...array import extent, distarray
 from ...util import Assert
 from ...core import LocalKernelResult
@@ -66,8 +67,16 @@ def _reduce_mapper(ex, children, child_to_var, op, axis, output):
   local_reduction = np.asarray(local_reduction).reshape(dst_extent.shape)
 
   #util.log_info('Update: %s %s', dst_extent, local_reduction)
-  output.update(dst_extent, local_reduction)
-  return LocalKernelResult(result=[])
+  futures = rpc.FutureGroup()
+  futures.append(output.update(dst_extent, local_reduction, wait=False))
+  return LocalKernelResult(result=[], futures=futures)
+
+
+def _reduce_inputs(ex, children, child_to_var, op, axis, output):
+  '''List the regions `_reduce_mapper` reads for ``ex``.'''
+  return [(child, ex) for child in children]
+
+_reduce_mapper.inputs = _reduce_inputs
 
 
 class ReduceExpr(Expr):
@@ -98,6 +107,9 @@ class ReduceExpr(Expr):
                                                  indent(self.children.pretty_str()), self.tile_hint)
 
   def _evaluate(self, ctx, deps):
+    return self._tile_kernel(ctx, deps).run()
+
+  def _tile_kernel(self, ctx, deps):
     children = deps['children']
     child_to_var = deps['child_to_var']
     axis = deps['axis']
@@ -118,13 +130,12 @@ class ReduceExpr(Expr):
                                     reducer=tile_accum, tile_hint=self.tile_hint)
 
   # util.log_info('Reducing into array %s', output_array)
-    largest.foreach_tile(_reduce_mapper, kw={'children': children,
-                                             'child_to_var': child_to_var,
-                                             'op': op,
-                                             'axis': axis,
-                                             'output': output_array})
-
-    return output_array
+    return TileKernel(largest, _reduce_mapper, kw={'children': children,
+                                                   'child_to_var': child_to_var,
+                                                   'op': op,
+                                                   'axis': axis,
+                                                   'output': output_array},
+                      output=output_array)
 
 
 def reduce(v, axis, dtype_fn, local_reduce_fn, accumulate_fn, fn_kw=None, tile_hint=None):
@@ -6,7 +6,7 @@ import itertools
 import numpy as np
 import scipy.sparse as sp
 
-from traits.api import PythonValue, Instance, Tuple
+from ...node import PythonValue, Instance, Tuple
 
 from spartan import rpc
 from .base import Expr, lazify
@@ -1,4 +1,4 @@
-from traits.api import Instance, Function, PythonValue, HasTraits
+from ...node import Instance, Function, PythonValue
 
 from spartan import rpc
 from .base import Expr, lazify, DictExpr, NotShapeable
@@ -120,6 +120,7 @@ class ShuffleExpr(Expr):
     if target is not None:
       v.foreach_tile(mapper_fn=target_mapper,
                      kw=dict(map_fn=map_fn, source=v, target=target, fn_kw=fn_kw))
+      target.mark_updated()
       return target
     else:
       return v.map_to_array(mapper_fn=notarget_mapper,
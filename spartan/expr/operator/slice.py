@@ -1,4 +1,4 @@
-from traits.api import Instance, Tuple, PythonValue
+from ...node import Instance, Tuple, PythonValue
 
 from . import base, broadcast
 from ... import util, node, core, master
@@ -4,7 +4,7 @@ from .map import map2
 from .ndarray import ndarray
 from .shuffle import shuffle
 from .tile_operation import tile_operation
-from ... import util, rpc, blob_ctx
+from ... import util, blob_ctx
 from ...array import extent
 
 
@@ -54,7 +54,8 @@ def _fetch_sort_mapper(array, ex, partition_counts):
   id = sorted_exts.index(ex)
 
   ctx = blob_ctx.get()
-  futures = rpc.FutureGroup()
+  tile_ids = []
+  fetch_slices = []
   dst_idx = 0
   for ex in sorted_exts:
     tile_id = array.tiles[ex]
@@ -62,10 +63,10 @@ def _fetch_sort_mapper(array, ex, partition_counts):
 
     # there are data belong to local partition in the tile ex
     if partition_counts[tile_id][0][id+1] > partition_counts[tile_id][0][id]:
-      fetch_slice = tuple([slice(partition_counts[tile_id][0][id], partition_counts[tile_id][0][id+1], None)])
-      futures.append(ctx.get_flatten(tile_id, fetch_slice, wait=False))
+      tile_ids.append(tile_id)
+      fetch_slices.append(tuple([slice(partition_counts[tile_id][0][id], partition_counts[tile_id][0][id+1], None)]))
 
-  result = np.concatenate([resp.data for resp in futures.wait()], axis=None)
+  result = np.concatenate(ctx.multi_get(tile_ids, fetch_slices, flatten=True), axis=None)
   yield extent.create((dst_idx,), (dst_idx+result.size,), (np.prod(array.shape),)), np.sort(result, axis=None)
 
 
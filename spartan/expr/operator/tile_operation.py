@@ -1,4 +1,4 @@
-from traits.api import Instance, Function, PythonValue
+from ...node import Instance, Function, PythonValue
 
 from .base import Expr, lazify, DictExpr, NotShapeable
 from ... import util
@@ -5,7 +5,7 @@ Transpose operation and expr.
 import numpy as np
 import scipy.sparse as sp
 
-from traits.api import Instance, PythonValue
+from ...node import Instance, PythonValue
 
 from spartan import rpc
 from .base import Expr, lazify
@@ -16,7 +16,7 @@ import math
 import ast
 import struct
 
-from traits.api import PythonValue
+from ...node import PythonValue
 
 from spartan import rpc
 from spartan import master
@@ -70,6 +70,7 @@ class WriteArrayExpr(Expr):
       array.foreach_tile(mapper_fn=_write_mapper,
                          kw={'source': array, 'sregion': sregion,
                              'dst_slice': dst_slice})
+      array.mark_updated()
     else:
       raise TypeError
 
@@ -0,0 +1,229 @@
+'''
+Content-addressed caching of kernel functions and arguments.
+
+Iterative programs run the same kernels over and over, often with the same
+closures, large constant arguments (e.g. a vector being multiplied by a
+distributed matrix) and distributed arrays.  Rather than sending these to
+every worker for each kernel, the master sends a small *skeleton* of the
+kernel where each cacheable object is replaced by a digest of its contents.
+Distributed arrays are instead referenced by their id and layout version,
+so their tile maps are only sent again after tiles have moved.  Workers keep recently
+used objects in a `KernelCache`; objects a worker doesn't hold yet are
+uploaded with the request (NumPy arrays are sent as-is, so the RPC layer can
+send them as separate frames).  Cached objects are shared by every kernel
+using them, so cached arrays are read-only.
+
+If a worker no longer holds an object the master believes it has, it
+reports a miss and the master resends the kernel with all of its objects.
+'''
+
+import collections
+import cPickle
+import hashlib
+import sys
+import types
+
+import numpy as np
+
+from . import cloudpickle, util
+from .config import FLAGS, IntFlag
+from .rpc import rlock, serialization_buffer
+
+FLAGS.add(IntFlag('kernel_cache_size', default=256,
+                  help='Number of kernel functions and arguments cached by each worker (0 disables caching)'))
+
+# Arrays smaller than this are sent with each kernel.
+MIN_CACHED_BYTES = 64 * 1024
+
+
+class CacheMiss(Exception):
+  '''Raised when a kernel refers to an object that isn't in the cache.'''
+  pass
+
+
+def _is_global(fn):
+  '''True if ``fn`` is pickled by reference (as module.name).'''
+  module = sys.modules.get(fn.__module__)
+  return getattr(module, fn.__name__, None) is fn
+
+
+def _digest_array(array):
+  h = hashlib.sha1()
+  h.update('%s%s' % (array.dtype.str, array.shape))
+  h.update(np.ascontiguousarray(array))
+  return h.hexdigest()
+
+
+class KernelEncoder(object):
+  '''
+  Encodes kernels on the master.
+
+  Tracks which objects each worker is expected to hold (mirroring the
+  workers' cache eviction policy), so only missing objects are uploaded.
+
+  :param max_entries: Size of the worker caches.
+  '''
+  def __init__(self, max_entries):
+    from .array import distarray
+    self._array_type = distarray.DistArrayImpl
+    self._max_entries = max_entries
+    self._held = collections.defaultdict(collections.OrderedDict)
+
+  def _persistent_id(self, objects, digests, root=None):
+    def persistent_id(obj):
+      if obj is root:
+        return None
+
+      if id(obj) in digests:
+        pid = digests[id(obj)][0]
+        # workers move an object to the end of their LRU each time it is read.
+        objects[pid[1]] = objects.pop(pid[1])
+        return pid
+
+      t = type(obj)
+      if t is types.FunctionType:
+        if _is_global(obj):
+          return None
+        payload = self._dumps(obj, objects, digests, root=obj)
+        digest = hashlib.sha1(payload).hexdigest()
+        objects.pop(digest, None)
+        objects[digest] = payload
+      elif t is np.ndarray and obj.nbytes >= MIN_CACHED_BYTES and not obj.dtype.hasobject:
+        digest = _digest_array(obj)
+        objects.pop(digest, None)
+        objects[digest] = obj
+      elif t is self._array_type:
+        # Arrays are referenced by handle; their tile map is only pickled
+        # for workers that don't have the current layout.  The contents
+        # version changes more often, so it's sent with each reference.
+        (origin, array_id), version = obj.cache_key()
+        digest = 'array-%s-%d-%d' % (origin, array_id, obj.layout_version)
+        objects[digest] = obj
+        pid = ('kernel_cache', digest, version)
+        digests[id(obj)] = (pid, obj)
+        return pid
+      else:
+        return None
+
+      # Keep a reference to obj, so its id isn't reused while pickling.
+      pid = ('kernel_cache', digest)
+      digests[id(obj)] = (pid, obj)
+      return pid
+    return persistent_id
+
+  def _dumps(self, obj, objects, digests, root=None):
+    w = serialization_buffer.Writer()
+    cloudpickle.dump(obj, w, -1, self._persistent_id(objects, digests, root))
+    return w.getvalue()
+
+  def _upload(self, obj):
+    if isinstance(obj, self._array_type):
+      return cloudpickle.dumps(obj, -1)
+    return obj
+
+  def encode(self, mapper_fn, kw, worker_ids):
+    '''
+    Encode a kernel to be sent to ``worker_ids``.
+
+    :rtype: tuple of (skeleton, uploads, objects): the pickled skeleton of
+      (mapper_fn, kw), the objects some worker is missing, and all objects
+      referenced by the skeleton.  Uploads map from a digest to a NumPy
+      array or a pickled object.  Objects may also hold distributed arrays,
+      which are only pickled when uploaded.
+    '''
+    # in the order workers read the objects, so their LRU order is mirrored.
+    objects = collections.OrderedDict()
+    skeleton = self._dumps((mapper_fn, kw), objects, {})
+
+    uploads = {}
+    for worker_id in worker_ids:
+      held = self._held[worker_id]
+      for digest in objects:
+        if digest in held:
+          del held[digest]
+        else:
+          uploads[digest] = objects[digest]
+        held[digest] = True
+
+      while len(held) > self._max_entries:
+        held.popitem(last=False)
+
+    for digest, obj in uploads.iteritems():
+      uploads[digest] = self._upload(obj)
+
+    return skeleton, uploads, objects
+
+  def reupload(self, worker_id, objects):
+    '''
+    Handle a cache miss from ``worker_id``.
+
+    :rtype: All of ``objects``, ready for upload.
+    '''
+    held = self._held[worker_id]
+    held.clear()
+    uploads = {}
+    for digest, obj in objects.iteritems():
+      uploads[digest] = self._upload(obj)
+      held[digest] = True
+    return uploads
+
+
+class KernelCache(object):
+  '''
+  A worker's LRU cache of kernel functions and arguments.
+
+  :param max_entries: Maximum number of objects to keep.
+  '''
+  def __init__(self, max_entries):
+    self._max_entries = max_entries
+    self._objects = collections.OrderedDict()
+    self._lock = rlock.FastRLock()
+
+  def _loads(self, payload, uploads):
+    unpickler = cPickle.Unpickler(serialization_buffer.Reader(payload))
+    unpickler.persistent_load = self._persistent_load(uploads)
+    return unpickler.load()
+
+  def _persistent_load(self, uploads):
+    def persistent_load(pid):
+      obj = self._get(pid[1], uploads)
+      if len(pid) > 2 and obj.version != pid[2]:
+        # a cached array with the same layout may hold older contents.  Other
+        # kernels may be using it, so the newer version is a copy.
+        clone = object.__new__(type(obj))
+        clone.__dict__.update(obj.__dict__)
+        clone.version = pid[2]
+        self._objects[pid[1]] = obj = clone
+      return obj
+    return persistent_load
+
+  def _get(self, digest, uploads):
+    if digest in self._objects:
+      obj = self._objects.pop(digest)
+    elif digest in uploads:
+      obj = uploads[digest]
+      if isinstance(obj, np.ndarray):
+        # kernels writing to the array would change it for later kernels.
+        obj = obj.view()
+        obj.flags.writeable = False
+      else:
+        obj = self._loads(obj, uploads)
+    else:
+      util.log_debug('Kernel cache miss: %s', digest)
+      raise CacheMiss(digest)
+
+    self._objects[digest] = obj
+    return obj
+
+  def load(self, skeleton, uploads):
+    '''
+    Decode a kernel encoded by `KernelEncoder.encode`.
+
+    :rtype: tuple of (mapper_fn, kw)
+    '''
+    with self._lock:
+      try:
+        return self._loads(skeleton, uploads)
+      finally:
+        while len(self._objects) > self._max_entries:
+          self._objects.popitem(last=False)
@@ -103,6 +103,16 @@ class Master(object):
   def register_array(self, array):
     self._arrays.add(array)
 
+  def mark_updated(self, array_ids):
+    '''
+    Record that kernels updated the arrays identified by ``array_ids``.
+
+    Bumps their versions, so results cached from them are recomputed.
+    '''
+    for array in list(self._arrays):
+      if array.cache_key()[0] in array_ids:
+        array.mark_updated()
+
   def get_available_workers(self):
     return self._available_workers
 
@@ -163,10 +173,7 @@ class Master(object):
       for array in self._arrays:
         ex = array.blob_to_ex.get(req.old_tile_id)
         if ex is not None:
-          array.tiles[ex] = req.new_tile_id
-          array.blob_to_ex[req.new_tile_id] = ex
-
-          del array.blob_to_ex[req.old_tile_id]
+          array.set_tile(ex, req.new_tile_id)
           self._ctx.destroy(req.old_tile_id)
           break
 
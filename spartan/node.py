@@ -1,8 +1,23 @@
 '''Helper for constructing trees of objects.
 
 Provides pretty printing, equality testing, hashing and keyword initialization.
+
+Two kinds of nodes are available: `Node`, based on ``traits.HasTraits``, and
+`SlotNode`, which stores its members in ``__slots__``.  Slot nodes are much
+cheaper to construct, and are used for expression DAGs, which are built
+anew by every operator call.  Their members are declared with the
+`Member` types below, which mirror the traits of the same name::
+
+  class MapExpr(Expr):
+    children = Instance(ListExpr)
+    op = PythonValue(None, desc="LocalExpr")
+
+Members are not validated.
 '''
-from traits.api import HasTraits, HasStrictTraits
+import collections
+import copy
+
+from traits.api import HasTraits, HasStrictTraits, TraitType
 from traits.traits import CTrait
 
 from spartan import util
@@ -59,3 +74,125 @@ class Node(HasTraits):
   def debug_str(self):
     return node_str(self)
 
+
+
+class Member(object):
+  '''
+  Declares a member of a `SlotNode`.
+
+  :param default: Initial value of the member.  Lists and dicts are
+    copied for each node.
+  :param desc: Description of the expected values (documentation only).
+  '''
+  default = None
+
+  def __init__(self, default=None, desc=None):
+    if default is not None:
+      self.default = default
+    self.desc = desc
+
+
+class Any(Member): pass
+class PythonValue(Member): pass
+class Function(Member): pass
+class Str(Member): default = ''
+class Int(Member): default = 0
+class Float(Member): default = 0.0
+class Bool(Member): default = False
+class Tuple(Member): default = ()
+class List(Member): default = []
+class Dict(Member): default = {}
+
+
+class Instance(Member):
+  '''Declares a member holding an instance of ``klass`` (or None).'''
+  def __init__(self, klass=None, desc=None):
+    Member.__init__(self, desc=desc)
+    self.klass = klass
+
+
+def _as_member(value):
+  '''
+  Return the `Member` declared by the class attribute ``value``, or None.
+
+  Traits (as used by `Node`) are accepted as well, so node classes written
+  for traits work unchanged.
+  '''
+  if isinstance(value, type) and issubclass(value, (Member, TraitType)):
+    value = value()
+  if isinstance(value, Member):
+    return value
+  if isinstance(value, TraitType):
+    return Member(default=value.default_value)
+  return None
+
+
+class SlotNodeType(type):
+  '''Metaclass of `SlotNode`: turns member declarations into slots.'''
+  def __new__(mcs, name, bases, ns):
+    declared = {}
+    for k, v in ns.items():
+      member = _as_member(v)
+      if member is not None:
+        declared[k] = member
+        del ns[k]
+
+    inherited = collections.OrderedDict()
+    for base in reversed(bases):
+      for k, member in getattr(base, '_node_decls', {}).iteritems():
+        inherited[k] = member
+
+    if '__slots__' not in ns:
+      ns['__slots__'] = tuple(sorted([k for k in declared if k not in inherited]))
+
+    cls = type.__new__(mcs, name, bases, ns)
+
+    decls = collections.OrderedDict(inherited)
+    for k in sorted(declared):
+      decls[k] = declared[k]
+    cls._node_decls = decls
+    cls._node_members = tuple(decls.keys())
+
+    # (name, default, copy default) for each member.
+    cls._node_defaults = tuple([(k, m.default, isinstance(m.default, (list, dict)))
+                                for k, m in decls.iteritems()])
+    return cls
+
+
+class SlotNode(object):
+  '''
+  A `Node` whose members are stored in slots.
+
+  Attributes which are not declared members may still be set; they are
+  kept in the instance dictionary.
+  '''
+  __metaclass__ = SlotNodeType
+  __slots__ = ('__dict__', '__weakref__')
+
+  def __init__(self, **kw):
+    for k, default, copy_default in self._node_defaults:
+      if k not in kw:
+        setattr(self, k, copy.copy(default) if copy_default else default)
+    for k, v in kw.iteritems():
+      setattr(self, k, v)
+
+  @property
+  def members(self):
+    return self._node_members
+
+  @property
+  def node_type(self):
+    return self.__class__.__name__
+
+  def debug_str(self):
+    return node_str(self)
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    for k in self._node_members:
+      state[k] = getattr(self, k)
+    return state
+
+  def __setstate__(self, state):
+    for k, v in state.iteritems():
+      setattr(self, k, v)
@@ -11,12 +11,16 @@ import collections
 import os
 import pickle
 import sys
+import thread
 import threading
 import time
 import traceback
 import types
 import weakref
+from multiprocessing.pool import ThreadPool
+import numpy as np
 from .. import cloudpickle, util, core
+from ..config import FLAGS, IntFlag
 from ..node import Node
 from . import serialization
 from traits.api import PythonValue
@@ -27,8 +31,17 @@ from ..core import RunKernelReq
 NO_RESULT = object()
 DEFAULT_TIMEOUT = 60
 WARN_THRESHOLD = 10
+# Arrays of at least this many bytes are sent as separate message frames
+# (without being copied) instead of being pickled with the message.
+OUT_OF_BAND_BYTES = 64 * 1024
+# Broadcasts of at least this many bytes are relayed through a tree of servers
+# (see `forall`).
+TREE_BROADCAST_BYTES = 1024 * 1024
 _rpc_id_generator = xrange(10000000).__iter__()
 
+FLAGS.add(IntFlag('broadcast_fanout', default=2,
+                  help='Number of hosts each relay forwards large broadcasts to (0 sends to every worker directly)'))
+
 def set_default_timeout(seconds):
   global DEFAULT_TIMEOUT
   DEFAULT_TIMEOUT = seconds
@@ -40,6 +53,16 @@ class RPCException(Node):
 class PickledData(Node):
     data = PythonValue
 
+class RelayReq(Node):
+    '''Run ``method`` with an encoded request, and forward it to ``tree``.'''
+    method = PythonValue
+    body = PythonValue
+    tree = PythonValue
+
+class RelayResp(Node):
+    '''The results from a relay server and every server in its subtree.'''
+    results = PythonValue
+
 def capture_exception(exc_info=None):
   if exc_info is None:
     exc_info = sys.exc_info()
@@ -49,17 +72,85 @@ def capture_exception(exc_info=None):
 class Group(tuple):
   pass
 
-def serialize_to(obj, writer):
+def _out_of_band_id(buffers):
+  '''
+  Return a ``persistent_id`` function which moves the data of large arrays
+  into ``buffers``; the pickle only records where to find them.
+
+  Dense arrays are appended as is (or as their transpose, for Fortran
+  ordered arrays).  Masked arrays are split into their data and mask;
+  sparse matrices are pickled normally, which moves their index and data
+  arrays.
+  '''
+  def persistent_id(obj):
+    t = type(obj)
+    if t is np.ndarray or t is np.memmap:
+      if obj.nbytes < OUT_OF_BAND_BYTES or obj.dtype.hasobject:
+        return None
+      if obj.flags.c_contiguous:
+        buffers.append(obj)
+        order = 'C'
+      elif obj.flags.f_contiguous:
+        buffers.append(obj.T)
+        order = 'F'
+      else:
+        buffers.append(np.ascontiguousarray(obj))
+        order = 'C'
+      return ('nd', len(buffers) - 1, obj.dtype, obj.shape, order)
+
+    if t is np.ma.MaskedArray:
+      if obj.nbytes < OUT_OF_BAND_BYTES:
+        return None
+      return ('ma', obj.data, np.ma.getmask(obj), obj.fill_value)
+
+    return None
+  return persistent_id
+
+def _out_of_band_load(frames):
+  '''
+  Return a ``persistent_load`` function which rebuilds arrays from ``frames``.
+
+  The arrays use the memory of the received frames directly.
+  '''
+  def persistent_load(pid):
+    if pid[0] == 'nd':
+      _, idx, dtype, shape, order = pid
+      if order == 'F':
+        return serialization_buffer.as_array(frames[idx], dtype, shape[::-1]).T
+      return serialization_buffer.as_array(frames[idx], dtype, shape)
+    if pid[0] == 'ma':
+      _, data, mask, fill_value = pid
+      return np.ma.MaskedArray(data, mask=mask, fill_value=fill_value)
+    raise cPickle.UnpicklingError('Unknown persistent id: %s' % (pid,))
+  return persistent_load
+
+def serialize_to(obj, writer, buffers=None):
+  '''
+  Pickle ``obj`` to ``writer``.
+
+  If ``buffers`` is a list, the data of large arrays in ``obj`` is appended
+  to it instead of being written to ``writer``.
+  '''
+  if buffers is None:
+    persistent_id = None
+  else:
+    persistent_id = _out_of_band_id(buffers)
+
   if isinstance(obj, RunKernelReq): 
-    cloudpickle.dump(obj, writer, -1)
+    cloudpickle.dump(obj, writer, -1, persistent_id)
     return
 
   pos = writer.tell()
   try:
-    cPickle.dump(obj, writer, -1)
+    pickler = cPickle.Pickler(writer, -1)
+    if persistent_id is not None:
+      pickler.inst_persistent_id = persistent_id
+    pickler.dump(obj)
   except (ImportError, pickle.PicklingError, PickleError, TypeError):
     writer.seek(pos)
-    cloudpickle.dump(obj, writer, -1)
+    if buffers is not None:
+      del buffers[:]
+    cloudpickle.dump(obj, writer, -1, persistent_id)
     
 def serialize(obj):
   if isinstance(obj, RunKernelReq): 
@@ -70,8 +161,50 @@ def serialize(obj):
   except (pickle.PicklingError, PickleError, TypeError):
     return cloudpickle.dumps(obj, -1)
     
-def read(f):
-  return cPickle.load(f)
+def read(f, frames=None):
+  '''
+  Unpickle an object from ``f``.
+
+  ``frames`` holds the out-of-band array data written by `serialize_to`.
+  '''
+  unpickler = cPickle.Unpickler(f)
+  if frames:
+    unpickler.persistent_load = _out_of_band_load(frames)
+  return unpickler.load()
+
+def encode_message(header, obj):
+  '''
+  Serialize ``header`` and ``obj`` into a message for sending.
+
+  Returns a string, or a `Group` of frames if large arrays are sent
+  out-of-band.
+  '''
+  w = serialization_buffer.Writer()
+  cPickle.dump(header, w, -1)
+  buffers = []
+  serialize_to(obj, w, buffers)
+  if buffers:
+    return Group([w.getvalue()] + buffers)
+  return w.getvalue()
+
+def encode_body(obj):
+  '''
+  Serialize ``obj`` without a header.
+
+  Returns a list of frames: the pickled object, followed by the data of
+  any large arrays.
+  '''
+  w = serialization_buffer.Writer()
+  buffers = []
+  serialize_to(obj, w, buffers)
+  return [w.getvalue()] + buffers
+
+def _with_header(header, body):
+  '''Prepend ``header`` to a body from `encode_body`, as for `encode_message`.'''
+  first = cPickle.dumps(header, -1) + body[0]
+  if len(body) > 1:
+    return Group([first] + list(body[1:]))
+  return first
 
 class PendingRequest(object):
   '''An outstanding RPC request on the server.
@@ -84,26 +217,36 @@ class PendingRequest(object):
     self.created = time.time()
     self.finished = False
     self.result = NO_RESULT
+    self._finished = thread.allocate_lock()
+    self._finished.acquire()
 
   def wait(self):
-    while self.result is NO_RESULT:
-      time.sleep(0.01)
-    return self.result
+    # Blocks until done() releases the lock.
+    with self._finished:
+      return self.result
   
   def exception(self):
     self.done(capture_exception())
 
   def done(self, result=None):
+    # a handler may fail after replying; only the first reply is sent.
+    if self.finished:
+      return
     self.finished = True
-    self.result = result
 
     assert self.socket is not None
     header = { 'rpc_id' : self.rpc_id }
-    
-    w = serialization_buffer.Writer()
-    cPickle.dump(header, w, -1)
-    serialize_to(result, w)
-    self.socket.send(w.getvalue())
+    try:
+      message = encode_message(header, result)
+    except:
+      util.log_info('Failed to encode reply.', exc_info=1)
+      result = capture_exception()
+      message = encode_message(header, result)
+
+    # waiters may only see the result once it has been encoded.
+    self.result = result
+    self._finished.release()
+    self.socket.send(message)
 
   def __del__(self):
     if not self.finished:
@@ -132,7 +275,33 @@ class RemoteException(Exception):
   def __str__(self):
     return repr(self)
 
+def _poll_until(poller, is_done, timeout, desc):
+  '''
+  Dispatch replies arriving on the sockets of ``poller`` (the calling
+  thread's poller) until ``is_done()`` is true.
+
+  Raises `TimeoutException` if nothing arrives for ``timeout`` seconds.
+  '''
+  while not is_done():
+    socks = poller.poll(timeout * 1000)
+    if not socks:
+      util.log_info('timed out!')
+      raise TimeoutException('Timed out on %s' % desc)
+
+    for fd, events in socks:
+      # Here we only care about read. We send message directly.
+      poller._sockets[fd].handle_read()
+
+
 class Future(object):
+  '''
+  The result of a request.
+
+  Replies to remote requests are read by the thread waiting for them, from
+  its own ``poller``.  Futures without a poller are completed directly by
+  the local handler (possibly from another thread), and block on a lock
+  until then.
+  '''
   def __init__(self, addr, rpc_id, timeout=None, poller=None):
     self.addr = addr
     self.rpc_id = rpc_id
@@ -142,26 +311,35 @@ class Future(object):
     if timeout is None:
       timeout = DEFAULT_TIMEOUT
     self._timeout = timeout 
+    if poller is None:
+      self._finished = thread.allocate_lock()
+      self._finished.acquire()
 
   def done(self, result=None):
-    self.have_result = True
     self.result = result
+    self.have_result = True
+    if self._poller is None:
+      self._finished.release()
+
+  def exception(self):
+    self.done(capture_exception())
 
   def __repr__(self):
     return 'Future(%s:%d)' % (self.addr, self.rpc_id)
   
-  def wait(self):
-    while not self.have_result:
-      socks = dict(self._poller.poll(self._timeout * 1000))
-      for fd, events in socks.iteritems():
-        # Here we only care about read. We send message directly.
-        self._poller._sockets[fd].handle_read()
-  
-      if len(socks) == 0:
-        # It means timeout.
-        util.log_info('timed out!')
-        raise TimeoutException('Timed out on remote call (%s %s)' % (self.addr, self.rpc_id))
+  def wait_quietly(self):
+    '''Wait for the result, without raising an exception if the call failed.'''
+    if not self.have_result:
+      if self._poller is None:
+        with self._finished:
+          pass
+      else:
+        _poll_until(self._poller, lambda: self.have_result, self._timeout,
+                    'remote call (%s %s)' % (self.addr, self.rpc_id))
+    return self.result
 
+  def wait(self):
+    self.wait_quietly()
     if isinstance(self.result, RPCException):
       raise RemoteException(self.result.py_exc)
     return self.result
@@ -181,6 +359,12 @@ class BroadcastFuture(object):
     self._timeout = timeout
 
   def done(self, result=None):
+    if isinstance(result, RelayResp):
+      # Results from a relay and its subtree.
+      for r in result.results:
+        self.done(r)
+      return
+
     self._n_jobs -= 1
     self.results.append(result)
     if self._n_jobs == 0:
@@ -190,16 +374,8 @@ class BroadcastFuture(object):
     return 'Future(%d) [%s]' % (self.rpc_id, self.elapsed_time())
   
   def wait(self):
-    while not self.have_all_results:
-      socks = dict(self._poller.poll(self._timeout * 1000))
-      for fd, events in socks.iteritems():
-        # Here we only care about read. We send message directly.
-        self._poller._sockets[fd].handle_read()
-      
-      if len(socks) == 0:
-        # It means timeout.
-        util.log_info('timed out!')
-        raise TimeoutException('Timed out on broadcast remote call (%s)' % (self.rpc_id,))
+    _poll_until(self._poller, lambda: self.have_all_results, self._timeout,
+                'broadcast remote call (%s)' % (self.rpc_id,))
     
     for result in self.results:
       if isinstance(result, RPCException):
@@ -225,7 +401,9 @@ class Server(object):
     self._methods = {}
     self._timers = collections.defaultdict(util.Timer)
     self._running = False
+    self._relay_threads = None
     self.register_method('diediedie', self._diediedie)
+    self.register_method('_relay', self._relay)
 
 
   def timings(self):
@@ -264,8 +442,8 @@ class Server(object):
     self._methods[name] = fn
 
   def handle_read(self, socket):
-    data = socket.recv()
-    reader = serialization_buffer.Reader(data)
+    frames = socket.recv()
+    reader = serialization_buffer.Reader(frames[0])
     header = cPickle.load(reader)
     
     handle = PendingRequest(socket, header['rpc_id'])
@@ -278,13 +456,60 @@ class Server(object):
       return
 
     try:
-      req = read(reader)
+      req = read(reader, frames[1:])
       result = fn(req, handle)
       assert result is None, 'non-None result from RPC handler (use handle.done())'
     except:
       util.log_info('Caught exception in handler.', exc_info=1)
       handle.exception()
   
+  def _relay(self, req, handle):
+    # Relays wait for their subtree, so they can't run on the poll thread.
+    if self._relay_threads is None:
+      self._relay_threads = ThreadPool(processes=4)
+    self._relay_threads.apply_async(self._run_relay, args=(req, handle))
+
+  def _run_relay(self, req, handle):
+    '''
+    Forward a broadcast to the subtree ``req.tree``, then run it locally.
+
+    Replies with a `RelayResp` holding one result for this server and
+    for each server in the subtree.
+    '''
+    try:
+      fgroup = None
+      if req.tree:
+        rpc_id = _rpc_id_generator.next()
+        fgroup = BroadcastFuture(rpc_id, _tree_size(req.tree),
+                                 poller=_relay_client(req.tree[0][0])._socket._poller)
+        _send_tree(_relay_client, req.method, rpc_id, req.body, req.tree, fgroup)
+
+      local = Future(self.addr, -1)
+      try:
+        self._methods[req.method](read(serialization_buffer.Reader(req.body[0]), req.body[1:]), local)
+      except:
+        util.log_info('Caught exception in handler.', exc_info=1)
+        if not local.have_result:
+          local.exception()
+
+      local.wait_quietly()
+      results = [local.result]
+      if fgroup is not None:
+        try:
+          fgroup.wait()
+        except RemoteException:
+          pass
+        except TimeoutException:
+          exc = capture_exception()
+          while not fgroup.have_all_results:
+            fgroup.done(exc)
+        results.extend(fgroup.results)
+    except:
+      util.log_info('Caught exception in relay.', exc_info=1)
+      results = [capture_exception()] * (1 + _tree_size(req.tree))
+
+    handle.done(RelayResp(results=results))
+
   def shutdown(self):
     util.log_debug('Server going down...')
     self._socket._event_loop.stop()
@@ -311,14 +536,14 @@ class Client(object):
     rpc_id = _rpc_id_generator.next()
     header = { 'method' : method, 'rpc_id' : rpc_id }
 
-    w = serialization_buffer.Writer()
-    cPickle.dump(header, w, -1)
     if isinstance(request, PickledData):
+      w = serialization_buffer.Writer()
+      cPickle.dump(header, w, -1)
       w.write(request.data)
+      data = w.getvalue()
     else:
-      serialize_to(request, w)
+      data = encode_message(header, request)
 
-    data = w.getvalue()
     f = Future(self.addr(), rpc_id, timeout, self._socket._poller)
     self._futures[rpc_id] = f
     self._socket.send(data)
@@ -340,15 +565,64 @@ class Client(object):
   def __getattr__(self, method_name):
     return ProxyMethod(self, method_name)
 
-  def handle_read(self, data):
-    reader = serialization_buffer.Reader(data)
+  def handle_read(self, frames):
+    reader = serialization_buffer.Reader(frames[0])
     header = cPickle.load(reader)
-    resp = read(reader)
+    resp = read(reader, frames[1:])
     rpc_id = header['rpc_id']
     f = self._futures[rpc_id]
     f.done(resp)
     del self._futures[rpc_id]
 
+def _tree_size(tree):
+  return sum(1 + _tree_size(children) for addr, children in tree)
+
+def broadcast_tree(addrs, fanout):
+  '''
+  Arrange the servers at ``addrs`` into a forest for relaying a broadcast.
+
+  One server per host relays to the others on that host, and these relays
+  form a ``fanout``-ary tree.
+
+  Returns a list of (addr, children) pairs, where ``children`` is a list
+  of the same form.  The sender sends to each root.
+  '''
+  by_host = collections.OrderedDict()
+  for addr in addrs:
+    by_host.setdefault(addr[0], []).append(addr)
+
+  hosts = [(local[0], [(addr, []) for addr in local[1:]]) for local in by_host.itervalues()]
+
+  def subtree(i):
+    addr, children = hosts[i]
+    first = fanout * (i + 1)
+    return (addr, children + [subtree(j) for j in range(first, min(first + fanout, len(hosts)))])
+
+  return [subtree(i) for i in range(min(fanout, len(hosts)))]
+
+def _send_tree(client_for, method, rpc_id, body, tree, future):
+  '''
+  Send the request ``body`` to the roots of ``tree``, asking each to relay
+  it to its subtree.
+  '''
+  direct = None
+  for addr, children in tree:
+    if children:
+      header = { 'method' : '_relay', 'rpc_id' : rpc_id }
+      data = encode_message(header, RelayReq(method=method, body=body, tree=children))
+    else:
+      if direct is None:
+        direct = _with_header({ 'method' : method, 'rpc_id' : rpc_id }, body)
+      data = direct
+    client_for(addr).send_raw(data=data, future=future)
+
+_relay_clients = {}
+
+def _relay_client(addr):
+  if addr not in _relay_clients:
+    _relay_clients[addr] = ThreadLocalClient(*addr)
+  return _relay_clients[addr]
+
 def forall(clients, method, request, timeout=None):
   ''' 
   Invoke ``method`` with ``request`` for each client in ``clients``
@@ -357,6 +631,9 @@ def forall(clients, method, request, timeout=None):
   future object, so this is more efficient when targeting multiple workers 
   with the same data.
 
+  Large requests are sent to a few servers, which relay them to the others
+  (see `broadcast_tree`), so the sender transmits them only a few times.
+
   Returns a BroadcastFuture wrapping all of the requests. 
  
   '''  
@@ -369,12 +646,18 @@ def forall(clients, method, request, timeout=None):
 
   with TIMER.serial_once:
     # Only serialize the header and body once for all the clients.
-    header = { 'method' : method, 'rpc_id' : rpc_id }
-    w = serialization_buffer.Writer()
-    cPickle.dump(header, w, -1)
-    serialize_to(request, w)
-    data = w.getvalue()
-  
+    body = encode_body(request)
+
+  nbytes = sum(len(frame) if isinstance(frame, str) else frame.nbytes for frame in body)
+  if FLAGS.broadcast_fanout > 0 and n_jobs > FLAGS.broadcast_fanout and \
+     nbytes >= TREE_BROADCAST_BYTES and all(hasattr(c, 'host') for c in clients):
+    by_addr = dict(((c.host, c.port), c) for c in clients)
+    tree = broadcast_tree([(c.host, c.port) for c in clients], FLAGS.broadcast_fanout)
+    with TIMER.master_loop:
+      _send_tree(by_addr.get, method, rpc_id, body, tree, fgroup)
+    return fgroup
+
+  data = _with_header({ 'method' : method, 'rpc_id' : rpc_id }, body)
   with TIMER.master_loop:
     for c in clients:
       c.send_raw(data=data, future=fgroup)
@@ -11,6 +11,8 @@ ctypedef unsigned char byte
 cdef extern from "Python.h":
   void PyBuffer_Release(Py_buffer*)
 
+N.import_array()
+
 cdef Py_buffer get_buffer(object o):
   cdef Py_buffer b
   if buffer.PyObject_GetBuffer(o, &b, buffer.PyBUF_SIMPLE) != 0:
@@ -139,4 +141,18 @@ cdef class Reader:
     return self.pos
 
   cpdef seek(self, int pos):
-    self.pos = pos
\ No newline at end of file
+    self.pos = pos
+
+
+cpdef N.ndarray as_array(object v, dtype, shape):
+  '''
+  Return a writable array of ``dtype`` and ``shape`` viewing the memory of ``v``.
+
+  ``v`` is kept alive by the array.  This lets array data be used directly
+  from a received (read-only) ZeroMQ frame, without a copy.
+  '''
+  cdef Buffer buf = Buffer(v)
+  cdef N.npy_intp size = buf.size()
+  cdef N.ndarray arr = N.PyArray_SimpleNewFromData(1, &size, N.NPY_UINT8, buf.data())
+  N.set_array_base(arr, buf)
+  return arr.view(dtype).reshape(shape)
@@ -50,35 +50,36 @@ class ZMQServerLoop(object):
     self.profiler = None
 
   def start(self):
-    MAX_TIMEOUT = 10 
     self._running = True
     # Record which thread this loop is running on. The Server Socket can check this
     # to decide what to do.
     self._running_thread = threading.current_thread()
-    _poll_time = 1
     _poll = self._poller.poll
     socket = self._socket 
+    direction = self._direction
     
     if self.profiler is not None:
       self.profiler.enable()
     
+    # Block until the socket is readable or another thread wakes us up to
+    # send queued messages; there is no polling timeout.
     while self._running:
-      socks = dict(_poll())
-      if len(socks) == 0:
-        _poll_time = min(_poll_time * 2, MAX_TIMEOUT)
-      else:
-        _poll_time = 1 
-
-      for fd, event in socks.iteritems():
+      for fd, event in _poll():
         if fd == self._pipe[0]:
           os.read(fd, 10000)
+          # Woken up by another thread: send its messages right away rather
+          # than waiting for the next poll to report the socket as writable.
+          socket.handle_write()
           continue
         
         if event & zmq.POLLIN: 
           socket.handle_read()
         if event & zmq.POLLOUT: 
           socket.handle_write()
-      self._poller.register(socket.zmq(), self._direction)
+
+      if self._direction != direction:
+        direction = self._direction
+        self._poller.register(socket.zmq(), direction)
     
     # Close serversocket after the loop ends.
     self._socket.close()
@@ -93,10 +94,15 @@ class ZMQServerLoop(object):
 
   def modify(self, direction):
     self._direction = direction
-    self.wakeup()
+    if threading.current_thread() != self._running_thread:
+      self.wakeup()
 
   def wakeup(self):
-    os.write(self._pipe[1], 'x')
+    try:
+      os.write(self._pipe[1], 'x')
+    except OSError:
+      # The pipe is full, so a wakeup is already pending.
+      pass
 
 class Socket(object):
   def __init__(self, ctx, sock_type, hostport, poller=None):
@@ -137,8 +143,8 @@ class Socket(object):
     self._handler = handler
   
   def handle_read(self):
-    data = self._zmq.recv()
-    self._handler(data)
+    frames = self._zmq.recv_multipart(copy=False)
+    self._handler(frames)
 
 class ServerSocket(Socket):
   ''' ServerSocket use its own loop and use its own handle_read/handle_write functions. '''
@@ -172,10 +178,16 @@ class ServerSocket(Socket):
     with self._out_lock:
       while self._out:
         msg = self._out.popleft()
-        if isinstance(msg, Group):
-          self._zmq.send_multipart(msg, copy=False)
-        else:
-          self._zmq.send(msg, copy=False)
+        try:
+          if isinstance(msg, Group):
+            self._zmq.send_multipart(msg, copy=False, flags=zmq.NOBLOCK)
+          else:
+            self._zmq.send(msg, copy=False, flags=zmq.NOBLOCK)
+        except zmq.Again:
+          # Wait until the socket is writable to send the rest.
+          self._out.appendleft(msg)
+          self._event_loop.modify(zmq.POLLIN | zmq.POLLOUT)
+          return
       self._event_loop.modify(zmq.POLLIN)
 
   def send(self, msg):
@@ -190,7 +202,7 @@ class ServerSocket(Socket):
     else: 
       with self._out_lock:
         self._out.append(msg)
-        self._event_loop.modify(zmq.POLLIN | zmq.POLLOUT)
+      self._event_loop.wakeup()
 
   def bind(self):
     host, port = self.addr
@@ -218,8 +230,8 @@ class StubSocket(object):
     self.source = source
     self.socket = socket
     assert isinstance(data, list)
-    assert len(data) == 1
-    self.data = data[0]
+    assert len(data) >= 1
+    self.data = data
 
   @property
   def addr(self):
@@ -13,6 +13,8 @@ master cannot be contacted for a sufficiently long interval, workers
 shut themselves down.   
 '''
 
+import collections
+import mmap
 import multiprocessing
 from multiprocessing.pool import ThreadPool
 import os
@@ -22,7 +24,8 @@ import sys
 import threading
 import time
 
-from . import config, util, rpc, core, blob_ctx
+from . import config, util, rpc, core, blob_ctx, kernel_cache
+from .array import tile, tile_store, fetch_cache, buffer_pool
 from .config import FLAGS, StrFlag, IntFlag, BoolFlag
 from .rpc import zeromq, TimeoutException, rlock
 from .util import Assert
@@ -34,6 +37,60 @@ import numpy as np
 #timeout for hearbeat messsage
 HEARTBEAT_TIMEOUT=1000000
 _init_lock = rlock.FastRLock()
+SHARED_ID_COUNTER = iter(xrange(100000000))
+
+def _read_tile(blob, subslice):
+  '''
+  Read ``subslice`` of ``blob`` (or the whole tile) for a reply.
+
+  Large arrays are sent from their own memory after the reply is queued
+  (see `rpc.serialize_to`), so data shared with the tile is copied:
+  an update applied in the meantime would otherwise be sent half-applied.
+  '''
+  if subslice is None:
+    return blob.copy()
+
+  data = blob.get(subslice)
+  if isinstance(data, np.ndarray):
+    if isinstance(blob.data, np.ndarray) and np.may_share_memory(data, blob.data):
+      return data.copy()
+  elif data is blob.data:
+    return data.copy()
+  return data
+
+
+def _read_flat(blob, subslice):
+  '''Return a copy of ``subslice`` of the flattened data of ``blob``.'''
+  if blob.is_constant():
+    data = blob.get(tuple([slice(0, n) for n in blob.shape]))
+  else:
+    data = blob.data
+  if subslice is None:
+    return data.flatten()
+  # flatten copies, so the result doesn't share memory with the tile.
+  return data.flatten()[subslice]
+
+
+# Seconds a shared memory file is kept after its tile is changed or
+# destroyed, so workers which were sent it before can still map it.
+SHARED_FILE_GRACE = 60
+
+FLAGS.add(IntFlag('kernel_threads', default=1,
+                  help='Number of tiles a worker runs concurrently for a single kernel'))
+FLAGS.add(IntFlag('concurrent_kernels', default=1,
+                  help='Number of kernels a worker runs at once, and of independent expressions the master evaluates at once'))
+FLAGS.add(IntFlag('worker_memory_budget', default=0,
+                  help='Megabytes of tile data a worker keeps in memory before spilling tiles to disk (0 disables spilling)'))
+FLAGS.add(StrFlag('spill_dir', default='/tmp/spartan/spill/',
+                  help='Directory for tiles spilled to disk by workers'))
+FLAGS.add(StrFlag('shared_memory_dir', default='/dev/shm',
+                  help='Directory for tiles shared with workers on the same host'))
+FLAGS.add(IntFlag('tile_lock_stripes', default=64,
+                  help='Number of locks guarding tile updates on each worker'))
+FLAGS.add(IntFlag('prefetch_depth', default=2,
+                  help='Number of tiles ahead of the running one whose remote inputs are fetched (0 disables)'))
+FLAGS.add(IntFlag('prefetch_memory', default=64,
+                  help='MB of remote kernel inputs each tile slot fetches ahead of use'))
 
 class Worker(object):
   '''
@@ -45,7 +102,14 @@ class Worker(object):
   Attributes:
       id (int): The unique identifier for this worker
       _peers (dict): Mapping from worker id to RPC client
-      _blobs (dict): Mapping from tile id to tile.
+      _blobs (TileStore): Mapping from tile id to tile.
+      _shared_tiles (dict): Mapping from tile id to (path, data) for tiles
+        exported to shared memory.
+      _retired_files (deque): (time, path) of shared memory files no longer
+        exported, removed after `SHARED_FILE_GRACE` seconds.
+      _lock: Guards the lists of tiles remaining in the running kernels.
+      _tile_locks (list): Striped locks guarding changes to tiles; a tile is
+        guarded by the lock picked by `_tile_lock`.
   '''
   def __init__(self, master):
     # Reseed the Numpy random number state.
@@ -57,7 +121,16 @@ class Worker(object):
     self.id = -1
     self._initialized = False
     self._peers = {}
-    self._blobs = {}
+    self._tile_locks = [rlock.FastRLock() for i in range(max(FLAGS.tile_lock_stripes, 1))]
+    self._blobs = tile_store.TileStore(FLAGS.worker_memory_budget * 1024 * 1024,
+                                       FLAGS.spill_dir,
+                                       tile_lock=self._tile_lock)
+    self._shared_tiles = {}
+    self._retired_files = collections.deque()
+    self._retired_lock = threading.Lock()
+    self._kernel_cache = kernel_cache.KernelCache(FLAGS.kernel_cache_size)
+    self._fetch_cache = fetch_cache.FetchCache(FLAGS.fetch_cache_size * 1024 * 1024)
+    self._buffer_pool = buffer_pool.BufferPool(FLAGS.buffer_pool_size * 1024 * 1024)
     self._master = master
     self._running = True
     self._ctx = None
@@ -74,8 +147,19 @@ class Worker(object):
     if not hasattr(threading.current_thread(), "_children"):
       threading.current_thread()._children = weakref.WeakKeyDictionary()
     
-    self._kernel_threads = ThreadPool(processes=1)
-    self._kernel_remain_tiles = []
+    num_kernels = max(FLAGS.concurrent_kernels, 1)
+    self._kernel_threads = ThreadPool(processes=num_kernels)
+    # The tiles not yet started by each running kernel; guarded by _lock.
+    self._running_kernels = []
+
+    # Tile slots used to run the tiles of a kernel concurrently.  The threads
+    # are kept alive between kernels, as each thread holds its own set of
+    # RPC client sockets.
+    self._num_tile_slots = max(FLAGS.kernel_threads, 1)
+    if self._num_tile_slots > 1:
+      self._tile_threads = ThreadPool(processes=self._num_tile_slots * num_kernels)
+    else:
+      self._tile_threads = None
     
     if FLAGS.profile_worker:
       import yappi
@@ -118,7 +202,8 @@ class Worker(object):
     self._peers[blob_ctx.MASTER_ID] = self._master
     
     self.id = req.id
-    self._ctx = blob_ctx.BlobCtx(self.id, self._peers, self)
+    self._ctx = blob_ctx.BlobCtx(self.id, self._peers, self, fetch_cache=self._fetch_cache,
+                                 buffer_pool=self._buffer_pool)
     blob_ctx.set(self._ctx)
     self._initialized = True
     handle.done()
@@ -131,20 +216,46 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
-    with self._lock:
-      assert self._initialized
-      #util.log_info('Creating: %s', req.tile_id)
-      Assert.eq(req.tile_id.worker, self.id)
-  
-      if req.tile_id.id == -1:
-        id = self._ctx.new_tile_id()
-      else:
-        id = req.tile_id
+    assert self._initialized
+    #util.log_info('Creating: %s', req.tile_id)
+    Assert.eq(req.tile_id.worker, self.id)
+
+    if req.tile_id.id == -1:
+      id = self._ctx.new_tile_id()
+    else:
+      id = req.tile_id
+    with self._tile_lock(id):
       self._blobs[id] = req.data
 
     resp = core.TileIdMessage(tile_id=id)
     handle.done(resp)
 
+  def create_many(self, req, handle):
+    '''
+    Create several empty tiles.
+
+    :param req: `MultiCreateReq`
+    :param handle: `PendingRequest`
+
+    '''
+    tile_ids = []
+    assert self._initialized
+    for shape, dtype, tile_type, fill_value in req.descriptors:
+      id = self._ctx.new_tile_id()
+      if fill_value is None:
+        t = tile.from_shape(shape, dtype, tile_type=tile_type)
+      else:
+        t = tile.from_constant(shape, dtype, fill_value)
+      with self._tile_lock(id):
+        self._blobs[id] = t
+      tile_ids.append(id)
+
+    handle.done(core.MultiCreateResp(tile_ids=tile_ids))
+
+  def _tile_lock(self, tile_id):
+    '''Return the lock guarding changes to ``tile_id``.'''
+    return self._tile_locks[hash(tile_id) % len(self._tile_locks)]
+
   def tile_op(self, req, handle):
     resp = core.RunKernelResp(result=req.fn(self._blobs[req.tile_id]))
     handle.done(resp)
@@ -157,13 +268,20 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
-    with self._lock:
-      for id in req.ids:
+    for id in req.ids:
+      with self._tile_lock(id):
         if id in self._blobs:
-          blob = self._blobs[id]
+          blob = self._blobs.peek(id)
           blob.refcnt -= 1
           if blob.refcnt == 0:
             del self._blobs[id]
+            self._unshare_tile(id)
+            # the tile is gone, so its buffer (if the pool handed it out)
+            # can be reused for a new tile.
+            data = blob.data
+            del blob
+            self._buffer_pool.recycle(data)
+            del data
           #util.log_info('Destroyed blob %s', id)
 
     #util.log_info('Destroy...')
@@ -178,12 +296,29 @@ class Worker(object):
     
     '''
     #util.log_info('W%d Update: %s', self.id, req.id)
-    with self._lock:
+    with self._tile_lock(req.id):
       blob =  self._blobs[req.id]
+      self._detach_shared(req.id, blob)
       self._blobs[req.id] = blob.update(req.region, req.data, req.reducer)
     
     handle.done()
 
+  def multi_update(self, req, handle):
+    '''
+    Apply several updates to tiles held by this worker.
+
+    :param req: `MultiUpdateReq`
+    :param handle: `PendingRequest`
+
+    '''
+    for update in req.updates:
+      with self._tile_lock(update.id):
+        blob = self._blobs[update.id]
+        self._detach_shared(update.id, blob)
+        self._blobs[update.id] = blob.update(update.region, update.data, update.reducer)
+
+    handle.done()
+
   def get(self, req, handle):
     '''
     Fetch a portion of a tile.
@@ -192,13 +327,98 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
-    if req.subslice is None:
-      #util.log_info('GET: %s', type(self._blobs[req.id]))
-      resp = core.GetResp(data=self._blobs[req.id])
-      handle.done(resp)
-    else:
-      resp = core.GetResp(data=self._blobs[req.id].get(req.subslice))
-      handle.done(resp)
+    #util.log_info('GET: %s', type(self._blobs[req.id]))
+    with self._tile_lock(req.id):
+      data = _read_tile(self._blobs[req.id], req.subslice)
+    handle.done(core.GetResp(data=data))
+
+  def get_shared(self, req, handle):
+    '''
+    Fetch a portion of a tile for a worker on the same host.
+
+    The tile data is moved to a shared memory file (the first time it is
+    requested), and the location of the file is returned instead of the data.
+    The caller maps the file, so no data is copied; updates are still
+    applied by this worker, to a private copy of the data (see
+    `_detach_shared`), so callers keep the data as it was when fetched.  Tiles that can't be shared (sparse, scalar or
+    partially initialized tiles) are returned as for `get`.
+
+    :param req: `GetReq`
+    :param handle: `PendingRequest`
+
+    '''
+    with self._tile_lock(req.id):
+      blob = self._blobs[req.id]
+      path = self._share_tile(req.id, blob)
+      if path is None:
+        resp = core.GetResp(data=_read_tile(blob, req.subslice))
+      else:
+        resp = core.SharedTileResp(path=path, shape=blob.data.shape,
+                                   dtype=blob.data.dtype, subslice=req.subslice)
+    handle.done(resp)
+
+  def _share_tile(self, tile_id, blob):
+    '''
+    Move the data of ``blob`` to a shared memory file.
+
+    :rtype: Path of the shared memory file, or None if the tile can't be shared.
+    '''
+    data = blob.data
+    if tile_id in self._shared_tiles:
+      path, shared = self._shared_tiles[tile_id]
+      if shared is data:
+        return path
+      # The tile data has been replaced by an update; export the new data.
+      self._unshare_tile(tile_id)
+
+    if blob.type != tile.TYPE_DENSE or not isinstance(data, np.ndarray) or \
+       len(data.shape) == 0 or data.nbytes == 0 or data.dtype.hasobject:
+      return None
+
+    if not blob.all_valid():
+      return None
+
+    path = os.path.join(FLAGS.shared_memory_dir,
+                        'spartan-%d-%d' % (os.getpid(), SHARED_ID_COUNTER.next()))
+    with open(path, 'w+b') as f:
+      f.truncate(data.nbytes)
+      buf = mmap.mmap(f.fileno(), data.nbytes)
+
+    shared = np.frombuffer(buf, dtype=data.dtype).reshape(data.shape)
+    shared[...] = data
+    blob.data = shared
+    self._shared_tiles[tile_id] = (path, shared)
+    return path
+
+  def _detach_shared(self, tile_id, blob):
+    '''
+    Stop exporting ``blob`` before it is updated.
+
+    Readers map the file copy-on-write, and see any page they haven't
+    written themselves change with the file; the owner moves its data to a
+    private copy so updates aren't written to the file.
+    '''
+    if tile_id in self._shared_tiles:
+      _, shared = self._shared_tiles[tile_id]
+      if blob.data is shared:
+        blob.data = np.array(shared)
+      self._unshare_tile(tile_id)
+
+  def _unshare_tile(self, tile_id):
+    '''Stop exporting ``tile_id``; its file is removed once readers had time to map it.'''
+    if tile_id in self._shared_tiles:
+      path, _ = self._shared_tiles.pop(tile_id)
+      with self._retired_lock:
+        self._retired_files.append((time.time(), path))
+
+  def _remove_retired_files(self, force=False):
+    '''Remove the shared memory files retired more than `SHARED_FILE_GRACE` seconds ago.'''
+    now = time.time()
+    with self._retired_lock:
+      while self._retired_files and \
+            (force or now - self._retired_files[0][0] > SHARED_FILE_GRACE):
+        _, path = self._retired_files.popleft()
+        os.unlink(path)
 
   def get_flatten(self, req, handle):
     '''
@@ -208,13 +428,38 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
-    if req.subslice is None:
+    with self._tile_lock(req.id):
       #util.log_info('GET: %s', type(self._blobs[req.id]))
-      resp = core.GetResp(data=self._blobs[req.id].data.flatten())
-      handle.done(resp)
-    else:
-      resp = core.GetResp(data=self._blobs[req.id].data.flatten()[req.subslice])
-      handle.done(resp)
+      data = _read_flat(self._blobs[req.id], req.subslice)
+    handle.done(core.GetResp(data=data))
+
+  def multi_get(self, req, handle):
+    '''
+    Fetch portions of several tiles in one request.
+
+    :param req: `MultiGetReq`
+    :param handle: `PendingRequest`
+
+    '''
+    data = []
+    for tile_id, subslice in zip(req.ids, req.subslices):
+      with self._tile_lock(tile_id):
+        data.append(_read_tile(self._blobs[tile_id], subslice))
+    handle.done(core.MultiGetResp(data=data))
+
+  def multi_get_flatten(self, req, handle):
+    '''
+    Fetch flatten portions of the flatten format of several tiles in one request.
+
+    :param req: `MultiGetReq`
+    :param handle: `PendingRequest`
+
+    '''
+    data = []
+    for tile_id, subslice in zip(req.ids, req.subslices):
+      with self._tile_lock(tile_id):
+        data.append(_read_flat(self._blobs[tile_id], subslice))
+    handle.done(core.MultiGetResp(data=data))
 
   def cancel_tile(self, req, handle):
     '''
@@ -223,11 +468,97 @@ class Worker(object):
     :param req: `TileIdMessage`
     :param handle: `PendingRequest`
     '''
+    with self._lock:
+      for remain in self._running_kernels:
+        if req.tile_id in remain:
+          remain.remove(req.tile_id)
+          handle.done(True)
+          return
+    handle.done(False)
+
+  def _remain_tiles(self):
+    '''Return the tiles of all running kernels which haven't been started.'''
+    with self._lock:
+      return [tile_id for remain in self._running_kernels for tile_id in remain]
+
+  def _run_tiles(self, req, remain, updated, kernel):
+    '''
+    Run ``req.mapper_fn`` over tiles from ``remain`` until it is empty.
+
+    This is run by each tile slot; all slots of a kernel share its remain
+    tile list, so tiles are handed out to whichever slot is free first.
+
+    :param req: `KernelReq`
+    :param remain: list of the kernel's tiles which haven't been started.
+    :param updated: set of the identities of the arrays the kernel updated.
+    :param kernel: Token the kernel's fetched regions are cached under.
+    :rtype: dict mapping from tile id to the result of ``req.mapper_fn``
+    '''
+    blob_ctx.set(self._ctx)
+    self._ctx.track_updates(updated)
+    self._fetch_cache.set_kernel(kernel)
+    results = {}
+    futures = []
+
+    # Tiles taken by this slot, whose remote inputs are being fetched while
+    # the tile before them runs.
+    prefetch = getattr(req.mapper_fn, 'prefetch', None)
+    depth = FLAGS.prefetch_depth if prefetch is not None else 0
+    budget = FLAGS.prefetch_memory * 1024 * 1024
+    ahead = collections.deque()
+    ahead_bytes = 0
+
+    # Updates made by kernels are combined and sent once all tiles are done.
+    self._ctx.buffer_updates()
     try:
-      self._kernel_remain_tiles.remove(req.tile_id)
-      handle.done(True)
-    except:
-      handle.done(False)
+      while True:
+        while len(ahead) <= depth and (not ahead or ahead_bytes < budget):
+          with self._lock:
+            if len(remain) == 0:
+              break
+            tile_id = remain.pop()
+          nbytes = 0
+          if depth > 0:
+            nbytes = self._prefetch(req, prefetch, tile_id)
+          ahead.append((tile_id, nbytes))
+          ahead_bytes += nbytes
+
+        if not ahead:
+          break
+        tile_id, nbytes = ahead.popleft()
+        ahead_bytes -= nbytes
+
+        blob = self._blobs[tile_id]
+        map_result = req.mapper_fn(tile_id, blob, **req.kw)
+        results[tile_id] = map_result.result
+
+        if map_result.futures is not None:
+          futures.append(map_result.futures)
+    finally:
+      self._ctx.drop_prefetches()
+      self._ctx.track_updates(None)
+      self._fetch_cache.set_kernel(None)
+      futures.append(self._ctx.flush_updates())
+
+    # Futures are bound to the poller of the thread that created them, so
+    # the update operations have to be waited for from this slot.
+    rpc.wait_for_all(futures)
+    return results
+
+  def _prefetch(self, req, prefetch, tile_id):
+    '''
+    Start fetching the remote inputs of ``tile_id`` for ``req``.
+
+    Prefetching is only an optimization: failures are logged, and the
+    inputs are fetched again when the tile runs.
+
+    :rtype: The number of bytes being fetched.
+    '''
+    try:
+      return prefetch(tile_id, self._blobs.peek(tile_id), **req.kw)
+    except Exception:
+      util.log_debug('Prefetch for tile %s failed', tile_id, exc_info=1)
+      return 0
 
   def _run_kernel(self, req, handle):
     '''
@@ -240,42 +571,42 @@ class Worker(object):
     
     '''
     start_time = time.time()
-    futures = []
     original_tile_id_set = set(self._blobs.iterkeys())
+    remain = []
+    updated = set()
+    kernel = object()
     try:
       blob_ctx.set(self._ctx)
-      results = {}
-      for tile_id in req.blobs:
-        if tile_id.worker == self.id:
-          self._kernel_remain_tiles.append(tile_id)
-    
-      # sort all tiles
-      self._kernel_remain_tiles.sort(key=lambda x: np.size(self._blobs[x].data))
+      with self._lock:
+        for tile_id in req.blobs:
+          if tile_id.worker == self.id:
+            remain.append(tile_id)
       
-      while len(self._kernel_remain_tiles) > 0:
-        tile_id = self._kernel_remain_tiles.pop()
+        # sort all tiles
+        remain.sort(key=lambda x: np.size(self._blobs.peek(x).data))
+        self._running_kernels.append(remain)
 
-        blob = self._blobs[tile_id]
-        map_result = req.mapper_fn(tile_id, blob, **req.kw)
-        results[tile_id] = map_result.result
-          
-        if map_result.futures is not None:
-          futures.append(map_result.futures)
-      
-      # wait for all kernel update operations to finish
-      rpc.wait_for_all(futures) 
+      if self._tile_threads is None:
+        results = self._run_tiles(req, remain, updated, kernel)
+      else:
+        slots = [self._tile_threads.apply_async(self._run_tiles, args=(req, remain, updated, kernel))
+                 for i in range(self._num_tile_slots)]
+        results = {}
+        for slot in slots:
+          results.update(slot.get())
       
       # We've finished processing our local set of tiles.  
       # If we are load balancing, check with the master if it's possible to steal
       # a tile from another worker.
       if FLAGS.load_balance:
+        self._ctx.track_updates(updated)
+        self._fetch_cache.set_kernel(kernel)
         tile_id = self._ctx.maybe_steal_tile(None, None).tile_id
         while tile_id is not None:
           blob = self._ctx.get(tile_id, None)
           map_result = req.mapper_fn(tile_id, blob, **req.kw)
-          with self._lock:
-            id = self._ctx.new_tile_id()
-            self._blobs[id] = blob
+          id = self._ctx.new_tile_id()
+          self._blobs[id] = blob
           results[id] = map_result.result
           if map_result.futures is not None:
             rpc.wait_for_all(map_result.futures)
@@ -290,16 +621,23 @@ class Worker(object):
           for _blob in result[1]:
             result_tile_id_set.add(_blob[1])
 
-      with self._lock:
-        for tile_id in result_tile_id_set.intersection(original_tile_id_set):
-          self._blobs[tile_id].refcnt += 1
+      for tile_id in result_tile_id_set.intersection(original_tile_id_set):
+        with self._tile_lock(tile_id):
+          self._blobs.peek(tile_id).refcnt += 1
 
       finish_time = time.time()
-      handle.done(results)
+      handle.done(core.RunKernelResp(result=results, updated=updated))
     except:
       util.log_warn('Exception occurred during kernel call', exc_info=1)
       self.worker_status.add_task_failure(req)
       handle.exception()
+    finally:
+      self._ctx.track_updates(None)
+      self._fetch_cache.set_kernel(None)
+      with self._lock:
+        self._running_kernels = [r for r in self._running_kernels if r is not remain]
+      self._fetch_cache.end_kernel(kernel)
+      self._buffer_pool.log_stats()
       
     util.log_debug('worker(%s) kernel run time:%s', self.id, finish_time - start_time)
      
@@ -311,6 +649,19 @@ class Worker(object):
     :param handle: `PendingRequest`
     
     '''
+    # Skeletons are decoded here, in the order they arrive, so the kernel
+    # cache evicts objects in the order the master's encoder expects.
+    if req.skeleton is not None:
+      blob_ctx.set(self._ctx)
+      try:
+        req.mapper_fn, req.kw = self._kernel_cache.load(req.skeleton, req.uploads)
+      except kernel_cache.CacheMiss:
+        handle.done(core.KernelCacheMissResp(worker_id=self.id))
+        return
+      except:
+        util.log_warn('Exception occurred decoding kernel', exc_info=1)
+        handle.exception()
+        return
     #threading.Thread(target=self._run_kernel, args=(req, handle)).start()
     self._kernel_threads.apply_async(self._run_kernel, args=(req, handle))
       
@@ -343,6 +694,11 @@ class Worker(object):
     time.sleep(0.1)
     self._running = False
     self._server.shutdown()
+    with self._lock:
+      self._blobs.clear()
+      for tile_id in self._shared_tiles.keys():
+        self._unshare_tile(tile_id)
+    self._remove_retired_files(force=True)
   
   def wait_for_shutdown(self):
     '''
@@ -357,7 +713,9 @@ class Worker(object):
         time.sleep(0.1)
         continue
       
-      self.worker_status.update_status(psutil.virtual_memory().percent, psutil.cpu_percent(), now, self._kernel_remain_tiles)
+      self.worker_status.update_status(psutil.virtual_memory().percent, psutil.cpu_percent(), now, self._remain_tiles())
+      self.worker_status.update_spill_status(*self._blobs.stats())
+      self._remove_retired_files()
       future = self._ctx.heartbeat(self.worker_status, HEARTBEAT_TIMEOUT)  
       try:
         future.wait()
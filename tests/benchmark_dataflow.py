@@ -0,0 +1,41 @@
+'''
+Measure a map -> map -> reduce pipeline with and without --dataflow.
+
+Without dataflow each stage starts once the previous one has finished on
+every worker; with it, each tile moves on to the next stage as soon as it
+is computed.
+'''
+from spartan import expr, util
+from spartan.config import FLAGS
+import numpy as np
+import test_common
+import time
+
+N_TILES = 64
+TILE_ROWS = 256
+COLS = 4096
+
+
+def _pipeline(x):
+  y = expr.map(x, lambda tile: np.sqrt(tile + 1))
+  z = expr.map(y, lambda tile: np.exp(-tile))
+  return expr.sum(z, axis=0)
+
+
+def benchmark_dataflow(ctx, timer):
+  shape = (N_TILES * TILE_ROWS, COLS)
+  x = expr.rand(*shape, tile_hint=(TILE_ROWS, COLS)).evaluate()
+
+  dataflow = FLAGS.dataflow
+  try:
+    for enabled in (False, True):
+      FLAGS.dataflow = enabled
+      st = time.time()
+      _pipeline(x).glom()
+      elapsed = time.time() - st
+      util.log_info('dataflow=%s: %d tiles in %.3f seconds', enabled, N_TILES, elapsed)
+  finally:
+    FLAGS.dataflow = dataflow
+
+if __name__ == '__main__':
+  test_common.run(__file__)
@@ -0,0 +1,43 @@
+'''
+Measure how quickly expression DAGs are built and optimized on the master.
+
+Iterative algorithms (SGD, CG) build a new DAG of small elementwise
+expressions every iteration; this runs no kernels, only the construction
+and optimization of such DAGs.
+'''
+from spartan import expr, util
+import numpy as np
+import test_common
+import time
+
+N_EXPRS = 2000
+CHAIN_LENGTH = 8
+
+
+def _build(x, y):
+  z = x
+  for i in range(CHAIN_LENGTH):
+    z = z * 0.5 + y
+  return z
+
+
+def benchmark_expr_construction(ctx, timer):
+  x = expr.ones((1000, 1000), tile_hint=(250, 1000)).evaluate()
+  y = expr.ones((1000, 1000), tile_hint=(250, 1000)).evaluate()
+
+  st = time.time()
+  dags = [_build(x, y) for i in range(N_EXPRS)]
+  elapsed = time.time() - st
+  n_nodes = N_EXPRS * CHAIN_LENGTH * 2
+  util.log_info('Construction: %d nodes in %.3f seconds, %.0f nodes/s',
+                n_nodes, elapsed, n_nodes / elapsed)
+
+  st = time.time()
+  for dag in dags[:N_EXPRS / 10]:
+    expr.optimized_dag(dag)
+  elapsed = time.time() - st
+  util.log_info('Optimization: %d DAGs in %.3f seconds, %.0f DAGs/s',
+                N_EXPRS / 10, elapsed, N_EXPRS / 10 / elapsed)
+
+if __name__ == '__main__':
+  test_common.run(__file__)
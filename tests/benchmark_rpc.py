@@ -0,0 +1,62 @@
+''' Measure round-trip latency and throughput of the rpc layer. '''
+from spartan import rpc
+from spartan import util
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+port = 7279
+host = "localhost"
+N_REQUESTS = 1000
+
+class EchoServer(object):
+  def __init__(self, server):
+    self._server = server
+    self._kernel_threads = ThreadPool(processes=1)
+
+  def ping(self, req, handle):
+    handle.done(req)
+
+  def run_kernel(self, req, handle):
+    # reply from a different thread, as workers do for kernels.
+    self._kernel_threads.apply_async(handle.done, args=(req,))
+
+  def shutdown(self, req, handle):
+    handle.done()
+    threading.Thread(target=self._server.shutdown).start()
+
+def _measure(client, method, payload):
+  # warm up the connection
+  getattr(client, method)(payload).wait()
+
+  # one request at a time
+  st = time.time()
+  for i in range(N_REQUESTS):
+    getattr(client, method)(payload).wait()
+  latency = (time.time() - st) / N_REQUESTS
+
+  # many requests in flight
+  st = time.time()
+  rpc.wait_for_all([getattr(client, method)(payload) for i in range(N_REQUESTS)])
+  throughput = N_REQUESTS / (time.time() - st)
+
+  util.log_info('%s %s: %.1f us/round trip, %.0f messages/second',
+                method, 'empty' if payload is None else '%d bytes' % payload.nbytes,
+                latency * 1e6, throughput)
+
+def benchmark_rpc():
+  server = rpc.listen(host, port)
+  server.register_object(EchoServer(server))
+  server_thread = server.serve_nonblock()
+  client = rpc.connect(host, port)
+
+  for payload in [None, np.ones(1024 * 1024, dtype=np.uint8)]:
+    _measure(client, 'ping', payload)
+    _measure(client, 'run_kernel', payload)
+
+  client.shutdown().wait()
+  server_thread.join()
+
+if __name__ == '__main__':
+  benchmark_rpc()
@@ -0,0 +1,43 @@
+'''
+Measure the throughput of concurrent updates to distinct tiles.
+
+Every tile of the source array writes its rows, one update per row, into
+the matching tile of the target.  Run with different --kernel_threads to
+compare how many writers a worker can serve at once.
+'''
+from spartan import expr, util
+from spartan.array import extent
+from spartan.util import Assert
+import numpy as np
+import test_common
+import time
+
+N_TILES = 16
+TILE_ROWS = 64
+COLS = 16384
+
+
+def _write_rows(source, ex):
+  row = np.ones((1, ex.shape[1]))
+  for i in range(ex.ul[0], ex.lr[0]):
+    yield extent.create((i, ex.ul[1]), (i + 1, ex.lr[1]), source.shape), row
+
+
+def benchmark_concurrent_updates(ctx, timer):
+  shape = (N_TILES * TILE_ROWS, COLS)
+  tile_hint = (TILE_ROWS, COLS)
+  source = expr.zeros(shape, dtype=np.float64, tile_hint=tile_hint).evaluate()
+
+  for i in range(3):
+    target = expr.ndarray(shape, dtype=np.float64, tile_hint=tile_hint,
+                          reduce_fn=np.add)
+    st = time.time()
+    result = expr.shuffle(source, _write_rows, target=target).evaluate()
+    elapsed = time.time() - st
+    util.log_info('%d updates of %d bytes: %.3f seconds, %.0f updates/s',
+                  shape[0], COLS * 8, elapsed, shape[0] / elapsed)
+
+  Assert.eq(expr.sum(result).glom(), np.prod(shape))
+
+if __name__ == '__main__':
+  test_common.run(__file__)
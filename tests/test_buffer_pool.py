@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+from spartan.array import buffer_pool
+from spartan.expr.operator import local
+from spartan.util import Assert
+
+SHAPE = (100, 100)
+NBYTES = 100 * 100 * 8
+
+class TestBufferPool(unittest.TestCase):
+  def test_recycle(self):
+    pool = buffer_pool.BufferPool(NBYTES * 4)
+    data = pool.empty(SHAPE, np.float64)
+    addr = data.ctypes.data
+    Assert.eq(pool.recycle(data), True)
+    del data
+
+    # a different shape or dtype is not served from the pool.
+    Assert.eq(pool.empty(SHAPE, np.float32).ctypes.data == addr, False)
+    data = pool.empty(SHAPE, np.float64)
+    Assert.eq(data.ctypes.data, addr)
+    Assert.eq(pool.stats(), (1, 2, 0))
+
+  def test_not_owned(self):
+    pool = buffer_pool.BufferPool(NBYTES * 4)
+    # arrays the pool didn't hand out may be held elsewhere.
+    Assert.eq(pool.recycle(np.ones(SHAPE)), False)
+    data = pool.empty(SHAPE, np.float64)
+    Assert.eq(pool.recycle(data[10:20]), False)
+    Assert.eq(pool.recycle(data), True)
+    # a buffer is only taken back once.
+    Assert.eq(pool.recycle(data), False)
+    Assert.eq(pool.stats()[2], NBYTES)
+
+  def test_budget(self):
+    pool = buffer_pool.BufferPool(NBYTES * 2)
+    for data in [pool.empty(SHAPE, np.float64) for i in range(3)]:
+      Assert.eq(pool.recycle(data), True)
+    Assert.eq(pool.stats()[2], 0)
+
+    for data in [pool.empty(shape, np.float64) for shape in [(10, 10), SHAPE, SHAPE]]:
+      pool.recycle(data)
+    Assert.eq(pool.stats()[2], NBYTES * 2)
+
+  def test_ufunc_out(self):
+    pool = buffer_pool.BufferPool(NBYTES * 4)
+    pool.recycle(pool.empty(SHAPE, np.float64))
+    a = local.LocalInput(idx='a')
+    op = local.LocalMapExpr(fn=np.add, deps=[a, a])
+    ctx = local.LocalCtx(inputs={'a' : np.ones(SHAPE)})
+    result = op.evaluate(ctx, alloc=pool.empty)
+    Assert.all_eq(result, np.ones(SHAPE) * 2)
+    Assert.eq(pool.stats()[0], 1)
+
+    # the result type follows numpy's rules.
+    ctx = local.LocalCtx(inputs={'a' : np.ones(SHAPE, dtype=np.int32)})
+    Assert.eq(op.evaluate(ctx, alloc=pool.empty).dtype, np.int32)
+    op = local.LocalMapExpr(fn=np.greater, deps=[a, a])
+    Assert.eq(op.evaluate(ctx, alloc=pool.empty).dtype, np.bool_)
+
+if __name__ == '__main__':
+  unittest.main()
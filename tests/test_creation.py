@@ -4,6 +4,7 @@ import spartan
 import numpy as np
 import test_common
 from spartan.util import Assert
+from spartan.array import distarray, extent
 
 
 class CreationTest(test_common.ClusterTest):
@@ -90,3 +91,14 @@ class CreationTest(test_common.ClusterTest):
     np_array2 = np.random.randn(dim, dim)
     Assert.all_eq(spartan.diag(spartan.diag(spartan.from_numpy(np_array2))).glom(),
                   np.diag(np.diag(np_array2)))
+
+  def test_create_many_tiles(self):
+    A = distarray.create((100, 100), np.int64, tile_hint=(10, 10))
+    Assert.eq(len(A.tiles), 100)
+    Assert.eq(len(set(A.tiles.values())), 100)
+    A.update(extent.from_shape(A.shape), np.ones((100, 100), dtype=np.int64))
+    Assert.all_eq(A.glom(), np.ones((100, 100)))
+
+    B = distarray.from_replica(A)
+    Assert.eq(set(B.tiles.keys()), set(A.tiles.keys()))
+    Assert.eq(len(set(B.tiles.values()) & set(A.tiles.values())), 0)
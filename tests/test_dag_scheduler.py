@@ -0,0 +1,34 @@
+import numpy as np
+from spartan import expr
+from spartan.config import FLAGS
+from spartan.util import Assert
+import test_common
+
+
+class TestDagScheduler(test_common.ClusterTest):
+  def test_independent_branches(self):
+    # concurrent evaluation is opt-in.
+    concurrent_kernels = FLAGS.concurrent_kernels
+    FLAGS.concurrent_kernels = 4
+    try:
+      a = expr.arange((40, 20), dtype=np.float)
+      b = expr.ones((20, 30))
+      na = np.arange(800, dtype=np.float).reshape((40, 20))
+      nb = np.ones((20, 30))
+
+      # both products, and the shared input of the second, run together.
+      c = expr.dot(a, b) + expr.dot(a * 2, b)
+      Assert.all_eq(c.glom(), np.dot(na, nb) + np.dot(na * 2, nb))
+    finally:
+      FLAGS.concurrent_kernels = concurrent_kernels
+
+  def test_sequential(self):
+    concurrent_kernels = FLAGS.concurrent_kernels
+    FLAGS.concurrent_kernels = 1
+    try:
+      a = expr.arange((40, 20), dtype=np.float)
+      na = np.arange(800, dtype=np.float).reshape((40, 20))
+      Assert.all_eq(expr.sum(a + a * 3, axis=0).glom(), (na * 4).sum(axis=0))
+    finally:
+      FLAGS.concurrent_kernels = concurrent_kernels
+
@@ -0,0 +1,52 @@
+import numpy as np
+from spartan import expr
+from spartan.config import FLAGS
+from spartan.util import Assert
+import test_common
+
+SHAPE = (40, 20)
+TILE_HINT = (10, 20)
+
+
+def _arange():
+  return expr.arange(SHAPE, dtype=np.float, tile_hint=TILE_HINT)
+
+
+def _np_arange():
+  return np.arange(np.prod(SHAPE), dtype=np.float).reshape(SHAPE)
+
+
+class TestDataflow(test_common.ClusterTest):
+  def setUp(self):
+    FLAGS.dataflow = True
+
+  def tearDown(self):
+    FLAGS.dataflow = False
+
+  def test_map_chain(self):
+    a = _arange()
+    b = expr.ones(SHAPE, tile_hint=TILE_HINT)
+    na = _np_arange()
+    # not optimized, so each map is a separate stage.
+    c = expr.sum((a * 2 + b) * 3, axis=0)
+    Assert.all_eq(c.glom(), ((na * 2 + 1) * 3).sum(axis=0))
+
+  def test_broadcast(self):
+    a = _arange()
+    na = _np_arange()
+    row = expr.sum(a, axis=0)
+    Assert.all_eq((a * 2 - row).glom(), na * 2 - na.sum(axis=0))
+
+  def test_map2(self):
+    a = _arange()
+    b = expr.ones(SHAPE, tile_hint=TILE_HINT)
+    na = _np_arange()
+    c = expr.concatenate(a + 1, b * 2, 0)
+    Assert.all_eq(c.glom(), np.concatenate((na + 1, np.ones(SHAPE) * 2), 0))
+
+  def test_shared_input(self):
+    a = _arange() * 2
+    na = _np_arange() * 2
+    b = a + 1
+    c = a * b
+    Assert.all_eq(c.glom(), na * (na + 1))
@@ -1,5 +1,5 @@
 from spartan import util
-from spartan.array import extent
+from spartan.array import extent, distarray
 from spartan.util import Assert
 import random
 
@@ -48,3 +48,21 @@ def test_unravel():
     ravelled = a.ravelled_pos()
     unravelled = extent.unravelled_pos(ravelled, a.array_shape)
     Assert.eq(a.ul, unravelled)
+
+def test_extent_index():
+  shape = (30, 20)
+  grid = distarray.compute_extents(shape, (7, 5)).keys()
+  irregular = [extent.create((0, 0), (10, 20), shape),
+               extent.create((10, 0), (30, 5), shape),
+               extent.create((10, 5), (30, 20), shape)]
+
+  for extents in (grid, irregular):
+    index = extent.ExtentIndex(extents)
+    for i in range(200):
+      x = sorted([random.randint(0, 30), random.randint(0, 30)])
+      y = sorted([random.randint(0, 20), random.randint(0, 20)])
+      region = extent.create((x[0], y[0]), (x[1], y[1]), shape)
+      expected = list(extent.find_overlapping(extents, region))
+      found = index.find_overlapping(region)
+      by_ul = lambda split: split[0].ul
+      Assert.eq(sorted(expected, key=by_ul), sorted(found, key=by_ul))
@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+from spartan.array import extent, fetch_cache
+from spartan.util import Assert
+
+ARRAY_SHAPE = (100, 100)
+REGION_BYTES = 10 * 100 * 8
+
+def _region(i):
+  return extent.create((i * 10, 0), ((i + 1) * 10, 100), ARRAY_SHAPE)
+
+class TestFetchCache(unittest.TestCase):
+  def test_hit_and_miss(self):
+    cache = fetch_cache.FetchCache(REGION_BYTES * 4)
+    key = ((0, 1), 0)
+    Assert.eq(cache.get(key, _region(0)), None)
+
+    data = np.ones((10, 100))
+    cache.put(key, _region(0), data)
+    data[:] = 2
+    result = cache.get(key, _region(0))
+    Assert.all_eq(result, np.ones((10, 100)))
+
+    # callers get their own copy.
+    result[:] = 3
+    Assert.all_eq(cache.get(key, _region(0)), np.ones((10, 100)))
+
+    # a new version of the array misses.
+    Assert.eq(cache.get(((0, 1), 1), _region(0)), None)
+    Assert.eq(cache.stats(), (2, 2))
+
+  def test_budget(self):
+    cache = fetch_cache.FetchCache(REGION_BYTES * 2)
+    key = ((0, 1), 0)
+    for i in range(3):
+      cache.put(key, _region(i), np.ones((10, 100)) * i)
+    Assert.eq(len(cache), 2)
+    Assert.eq(cache.get(key, _region(0)), None)
+    Assert.all_eq(cache.get(key, _region(2)), np.ones((10, 100)) * 2)
+
+  def test_invalidate(self):
+    cache = fetch_cache.FetchCache(REGION_BYTES * 4)
+    cache.put(((0, 1), 0), _region(0), np.ones((10, 100)))
+    cache.put(((0, 1), 1), _region(1), np.ones((10, 100)))
+    cache.put(((0, 2), 0), _region(0), np.ones((10, 100)))
+    cache.invalidate((0, 1))
+    Assert.eq(len(cache), 1)
+    Assert.all_eq(cache.get(((0, 2), 0), _region(0)), np.ones((10, 100)))
+
+  def test_end_kernel(self):
+    cache = fetch_cache.FetchCache(REGION_BYTES * 4)
+    key = ((0, 1), 0)
+    first, second = object(), object()
+    cache.set_kernel(first)
+    cache.put(key, _region(0), np.ones((10, 100)))
+    cache.set_kernel(second)
+    cache.put(key, _region(1), np.ones((10, 100)))
+    # kernels only see the regions they fetched.
+    Assert.eq(cache.get(key, _region(0)), None)
+
+    cache.end_kernel(first)
+    Assert.eq(len(cache), 1)
+    Assert.all_eq(cache.get(key, _region(1)), np.ones((10, 100)))
+    cache.set_kernel(None)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+from spartan import kernel_cache
+from spartan.util import Assert
+
+def _make_kernel(scale):
+  def _kernel(tile_id, blob, vec):
+    return blob * scale + vec
+  return _kernel
+
+def _sum_kernel(tile_id, blob, vecs):
+  return blob + sum(vecs)
+
+class TestKernelCache(unittest.TestCase):
+  def test_repeated_kernel(self):
+    encoder = kernel_cache.KernelEncoder(16)
+    cache = kernel_cache.KernelCache(16)
+    vec = np.arange(kernel_cache.MIN_CACHED_BYTES, dtype=np.float64)
+
+    skeleton, uploads, objects = encoder.encode(_make_kernel(2), {'vec' : vec}, [0])
+    Assert.eq(len(uploads), 2)
+    fn, kw = cache.load(skeleton, uploads)
+    Assert.all_eq(fn(None, 1, **kw), vec + 2)
+    # cached arrays are shared between kernels, so they can't be written.
+    Assert.eq(kw['vec'].flags.writeable, False)
+    Assert.eq(vec.flags.writeable, True)
+
+    # The same function and argument are sent by digest only.
+    skeleton, uploads, objects = encoder.encode(_make_kernel(2), {'vec' : vec.copy()}, [0])
+    Assert.eq(len(uploads), 0)
+    fn, kw = cache.load(skeleton, uploads)
+    Assert.all_eq(fn(None, 1, **kw), vec + 2)
+
+    # A new closure value changes the function digest, but not the array's.
+    skeleton, uploads, objects = encoder.encode(_make_kernel(3), {'vec' : vec}, [0])
+    Assert.eq(len(uploads), 1)
+    fn, kw = cache.load(skeleton, uploads)
+    Assert.all_eq(fn(None, 1, **kw), vec + 3)
+
+  def test_miss(self):
+    encoder = kernel_cache.KernelEncoder(16)
+    vec = np.arange(kernel_cache.MIN_CACHED_BYTES, dtype=np.float64)
+    encoder.encode(_make_kernel(2), {'vec' : vec}, [0])
+
+    # A fresh worker holds nothing the encoder expects it to.
+    cache = kernel_cache.KernelCache(16)
+    skeleton, uploads, objects = encoder.encode(_make_kernel(2), {'vec' : vec}, [0])
+    self.assertRaises(kernel_cache.CacheMiss, cache.load, skeleton, uploads)
+
+    uploads = encoder.reupload(0, objects)
+    fn, kw = cache.load(skeleton, uploads)
+    Assert.all_eq(fn(None, 1, **kw), vec + 2)
+
+  def test_eviction_order(self):
+    # The encoder must evict the same objects as the worker, or kernels
+    # referring to an object the worker dropped miss.
+    encoder = kernel_cache.KernelEncoder(2)
+    cache = kernel_cache.KernelCache(2)
+    vecs = [np.ones(kernel_cache.MIN_CACHED_BYTES) * i for i in range(3)]
+    for order in [(0, 1), (1, 0), (0, 2), (2, 0), (0, 1)]:
+      args = [vecs[i] for i in order]
+      skeleton, uploads, objects = encoder.encode(_sum_kernel, {'vecs' : args}, [0])
+      fn, kw = cache.load(skeleton, uploads)
+      Assert.all_eq(fn(None, 1, **kw), np.ones(kernel_cache.MIN_CACHED_BYTES) * (1 + sum(order)))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,42 @@
+import cPickle
+import unittest
+
+from spartan.node import SlotNode, Instance, List, PythonValue, Str
+from spartan.util import Assert
+
+
+class Point(SlotNode):
+  x = PythonValue(0)
+  y = PythonValue(0)
+  label = Str
+  tags = List()
+
+
+class LabeledPoint(Point):
+  tags = PythonValue(None, desc="list or None")
+  parent = Instance(Point)
+
+
+class TestSlotNode(unittest.TestCase):
+  def test_members(self):
+    Assert.eq(Point.__slots__, ('label', 'tags', 'x', 'y'))
+    # redeclared members keep their slot, with a new default.
+    Assert.eq(LabeledPoint.__slots__, ('parent',))
+    Assert.eq(set(LabeledPoint().members), set(['label', 'tags', 'x', 'y', 'parent']))
+
+  def test_defaults(self):
+    a = Point(x=1)
+    b = Point()
+    a.tags.append('a')
+    Assert.eq((a.x, a.y, a.label, a.tags), (1, 0, '', ['a']))
+    Assert.eq(b.tags, [])
+    Assert.eq(LabeledPoint().tags, None)
+
+  def test_pickle(self):
+    p = LabeledPoint(x=2, parent=Point(y=3))
+    p.extra = 'extra'
+    q = cPickle.loads(cPickle.dumps(p, -1))
+    Assert.eq((q.x, q.parent.y, q.extra), (2, 3, 'extra'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,6 @@
 from spartan import array, expr
 from spartan.config import FLAGS
+from spartan.expr.operator import optimize
 from spartan.util import Assert
 import test_common
 import numpy as np
@@ -179,3 +180,18 @@ class TestOptimization(test_common.ClusterTest):
 
     for child in a.optimized().op.deps:
       Assert.true(not isinstance(child, expr.operator.local.LocalInput))
+
+  def test_optimization_cse(self):
+    na = np.random.rand(100, 100)
+    a = expr.from_numpy(na)
+    b = (a.T - 1) ** 2 + (a.T - 1) ** 2
+
+    dag = optimize.apply_pass(optimize.CommonSubexpressionElimination, b)
+    left, right = dag.children
+    Assert.eq(left.expr_id, right.expr_id)
+    # random arrays are never merged.
+    dag = optimize.apply_pass(optimize.CommonSubexpressionElimination,
+                              expr.rand(10, 10) + expr.rand(10, 10))
+    Assert.ne(dag.children[0].expr_id, dag.children[1].expr_id)
+
+    Assert.all_eq(b.optimized().glom(), 2 * (na.T - 1) ** 2, tolerance=1e-10)
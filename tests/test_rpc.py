@@ -64,3 +64,21 @@ def test_rpc():
   #shutdown server
   client.shutdown()
   server_thread.join()
+
+
+def test_broadcast_tree():
+  addrs = [('host%d' % (i / 2), 1000 + i) for i in range(10)]
+  tree = rpc.broadcast_tree(addrs, 2)
+
+  def nodes(tree):
+    for addr, children in tree:
+      yield addr
+      for child in nodes(children):
+        yield child
+
+  # every server is reached exactly once
+  assert sorted(nodes(tree)) == sorted(addrs)
+  # the sender sends to one relay per host, for ``fanout`` hosts
+  assert [addr for addr, _ in tree] == [('host0', 1000), ('host1', 1002)]
+  # each relay forwards to the other server on its host first
+  assert tree[0][1][0] == (('host0', 1001), [])
@@ -97,9 +97,33 @@ def test_function():
   cPickle_dump(a)
 
 
+def test_out_of_band():
+  from spartan.rpc import common
+  dense = np.random.rand(*ARRAY_SIZE)
+  masked = np.ma.masked_less(dense, 0.5)
+  sparse = sp.coo_matrix(dense > 0.9)
+  msg = spartan.core.GetResp(data=[dense, dense.T, masked, sparse])
+
+  frames = list(common.encode_message({'rpc_id': 0}, msg))
+  t1 = datetime.now()
+  reader = Reader(frames[0])
+  cPickle.load(reader)
+  new_msg = common.read(reader, frames[1:])
+  t2 = datetime.now()
+  print "out_of_band: %s ms" % millis(t1, t2)
+
+  Assert.all_eq(new_msg.data[0], dense)
+  Assert.all_eq(new_msg.data[1], dense.T)
+  Assert.all_eq(new_msg.data[2].mask, masked.mask)
+  Assert.all_eq(new_msg.data[3].todense(), sparse.todense())
+  # received arrays can be updated in place
+  new_msg.data[0][0, 0] = 2
+  Assert.eq(new_msg.data[0][0, 0], 2)
+
+
 def test_all():
   fns = [test_dense_array, test_noncontiguous_array, test_scalar, test_sparse,
-         test_mask_array, test_message, test_function]
+         test_mask_array, test_message, test_function, test_out_of_band]
   for fn in fns:
     print fn.func_name
     fn()
@@ -4,7 +4,7 @@ import unittest
 
 import spartan
 import numpy as np
-from spartan import expr, util
+from spartan import blob_ctx, expr, util
 from spartan.array import distarray, extent
 from spartan.util import Assert
 import test_common
@@ -80,6 +80,34 @@ class SliceTest(test_common.ClusterTest):
     nv = na[1:] - na[:-1]
     Assert.all_eq(v, nv)
 
+  def test_iter_tiles(self):
+    x = expr.arange((TEST_SIZE, TEST_SIZE), tile_hint=(3, TEST_SIZE))
+    nx = np.arange(TEST_SIZE * TEST_SIZE).reshape(TEST_SIZE, TEST_SIZE)
+    last = None
+    for ex, data in x.iter_tiles(window=2):
+      Assert.all_eq(data, nx[ex.to_slice()])
+      if last is not None:
+        Assert.le(last, ex.ul)
+      last = ex.ul
+
+  def test_iter_blocks(self):
+    x = expr.arange((TEST_SIZE, TEST_SIZE), tile_hint=(3, 3))
+    nx = np.arange(TEST_SIZE * TEST_SIZE).reshape(TEST_SIZE, TEST_SIZE)
+    for axis in [0, 1]:
+      blocks = [data for ex, data in x.iter_blocks(axis, block_rows=4)]
+      Assert.eq(len(blocks), 3)
+      Assert.all_eq(np.concatenate(blocks, axis=axis), nx)
+
+  def test_prefetch(self):
+    x = expr.arange((TEST_SIZE, TEST_SIZE), tile_hint=(3, 3)).evaluate()
+    nx = np.arange(TEST_SIZE * TEST_SIZE).reshape(TEST_SIZE, TEST_SIZE)
+    region = extent.create((2, 1), (8, 7), x.shape)
+    Assert.eq(x.prefetch(region), 6 * 6 * np.dtype(x.dtype).itemsize)
+    # a second prefetch of the same region is not started.
+    Assert.eq(x.prefetch(region), 0)
+    Assert.all_eq(x.fetch(region), nx[2:8, 1:7])
+    Assert.eq(blob_ctx.get().has_prefetch((x.cache_key(), region)), False)
+
 if __name__ == '__main__':
   rest = spartan.config.initialize(sys.argv)
   unittest.main(argv=rest)
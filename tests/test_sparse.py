@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+import scipy.sparse
 from spartan import expr, util
 from spartan.util import Assert
 import test_common
@@ -49,5 +50,12 @@ class TestReduce(test_common.ClusterTest):
     print 'test multiply'
     z = expr.dot(x, x)
     print z.glom().todense()
+
+  def test_sparse_iter_blocks(self):
+    x = expr.sparse_diagonal(ARRAY_SIZE, tile_hint=(3, 3)).evaluate()
+    blocks = [data for ex, data in x.iter_blocks(0, block_rows=4)]
+    Assert.eq(len(blocks), 3)
+    Assert.all_eq(scipy.sparse.vstack(blocks).todense(), np.eye(ARRAY_SIZE[0]))
+
 if __name__ == '__main__':
   unittest.main()
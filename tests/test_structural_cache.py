@@ -0,0 +1,69 @@
+import numpy as np
+from spartan import expr, rpc
+from spartan.config import FLAGS
+from spartan.core import LocalKernelResult
+from spartan.expr.operator import base
+from spartan.util import Assert
+import test_common
+
+_offset = [0]
+
+
+def _column_sums(x):
+  return expr.sum(expr.lazify(x) * 2, axis=0)
+
+
+def _offset_sum(x):
+  return expr.sum(expr.map(expr.lazify(x), lambda v: v + _offset[0]))
+
+
+def _fill_mapper(ex, target=None):
+  futures = rpc.FutureGroup()
+  futures.append(target.update(ex, np.ones(ex.shape, dtype=target.dtype), wait=False))
+  return LocalKernelResult(result=None, futures=futures)
+
+
+class TestStructuralCache(test_common.ClusterTest):
+  def setUp(self):
+    FLAGS.opt_structural_cache = True
+
+  def tearDown(self):
+    FLAGS.opt_structural_cache = False
+
+  def test_rebuilt_expr(self):
+    x = expr.arange((20, 10), dtype=np.float).evaluate()
+    hits = base.eval_cache.hits
+    first = _column_sums(x).evaluate()
+    second = _column_sums(x).evaluate()
+    Assert.eq(base.eval_cache.hits, hits + 1)
+    Assert.eq(first.cache_key(), second.cache_key())
+
+  def test_write_invalidates(self):
+    x = expr.arange((20, 10), dtype=np.float).evaluate()
+    nx = np.arange(200, dtype=np.float).reshape((20, 10))
+    Assert.all_eq(_column_sums(x).glom(), (nx * 2).sum(axis=0))
+
+    expr.write(x, np.s_[0:1, :], np.ones((1, 10)), np.s_[0:1, :]).evaluate()
+    nx[0] = 1
+    Assert.all_eq(_column_sums(x).glom(), (nx * 2).sum(axis=0))
+
+  def test_kernel_write_invalidates(self):
+    x = expr.arange((20, 10), dtype=np.float).evaluate()
+    nx = np.arange(200, dtype=np.float).reshape((20, 10))
+    Assert.all_eq(_column_sums(x).glom(), (nx * 2).sum(axis=0))
+
+    # updated by the workers, without telling the master.
+    x.foreach_tile(mapper_fn=_fill_mapper, kw={'target' : x})
+    Assert.all_eq(_column_sums(x).glom(), np.ones(10) * 40)
+
+  def test_mutable_global_not_cached(self):
+    x = expr.ones((10, 10)).evaluate()
+    _offset[0] = 0
+    Assert.eq(_offset_sum(x).glom(), 100)
+    _offset[0] = 1
+    Assert.eq(_offset_sum(x).glom(), 200)
+
+  def test_random_not_cached(self):
+    first = expr.sum(expr.rand(10, 10)).glom()
+    second = expr.sum(expr.rand(10, 10)).glom()
+    Assert.ne(first, second)
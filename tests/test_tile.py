@@ -17,7 +17,8 @@ class TestTile(test_common.ClusterTest):
   def test_create_dense(self):
     t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_DENSE)
     t._initialize()
-    Assert.eq(t.mask.shape, ARRAY_SIZE)
+    Assert.eq(t.mask, tile.MASK_ALL_CLEAR)
+    Assert.eq(t.valid_mask().shape, ARRAY_SIZE)
     
   def test_create_sparse(self):
     t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_SPARSE)
@@ -31,6 +32,27 @@ class TestTile(test_common.ClusterTest):
     t.update(UPDATE_SUBSLICE, update, None)
     print t.data
     
+  def test_partial_mask(self):
+    t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_DENSE)
+    t.update(UPDATE_SUBSLICE, np.ones(UPDATE_SHAPE), np.add)
+    Assert.eq(t.mask, [((0, 8), (0, 8))])
+    Assert.eq(t.all_valid(UPDATE_SUBSLICE), True)
+    Assert.isinstance(t.get((slice(0, 10), slice(0, 10))), np.ma.MaskedArray)
+
+    t.update(UPDATE_SUBSLICE, np.ones(UPDATE_SHAPE), np.add)
+    Assert.all_eq(t.get(UPDATE_SUBSLICE), np.ones(UPDATE_SHAPE) * 2)
+
+    t.update((slice(0, 10), slice(0, 10)), np.ones(ARRAY_SIZE), np.add)
+    Assert.eq(t.mask, tile.MASK_ALL_SET)
+    Assert.eq(t.data[0, 0], 3)
+    Assert.eq(t.data[9, 9], 1)
+
+  def test_strided_mask(self):
+    t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_DENSE)
+    t.update((slice(0, 10, 2), slice(0, 10)), np.ones((5, 10)), None)
+    Assert.isinstance(t.mask, np.ndarray)
+    Assert.eq(t.valid_mask().sum(), 50)
+
   def test_update_dense_to_sparse(self):
     t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_SPARSE)
     update = np.ones(UPDATE_SHAPE)
@@ -54,6 +76,86 @@ class TestTile(test_common.ClusterTest):
     t.update(UPDATE_SUBSLICE, update, None)
     Assert.eq(sp.issparse(t.data), True)
     print t.data.todense()
-    
+
+  def test_sparse_merge(self):
+    for dtype in [np.float32, np.float64, np.int64]:
+      # np.maximum has no native kernel.
+      for reducer in [None, np.add, np.multiply, np.maximum]:
+        t = tile.from_data(sp.eye(ARRAY_SIZE[0], dtype=dtype, format='coo'))
+        Assert.eq(t.data.format, 'csr')
+        expected = np.eye(ARRAY_SIZE[0], dtype=dtype)
+
+        update = sp.rand(UPDATE_SHAPE[0], UPDATE_SHAPE[1], density=0.3, format='csc').astype(dtype)
+        t.update(UPDATE_SUBSLICE, update, reducer)
+        if reducer is None:
+          expected[UPDATE_SUBSLICE] = update.toarray()
+        else:
+          expected[UPDATE_SUBSLICE] = reducer(expected[UPDATE_SUBSLICE], update.toarray())
+        Assert.all_eq(t.data.toarray(), expected)
+
+        update = np.arange(np.prod(UPDATE_SHAPE)).reshape(UPDATE_SHAPE).astype(dtype)
+        t.update(UPDATE_SUBSLICE, update, reducer)
+        if reducer is None:
+          expected[UPDATE_SUBSLICE] = update
+        else:
+          expected[UPDATE_SUBSLICE] = reducer(expected[UPDATE_SUBSLICE], update)
+        Assert.all_eq(t.data.toarray(), expected)
+
+  def test_sparse_get(self):
+    data = sp.rand(ARRAY_SIZE[0], ARRAY_SIZE[1], density=0.5, format='csr')
+    t = tile.from_data(data)
+    result = t.get((slice(2, 7), slice(3, 10)))
+    Assert.eq(result.format, 'csr')
+    Assert.all_eq(result.toarray(), data.toarray()[2:7, 3:10])
+
+  def test_constant(self):
+    t = tile.from_constant(ARRAY_SIZE, np.float32, 0)
+    Assert.eq(t.is_constant(), True)
+    Assert.all_eq(t.get(UPDATE_SUBSLICE), np.zeros(UPDATE_SHAPE))
+    # values read from the tile may be kept and written by the caller.
+    Assert.eq(t.get(UPDATE_SUBSLICE).flags.writeable, True)
+
+    # adding to a tile of zeros replaces it, without allocating the zeros.
+    update = np.ones(ARRAY_SIZE, dtype=np.float32)
+    t.update((slice(0, 10), slice(0, 10)), update, np.add)
+    Assert.eq(t.is_constant(), False)
+    Assert.all_eq(t.data, update)
+
+    t = tile.from_constant(ARRAY_SIZE, np.float32, 2)
+    t.update(UPDATE_SUBSLICE, np.ones(UPDATE_SHAPE, dtype=np.float32), np.multiply)
+    Assert.eq(t.is_constant(), False)
+    Assert.eq(t.data[0, 0], 2)
+    Assert.eq(t.data[9, 9], 2)
+    Assert.eq(t.data.sum(), 200)
+
+  def test_read_only_data(self):
+    data = np.ones(ARRAY_SIZE, dtype=np.float32)
+    data.flags.writeable = False
+    t = tile.from_data(data)
+    t.update(UPDATE_SUBSLICE, np.ones(UPDATE_SHAPE, dtype=np.float32), np.add)
+    Assert.eq(t.data.sum(), np.prod(ARRAY_SIZE) + np.prod(UPDATE_SHAPE))
+    Assert.eq(data.sum(), np.prod(ARRAY_SIZE))
+
+  def test_first_write(self):
+    update = np.arange(np.prod(ARRAY_SIZE), dtype=np.float32).reshape(ARRAY_SIZE) - 50
+    for reducer in [None, np.add, np.maximum]:
+      t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_DENSE)
+      # unwritten elements are replaced, not reduced with zero.
+      t.update(None, update, reducer)
+      result = t.get((slice(0, 10), slice(0, 10)))
+      Assert.eq(isinstance(result, np.ma.MaskedArray), False)
+      Assert.all_eq(result, update)
+
+  def test_empty_dense_is_lazy(self):
+    t = tile.from_shape(ARRAY_SIZE, dtype=np.float32, tile_type=tile.TYPE_DENSE)
+    t._initialize()
+    Assert.eq(t.is_constant(), True)
+    # unwritten elements read as masked.
+    Assert.eq(t.get(UPDATE_SUBSLICE).mask.all(), True)
+    t.update(UPDATE_SUBSLICE, np.ones(UPDATE_SHAPE, dtype=np.float32), None)
+    Assert.eq(t.is_constant(), False)
+    Assert.all_eq(t.get(UPDATE_SUBSLICE), np.ones(UPDATE_SHAPE))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from spartan.array import tile, tile_store
+from spartan.util import Assert
+
+TILE_SHAPE = (100, 100)
+TILE_BYTES = 100 * 100 * 8
+
+class TestTileStore(unittest.TestCase):
+  def setUp(self):
+    self.spill_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.spill_dir)
+
+  def _make_tile(self, value):
+    return tile.from_data(np.ones(TILE_SHAPE, dtype=np.float64) * value)
+
+  def test_no_budget(self):
+    store = tile_store.TileStore(0, self.spill_dir)
+    for i in range(4):
+      store[i] = self._make_tile(i)
+    Assert.eq(store.stats(), (0, 0, 0, 0))
+    Assert.eq(os.listdir(self.spill_dir), [])
+
+  def test_spill_and_reload(self):
+    # Room for the data of about two tiles (fully written tiles have no mask).
+    store = tile_store.TileStore(TILE_BYTES * 5 / 2, self.spill_dir)
+    for i in range(4):
+      store[i] = self._make_tile(i)
+
+    spill_count, spill_bytes, _, _ = store.stats()
+    Assert.eq(spill_count, 2)
+    Assert.eq(spill_bytes, 2 * TILE_BYTES)
+    Assert.eq(len(os.listdir(self.spill_dir)), 2)
+    Assert.isinstance(store.peek(0).data, np.memmap)
+
+    for i in range(4):
+      Assert.all_eq(store[i].data, np.ones(TILE_SHAPE) * i)
+    Assert.eq(store.reload_count, 2)
+    Assert.eq(store.reload_bytes, 2 * TILE_BYTES)
+    Assert.eq(len(os.listdir(self.spill_dir)), 0)
+
+  def test_update_spilled(self):
+    store = tile_store.TileStore(TILE_BYTES, self.spill_dir)
+    store[0] = self._make_tile(0)
+    store[1] = self._make_tile(1)
+    Assert.isinstance(store.peek(0).data, np.memmap)
+
+    t = store[0]
+    store[0] = t.update((slice(0, 10), slice(0, 10)), np.ones((10, 10)), np.add)
+    Assert.eq(store[0].data[0, 0], 1)
+    Assert.eq(store[0].data[50, 50], 0)
+
+  def test_locked_not_spilled(self):
+    locks = dict([(i, threading.Lock()) for i in range(3)])
+    store = tile_store.TileStore(TILE_BYTES, self.spill_dir, tile_lock=locks.get)
+    store[0] = self._make_tile(0)
+
+    # tile 0 is being updated by another thread, so it stays in memory.
+    with locks[0]:
+      store[1] = self._make_tile(1)
+    Assert.eq(isinstance(store.peek(0).data, np.memmap), False)
+    Assert.eq(store.spill_count, 0)
+
+    store[2] = self._make_tile(2)
+    Assert.isinstance(store.peek(0).data, np.memmap)
+
+  def test_delete_spilled(self):
+    store = tile_store.TileStore(TILE_BYTES, self.spill_dir)
+    store[0] = self._make_tile(0)
+    store[1] = self._make_tile(1)
+    Assert.eq(len(os.listdir(self.spill_dir)), 1)
+    store.clear()
+    Assert.eq(len(store), 0)
+    Assert.eq(os.listdir(self.spill_dir), [])
+
+if __name__ == '__main__':
+  unittest.main()